@@ -1,3 +1,14 @@
 #!/usr/bin/env python
-from lsst.meas.extensions.astromNet.multiindex import generateCache
-generateCache()
+import argparse
+
+from lsst.meas.extensions.astrometryNet.multiindex import generateCache
+
+parser = argparse.ArgumentParser(description="Generate the andCache.fits file for astrometry_net_data")
+parser.add_argument("--densityNside", type=int, default=16,
+                    help="healpix nside of the reference density maps; 0 for no maps")
+parser.add_argument("--quantiles", type=float, nargs="+", default=[0.1, 0.5, 0.9],
+                    help="magnitude quantile levels for the reference density maps")
+parser.add_argument("--magColumn", default=None,
+                    help="magnitude column for the reference density maps (default: defaultMagColumn)")
+args = parser.parse_args()
+generateCache(densityNside=args.densityNside, quantiles=args.quantiles, magColumn=args.magColumn)
@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+from lsst.meas.extensions.astrometryNet.queryPlanner import main
+main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time cleanBadPoints.clean against the original per-match implementation
+on a synthetic list of matches, e.g.:
+
+    python examples/benchmarkCleanBadPoints.py --numMatches 10000
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.astrom.sip import LeastSqFitter1dPoly
+from lsst.meas.extensions.astrometryNet import cleanBadPoints
+
+
+def legacyClean(srcMatch, wcs, order=3, nsigma=3, maxiter=100):
+    """The original implementation of cleanBadPoints.clean"""
+    catX = np.array([wcs.skyToPixel(m.first.getCoord()).getX() for m in srcMatch])
+    x = np.array([s.second.getX() for s in srcMatch])
+    y = x - catX
+    idx = x.argsort()
+    newidx = []
+    for niter in range(maxiter):
+        rSize = len(idx)/float(order+1)
+        rx = np.zeros((order+1))
+        ry = np.zeros((order+1))
+        for i in range(order+1):
+            rng = list(range(int(rSize*i), int(rSize*(i+1))))
+            rx[i] = np.mean(x[idx[rng]])
+            ry[i] = np.median(y[idx[rng]])
+        lsf = LeastSqFitter1dPoly(list(rx), list(ry), list(np.ones(len(rx))), order)
+        f = [lsf.valueAt(value) for value in x]
+        sigma = (y - f).std()
+        if sigma == 0:
+            newidx = newidx if len(newidx) else idx
+            break
+        newidx = np.flatnonzero(np.fabs((y - f)/sigma) < nsigma)
+        if len(newidx) == len(idx):
+            break
+    return [srcMatch[i] for i in newidx]
+
+
+def makeMatches(numMatches, outlierFraction, rng):
+    """Make a list of matches with a TAN WCS and some outliers"""
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(2000, 2000),
+                             crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                             cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+    refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+    srcSchema = afwTable.SourceTable.makeMinimalSchema()
+    centroidKey = afwTable.Point2DKey.addFields(srcSchema, "centroid", "centroid", "pixel")
+    srcSchema.getAliasMap().set("slot_Centroid", "centroid")
+    srcCat = afwTable.SourceCatalog(srcSchema)
+    matches = []
+    for i in range(numMatches):
+        x, y = rng.uniform(0, 4000, 2)
+        ref = refCat.addNew()
+        ref.setCoord(wcs.pixelToSky(x, y))
+        src = srcCat.addNew()
+        offset = rng.normal(0, 3) if rng.uniform() < outlierFraction else 0
+        src.set(centroidKey, afwGeom.Point2D(x + rng.normal(0, 0.02) + offset, y + rng.normal(0, 0.02)))
+        matches.append(afwTable.ReferenceMatch(ref, src, 0.0))
+    return matches, wcs
+
+
+def timeIt(func, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--numMatches", type=int, default=10000, help="number of matches")
+    parser.add_argument("--outlierFraction", type=float, default=0.05, help="fraction of outliers")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timings (the best is reported)")
+    args = parser.parse_args()
+
+    matches, wcs = makeMatches(args.numMatches, args.outlierFraction, np.random.RandomState(12345))
+    legacyTime, legacyResult = timeIt(lambda: legacyClean(matches, wcs), args.repeat)
+    newTime, newResult = timeIt(lambda: cleanBadPoints.clean(matches, wcs), args.repeat)
+    jointTime, jointResult = timeIt(lambda: cleanBadPoints.clean(matches, wcs, useY=True), args.repeat)
+
+    same = [m.second.getId() for m in legacyResult] == [m.second.getId() for m in newResult]
+    print("%d matches" % (len(matches),))
+    print("legacy (X only):     %8.3f s, %d kept" % (legacyTime, len(legacyResult)))
+    print("vectorized (X only): %8.3f s, %d kept; same as legacy: %s" % (newTime, len(newResult), same))
+    print("vectorized (X and Y): %7.3f s, %d kept" % (jointTime, len(jointResult)))
+
+
+if __name__ == "__main__":
+    main()
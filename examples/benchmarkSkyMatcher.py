@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time repeated matching of a dense synthetic field, as in the SIP iterations of
+ANetBasicAstrometryTask, using lsst.meas.astrom.sip.MatchSrcToCatalogue for each
+iteration and using one SkyMatcher for all iterations, e.g.:
+
+    python examples/benchmarkSkyMatcher.py --numObjects 20000 --numIter 5
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.meas.astrom.sip as astromSip
+from lsst.meas.extensions.astrometryNet.skyMatcher import SkyMatcher
+
+
+def makeField(numObjects, rng):
+    """Make a reference catalog and a source catalog for a 4k x 4k TAN WCS"""
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(2000, 2000),
+                             crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                             cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+    refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+    srcSchema = afwTable.SourceTable.makeMinimalSchema()
+    centroidKey = afwTable.Point2DKey.addFields(srcSchema, "centroid", "centroid", "pixel")
+    srcSchema.getAliasMap().set("slot_Centroid", "centroid")
+    srcCat = afwTable.SourceCatalog(srcSchema)
+    for i in range(numObjects):
+        x, y = rng.uniform(0, 4000, 2)
+        ref = refCat.addNew()
+        ref.setCoord(wcs.pixelToSky(x, y))
+        src = srcCat.addNew()
+        src.set(centroidKey, afwGeom.Point2D(x + rng.normal(0, 0.5), y + rng.normal(0, 0.5)))
+    return refCat, srcCat, wcs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--numObjects", type=int, default=20000, help="number of objects")
+    parser.add_argument("--numIter", type=int, default=5, help="number of matching iterations")
+    args = parser.parse_args()
+
+    refCat, srcCat, wcs = makeField(args.numObjects, np.random.RandomState(12345))
+    radius = 1.0*afwGeom.arcseconds
+
+    t0 = time.time()
+    for i in range(args.numIter):
+        legacy = astromSip.MatchSrcToCatalogue(refCat, srcCat, wcs, radius).getMatches()
+    legacyTime = time.time() - t0
+
+    t0 = time.time()
+    matcher = SkyMatcher.fromCatalog(refCat, wcs.pixelToSky(2000, 2000), radius)
+    buildTime = time.time() - t0
+    for i in range(args.numIter):
+        found = matcher.matchPixels(srcCat.getX(), srcCat.getY(), wcs)
+    newTime = time.time() - t0
+
+    print("%d objects, %d iterations" % (args.numObjects, args.numIter))
+    print("MatchSrcToCatalogue: %8.3f s, %d matches" % (legacyTime, len(legacy)))
+    print("SkyMatcher:          %8.3f s (%.3f s to build), %d matches; speedup %.1f" %
+          (newTime, buildTime, len(found.refIndex), legacyTime/newTime))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Compare blind solves using the globally brightest sources with solves using
+the brightest sources in each cell of a grid (config.doSpatialThinning).
+
+Uses the test catalogs and astrometry_net_data in the tests directory, e.g.:
+
+    python examples/benchmarkSpatialThinning.py --repeat 5
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.extensions.astrometryNet import ANetBasicAstrometryTask
+
+TestDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tests")
+
+# catalog file name, astrometry_net_data version, image bounding box
+Datasets = [
+    ("v695833-e0-c000.xy.fits", "photocal",
+     afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4612))),
+    ("cat.xy.fits", "cfhttemplate",
+     afwGeom.Box2I(afwGeom.Point2I(500, 500), afwGeom.Extent2I(1000, 1000))),
+]
+
+
+def runSolves(catalogName, dataName, bbox, doSpatialThinning, numCells, numPerCell, repeat):
+    """Solve a catalog repeatedly; return the solve times and the number of successes"""
+    os.environ["ASTROMETRY_NET_DATA_DIR"] = os.path.join(TestDir, "astrometry_net_data", dataName)
+    sourceCat = afwTable.SourceCatalog.readFits(os.path.join(TestDir, catalogName))
+    if not sourceCat.isContiguous():
+        sourceCat = sourceCat.copy(deep=True)
+    config = ANetBasicAstrometryTask.ConfigClass()
+    config.doSpatialThinning = doSpatialThinning
+    config.thinningNumCells = numCells
+    config.thinningNumPerCell = numPerCell
+    task = ANetBasicAstrometryTask(config=config)
+
+    times = []
+    numSolved = 0
+    for i in range(repeat):
+        t0 = time.time()
+        res = task.solveArrays(sourceCat.getX(), sourceCat.getY(), sourceCat.getPsfInstFlux(), bbox=bbox)
+        times.append(time.time() - t0)
+        if res.wcs is not None:
+            numSolved += 1
+    return np.array(times), numSolved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="number of solves per configuration")
+    parser.add_argument("--numCells", type=int, default=4, help="number of cells along each axis")
+    parser.add_argument("--numPerCell", type=int, default=3, help="number of sources kept per cell")
+    args = parser.parse_args()
+
+    print("%-26s %-10s %10s %10s %8s" % ("catalog", "selection", "mean (s)", "min (s)", "solved"))
+    for catalogName, dataName, bbox in Datasets:
+        for doSpatialThinning in (False, True):
+            times, numSolved = runSolves(catalogName, dataName, bbox, doSpatialThinning,
+                                         args.numCells, args.numPerCell, args.repeat)
+            print("%-26s %-10s %10.3f %10.3f %5d/%d" %
+                  (catalogName, "grid" if doSpatialThinning else "global", times.mean(), times.min(),
+                   numSolved, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
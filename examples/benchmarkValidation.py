@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Time the match-list checks made by ANetBasicAstrometryTask.useKnownWcs at each
+config.validationLevel, on a synthetic catalog in which every source is matched, e.g.:
+
+    python examples/benchmarkValidation.py --numSources 20000
+
+The "full" level is quadratic in the number of sources, so takes minutes at this size.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import lsst.afw.table as afwTable
+from lsst.meas.extensions.astrometryNet import ANetBasicAstrometryTask
+
+
+def makeMatches(numSources):
+    """Make a source catalog and a list of matches to every source"""
+    refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+    sourceCat = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+    matches = []
+    for i in range(numSources):
+        ref = refCat.addNew()
+        ref.setId(i + 1)
+        src = sourceCat.addNew()
+        src.setId(i + 1)
+        matches.append(afwTable.ReferenceMatch(ref, src, 0.0))
+    return sourceCat, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--numSources", type=int, default=20000, help="number of sources")
+    parser.add_argument("--levels", default="none,fast,full",
+                        help="comma-separated validation levels to time")
+    args = parser.parse_args()
+
+    sourceCat, matches = makeMatches(args.numSources)
+    print("%d sources, %d matches" % (len(sourceCat), len(matches)))
+    for level in args.levels.split(","):
+        t0 = time.time()
+        ANetBasicAstrometryTask.validateMatches(matches, sourceCat, level)
+        print("%-5s %10.3f s" % (level, time.time() - t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ extern "C" {
 
 #include <memory>
 #include <string>
+#include <tuple>
 #include <utility>
 #include <vector>
 
@@ -163,6 +164,69 @@ public:
         const char* varCol,
         bool uniqueIds=true);
 
+    /**
+    Count the reference objects in a region of the sky, in each index
+
+    Only the star kd-tree of each index is searched, with a counting range query: kd-tree nodes
+    wholly inside the region are counted without visiting their stars, and no list of stars,
+    tag-along columns or records are made. Indices that share stars each count them, so the
+    number of distinct objects is at least the largest count and at most the sum.
+
+    @param[in] inds  list of star kd-trees from astrometry.net
+    @param[in] ctrCoord  center of search region
+    @param[in] radius  search radius
+    @return the number of reference objects found in each index, in the order of inds
+    */
+    std::vector<int> countStars(
+        std::vector<index_t*> inds,
+        lsst::afw::geom::SpherePoint const &ctrCoord,
+        lsst::afw::geom::Angle const &radius) const;
+
+    /**
+    Histogram the magnitudes of the reference objects in a region of the sky, in each index
+
+    Only the requested magnitude column is read from the tag-along table, for the stars found;
+    no records are made. Bins are half-open, [binEdges[i], binEdges[i+1]); magnitudes outside
+    the bins (including NaN) are not counted.
+
+    @param[in] inds  list of star kd-trees from astrometry.net
+    @param[in] ctrCoord  center of search region
+    @param[in] radius  search radius
+    @param[in] magCol  name of magnitude column in astrometry.net data
+    @param[in] binEdges  increasing magnitude bin edges; at least two
+    @return for each index, in the order of inds, the number of reference objects in each bin
+
+    @throw lsst::pex::exceptions::InvalidParameterError if binEdges are too few or not increasing
+    @throw lsst::pex::exceptions::NotFoundError if an index has no tag-along table or magnitude column
+    */
+    std::vector<std::vector<int>> getMagHistograms(
+        std::vector<index_t*> inds,
+        lsst::afw::geom::SpherePoint const &ctrCoord,
+        lsst::afw::geom::Angle const &radius,
+        std::string const& magCol,
+        std::vector<double> const& binEdges) const;
+
+    /**
+    Get the positions and magnitudes of the reference objects in a region of the sky
+
+    Only the magnitude column is read from the tag-along table; no records are made.
+    Objects are not de-duplicated between indices.
+
+    @param[in] inds  list of star kd-trees from astrometry.net
+    @param[in] ctrCoord  center of search region
+    @param[in] radius  search radius
+    @param[in] magCol  name of magnitude column in astrometry.net data; if empty then
+        the magnitudes are not read and are returned as NaN
+    @return RA (deg), Dec (deg) and magnitude of each reference object, concatenated over inds
+
+    @throw lsst::pex::exceptions::NotFoundError if an index has no tag-along table or magnitude column
+    */
+    std::tuple<std::vector<double>, std::vector<double>, std::vector<double>> getStarArrays(
+        std::vector<index_t*> inds,
+        lsst::afw::geom::SpherePoint const &ctrCoord,
+        lsst::afw::geom::Angle const &radius,
+        std::string const& magCol) const;
+
     std::shared_ptr<lsst::daf::base::PropertyList> getSolveStats() const;
 
     std::shared_ptr<lsst::afw::geom::SkyWcs> getWcs();
@@ -209,14 +273,38 @@ public:
 
     void setImageSize(int width, int height);
 
+    /**
+     * Set the maximum number of stars to use; 0 for no limit
+     *
+     * Only the brightest maxStars stars given to setStars are kept, so call this before setStars.
+     */
     void setMaxStars(int maxStars) {
+        _maxStars = maxStars;
         _solver->endobj = maxStars;
     }
 
     void setStars(lsst::afw::table::SourceCatalog const & srcs, int x0, int y0);
 
+    /**
+     * Set the stars to solve from arrays of positions and fluxes
+     *
+     * If a maximum number of stars has been set (see setMaxStars) then only that many
+     * of the brightest stars are kept.
+     *
+     * @param[in] x  x positions (pixels); an array of length n
+     * @param[in] y  y positions (pixels); an array of length n
+     * @param[in] flux  fluxes; an array of length n
+     * @param[in] n  number of stars
+     * @param[in] x0  x origin to subtract from the positions
+     * @param[in] y0  y origin to subtract from the positions
+     */
+    void setStars(double const* x, double const* y, double const* flux, std::size_t n, int x0, int y0);
+
 private:
 
+    /// Give the solver a new field of stars, which it takes ownership of
+    void _setField(starxy_t* starxy);
+
     struct _Deleter {
         void operator()(solver_t* m) {
             solver_free(m);
@@ -224,6 +312,7 @@ private:
     };
 
     std::unique_ptr<solver_t, _Deleter> _solver;
+    int _maxStars;  ///< maximum number of stars to keep in setStars; 0 for no limit
 };
 
 /**
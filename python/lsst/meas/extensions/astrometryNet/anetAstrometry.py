@@ -26,19 +26,26 @@ __all__ = ["ANetAstrometryConfig", "ANetAstrometryTask", "showAstrometry"]
 from builtins import input
 from builtins import zip
 from builtins import range
+import math
+from multiprocessing.pool import ThreadPool
+import time
 
 import numpy as np
 
 import lsstDebug
 import lsst.pex.exceptions
 import lsst.afw.geom as afwGeom
-from lsst.afw.cameraGeom import PIXELS, TAN_PIXELS
-from lsst.afw.table import Point2DKey, CovarianceMatrix2fKey, updateSourceCoords
+from lsst.afw.cameraGeom import PIXELS, FIELD_ANGLE
+from lsst.afw.table import Point2DKey, CovarianceMatrix2fKey
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 from lsst.meas.astrom import displayAstrometry
-from lsst.meas.astrom.sip import makeCreateWcsWithSip
 from .anetBasicAstrometry import ANetBasicAstrometryTask
+from .distortionCache import DistortionCache
+from .loadAstrometryNetObjects import LoadMultiIndexes
+from .matchArrays import MatchArrays
+from .sipFitter import TanSipFitter
+from .wcsUtils import setSourceCoords
 
 
 class ANetAstrometryConfig(pexConfig.Config):
@@ -55,6 +62,31 @@ class ANetAstrometryConfig(pexConfig.Config):
                                         min=0.0, inclusiveMin=False)
     rejectIter = pexConfig.RangeField(dtype=int, default=3, doc="Rejection iterations for Wcs fitting",
                                       min=0)
+    rejectScatter = pexConfig.ChoiceField(
+        dtype=str,
+        default="std",
+        doc="Estimator of the scatter of the match residuals, in units of which rejectThresh is applied",
+        allowed={
+            "std": "standard deviation",
+            "mad": "median absolute deviation, scaled to a Gaussian standard deviation",
+        },
+    )
+    distortionGridSpacing = pexConfig.RangeField(dtype=int, default=64, min=2, doc=(
+        "Spacing (pixels) of the grid on which each detector's distortion is sampled for distort()"))
+    distortionGridTolerance = pexConfig.RangeField(dtype=float, default=1e-3, min=0.0, doc=(
+        "Maximum error (pixels) of interpolating the distortion grid; if exceeded, the exact "
+        "distortion transform is used instead"))
+    numWorkers = pexConfig.RangeField(dtype=int, default=1, min=1,
+                                      doc="Number of threads used to solve the CCDs of a visit in runVisit")
+    useFocalPlaneSolve = pexConfig.Field(dtype=bool, default=False, doc=(
+        "In runVisit, first solve all CCDs together in a common focal-plane frame built from the camera "
+        "geometry (see solveFocalPlane), and only solve individually the CCDs for which that fails?"))
+    retryFromNeighbors = pexConfig.Field(dtype=bool, default=True, doc=(
+        "In runVisit, retry CCDs that failed to solve with their pointing corrected by the offset "
+        "between the input and solved WCS of the nearest CCD that did solve?"))
+    neighborSearchMargin = pexConfig.RangeField(dtype=float, default=30.0, min=0.0, doc=(
+        "Margin (arcsec) added to the search radius of a CCD retried from a neighbor's pointing, "
+        "beyond the CCD's own radius and twice the neighbor's pointing offset"))
 
     @property
     def refObjLoader(self):
@@ -170,6 +202,9 @@ class ANetAstrometryTask(pipeBase.Task):
         self.centroidErrKey = CovarianceMatrix2fKey((self.centroidXErrKey, self.centroidYErrKey))
         # postpone making the solver subtask because it may not be needed and is expensive to create
         self.solver = None
+        # kept for the lifetime of the task, so shared by all the visits it processes
+        self.distortionCache = DistortionCache(gridSpacing=self.config.distortionGridSpacing,
+                                               tolerance=self.config.distortionGridTolerance)
 
     @pipeBase.timeMethod
     def run(self, exposure, sourceCat):
@@ -198,11 +233,263 @@ class ANetAstrometryTask(pipeBase.Task):
             return self.solve(exposure=exposure, sourceCat=sourceCat)
 
     @pipeBase.timeMethod
-    def solve(self, exposure, sourceCat):
+    def runVisit(self, exposureSourceList):
+        """!Solve all the CCDs of a visit, loading the astrometry.net indexes only once
+
+        The union of the multi-indexes needed by the CCDs that have an input WCS is
+        loaded once and kept loaded while the CCDs are solved, using config.numWorkers
+        threads; a CCD without a WCS is solved blind, loading what it needs itself.
+        If config.retryFromNeighbors then CCDs that fail are retried with their RA,Dec
+        center corrected by the pointing offset of the nearest CCD that solved, and a
+        search radius tightened to match (see _getNeighborPointing).
+
+        Each solve uses its own astrometry.net solver; the threads share only the
+        pinned indexes, which the solvers read but do not modify (the solver task
+        serializes adding them to a solver, which reopens their files).
+
+        @param[in,out] exposureSourceList  list of (exposure, sourceCat) pairs, one per CCD;
+            as for run, each exposure's WCS is used as an initial guess and is updated
+        @return a list with one entry per CCD, in the order of exposureSourceList:
+            the lsst.pipe.base.Struct returned by run, or None if the CCD could not be solved
+        """
+        if self.config.forceKnownWcs:
+            return [self.run(exposure=exposure, sourceCat=sourceCat)
+                    for exposure, sourceCat in exposureSourceList]
+        if not self.solver:
+            self.makeSubtask("solver")
+
+        # Input pointing of each CCD; the exposure WCS is replaced when a CCD solves
+        commanded = [self._getCenterAndRadius(exposure) for exposure, sourceCat in exposureSourceList]
+        refObjLoader = self.solver.refObjLoader
+        refObjLoader._readIndexFiles()
+        multiInds = []
+        for center, radius in (c for c in commanded if c is not None):
+            multiInds += [mi for mi in refObjLoader._getMIndexesWithinRange(center, radius)
+                          if mi not in multiInds]
+        self.log.info("Solving %d CCDs using %d multi-indexes", len(exposureSourceList), len(multiInds))
+        numBlind = sum(c is None for c in commanded)
+        if numBlind > 0:
+            self.log.warn("%d CCDs have no WCS and will be solved blind", numBlind)
+
+        def solveCcd(args):
+            i, kwargs = args
+            exposure, sourceCat = exposureSourceList[i]
+            try:
+                return self.solve(exposure=exposure, sourceCat=sourceCat, **kwargs)
+            except (RuntimeError, lsst.pex.exceptions.Exception) as e:
+                self.log.warn("Unable to solve CCD %d: %s", i, e)
+                return None
+
+        pool = ThreadPool(self.config.numWorkers) if self.config.numWorkers > 1 else None
+        mapFunc = pool.map if pool is not None else lambda func, args: list(map(func, args))
+        try:
+            with LoadMultiIndexes(multiInds):
+                results = [None]*len(exposureSourceList)
+                if self.config.useFocalPlaneSolve:
+                    try:
+                        results = self.solveFocalPlane(exposureSourceList).ccdResults
+                    except (RuntimeError, lsst.pex.exceptions.Exception) as e:
+                        self.log.warn("Focal plane solve failed; solving CCDs individually: %s", e)
+                toSolve = [(i, {}) for i, result in enumerate(results) if result is None]
+                for (i, kwargs), result in zip(toSolve, mapFunc(solveCcd, toSolve)):
+                    results[i] = result
+
+                if self.config.retryFromNeighbors:
+                    retries = []
+                    for i, result in enumerate(results):
+                        if result is not None or commanded[i] is None:
+                            continue
+                        pointing = self._getNeighborPointing(i, commanded, results, exposureSourceList)
+                        if pointing is not None:
+                            radecCenter, searchRadius = pointing
+                            retries.append((i, dict(radecCenter=radecCenter, searchRadius=searchRadius,
+                                                    useRaDecCenter=True)))
+                    if retries:
+                        self.log.info("Retrying %d CCDs using the pointing of neighboring CCDs",
+                                      len(retries))
+                        for (i, kwargs), result in zip(retries, mapFunc(solveCcd, retries)):
+                            results[i] = result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        numSolved = sum(result is not None for result in results)
+        self.log.info("Solved %d of %d CCDs", numSolved, len(results))
+        self.metadata.set("visitNumCcds", len(results))
+        self.metadata.set("visitNumSolved", numSolved)
+        return results
+
+    @pipeBase.timeMethod
+    def solveFocalPlane(self, exposureSourceList):
+        """!Solve all the CCDs of a visit together in a common focal-plane frame
+
+        The sources of every CCD are mapped through the camera geometry to field angle
+        (which removes the known optical distortion), then scaled to "focal-plane pixels"
+        with the mean plate scale of the CCDs, and solved in a single blind solve. Each
+        CCD's WCS is that solution composed with its pixels to focal-plane pixels
+        transform, refined by matching to the reference catalog as in solve.
+
+        @param[in,out] exposureSourceList  list of (exposure, sourceCat) pairs, one per CCD;
+            each exposure must have a detector; if it has a WCS, the first one found is used
+            for the initial pointing. Exposure WCSs are updated for the CCDs that solve.
+        @return an lsst.pipe.base.Struct containing:
+        - focalPlaneWcs  TAN WCS of the focal-plane pixel frame (an lsst.afw.geom.SkyWcs)
+        - ccdResults  a list with one entry per CCD: an lsst.pipe.base.Struct as returned by run,
+            or None if the CCD could not be refined
+        @throw RuntimeError if an exposure has no detector or the joint solve fails
+        """
+        if not self.solver:
+            self.makeSubtask("solver")
+
+        pixToFieldAngleList = []
+        radPerPixelList = []
+        for exposure, sourceCat in exposureSourceList:
+            detector = exposure.getDetector()
+            if detector is None:
+                raise RuntimeError("Focal plane solve requires a detector for every exposure")
+            pixToFieldAngle = detector.getTransform(PIXELS, FIELD_ANGLE)
+            pixToFieldAngleList.append(pixToFieldAngle)
+            jacobian = np.array(pixToFieldAngle.getJacobian(afwGeom.Box2D(exposure.getBBox()).getCenter()))
+            radPerPixelList.append(math.sqrt(abs(np.linalg.det(jacobian))))
+        radPerPixel = float(np.median(radPerPixelList))
+
+        xList, yList, fluxList = [], [], []
+        fpBBox = afwGeom.Box2D()
+        radecCenter = None
+        for (exposure, sourceCat), pixToFieldAngle in zip(exposureSourceList, pixToFieldAngleList):
+            good = self.solver._getGoodSourceArrays(sourceCat)
+            if len(good.x) > 0:
+                fieldAngle = pixToFieldAngle.applyForward(np.array([good.x, good.y]))
+                xList.append(fieldAngle[0]/radPerPixel)
+                yList.append(fieldAngle[1]/radPerPixel)
+                fluxList.append(good.flux)
+            for corner in afwGeom.Box2D(exposure.getBBox()).getCorners():
+                fieldAngle = pixToFieldAngle.applyForward(corner)
+                fpBBox.include(afwGeom.Point2D(fieldAngle.getX()/radPerPixel, fieldAngle.getY()/radPerPixel))
+            if radecCenter is None and exposure.getWcs() is not None:
+                boresight = pixToFieldAngle.applyInverse(afwGeom.Point2D(0, 0))
+                radecCenter = exposure.getWcs().pixelToSky(boresight)
+        if not xList:
+            raise RuntimeError("No good sources for the focal plane solve")
+        x = np.concatenate(xList)
+        y = np.concatenate(yList)
+        flux = np.concatenate(fluxList)
+        fpBBox = afwGeom.Box2I(fpBBox)
+        pixelScale = radPerPixel*afwGeom.radians
+        self.log.info("Solving %d CCDs together: %d sources in a %d x %d focal plane frame "
+                      "at %.3f arcsec/pix",
+                      len(exposureSourceList), len(x), fpBBox.getWidth(), fpBBox.getHeight(),
+                      pixelScale.asArcseconds())
+
+        searchRadius = None
+        if radecCenter is not None:
+            searchRadius = pixelScale*math.hypot(fpBBox.getWidth(), fpBBox.getHeight())
+        solveRes = self.solver.solveArrays(x, y, flux, bbox=fpBBox, pixelScale=pixelScale,
+                                           radecCenter=radecCenter, searchRadius=searchRadius)
+        if solveRes.wcs is None:
+            raise RuntimeError("Unable to solve the focal plane")
+
+        fieldAngleToFp = afwGeom.makeTransform(
+            afwGeom.AffineTransform(afwGeom.LinearTransform.makeScaling(1.0/radPerPixel)))
+        ccdResults = []
+        for i, ((exposure, sourceCat), pixToFieldAngle) in enumerate(zip(exposureSourceList,
+                                                                         pixToFieldAngleList)):
+            ccdWcs = afwGeom.makeModifiedWcs(pixelTransform=pixToFieldAngle.then(fieldAngleToFp),
+                                             wcs=solveRes.wcs, modifyActualPixels=False)
+            try:
+                ccdResults.append(self._refineCcd(exposure=exposure, sourceCat=sourceCat, wcs=ccdWcs))
+            except (RuntimeError, lsst.pex.exceptions.Exception) as e:
+                self.log.warn("Unable to refine the focal plane solution for CCD %d: %s", i, e)
+                ccdResults.append(None)
+        return pipeBase.Struct(
+            focalPlaneWcs=solveRes.wcs,
+            ccdResults=ccdResults,
+        )
+
+    def _refineCcd(self, exposure, sourceCat, wcs):
+        """!Match a CCD to the reference catalog using a WCS derived from a focal plane solution, and refit
+
+        @param[in,out] exposure  exposure of the CCD; its WCS is updated
+        @param[in] sourceCat  catalog of sources detected on the exposure
+        @param[in] wcs  initial WCS for the CCD
+        @return an lsst.pipe.base.Struct as returned by solve
+        """
+        astrom = self.solver.useKnownWcs(sourceCat=sourceCat, wcs=wcs, exposure=exposure)
+        matches = astrom.getMatches()
+        if astrom.getWcs() is None or not matches:
+            raise RuntimeError("No astrometric matches")
+        exposure.setWcs(astrom.getWcs())
+        self.refitWcs(sourceCat=sourceCat, exposure=exposure, matches=matches)
+        return pipeBase.Struct(
+            refCat=astrom.refCat,
+            matches=matches,
+            matchMeta=astrom.getMatchMetadata(),
+        )
+
+    def _getCenterAndRadius(self, exposure):
+        """!Get the center of an exposure from its WCS, and the radius around it that a solve searches
+
+        The radius is the one ANetBasicAstrometryTask.determineWcs uses by default,
+        config.raDecSearchRadius, widened if necessary to cover the search region
+        of the solver's pointing model.
+
+        @return a tuple of the center (an afwGeom.SpherePoint) and radius (an afwGeom.Angle),
+            or None if the exposure has no WCS
+        """
+        wcs = exposure.getWcs()
+        if wcs is None:
+            return None
+        bbox = exposure.getBBox()
+        center = wcs.pixelToSky(afwGeom.Box2D(bbox).getCenter())
+        radius = self.solver.config.raDecSearchRadius*afwGeom.degrees
+        corrected = self.solver._applyPointingModel(wcs, bbox, radius)
+        if corrected is not None:
+            modelCenter, modelRadius = corrected
+            radius = max(radius, center.separation(modelCenter) + modelRadius)
+        return center, radius
+
+    def _getNeighborPointing(self, index, commanded, results, exposureSourceList):
+        """!Estimate the center of a CCD from the pointing offset of the nearest solved CCD
+
+        The search radius is the CCD's own radius (from its input WCS), plus twice the
+        neighbor's pointing offset (the offset applied may be wrong in direction, but
+        not by much more than its size), plus config.neighborSearchMargin; it is no
+        larger than the CCD's input search radius.
+
+        @param[in] index  index of the CCD in exposureSourceList
+        @param[in] commanded  list of input (center, radius), or None, for each CCD
+        @param[in] results  list of results, or None, for each CCD
+        @param[in] exposureSourceList  list of (exposure, sourceCat) for each CCD
+        @return estimated center (an afwGeom.SpherePoint) and search radius (an afwGeom.Angle),
+            or None if no CCD with an input WCS solved
+        """
+        center, commandedRadius = commanded[index]
+        neighbors = [j for j, result in enumerate(results) if result is not None and commanded[j] is not None]
+        if not neighbors:
+            return None
+        nearest = min(neighbors, key=lambda j: center.separation(commanded[j][0]))
+        nearestCenter = commanded[nearest][0]
+        nearestExposure = exposureSourceList[nearest][0]
+        solvedCenter = nearestExposure.getWcs().pixelToSky(
+            afwGeom.Box2D(nearestExposure.getBBox()).getCenter())
+        offset = nearestCenter.separation(solvedCenter)
+        if offset.asRadians() != 0:
+            center = center.offset(nearestCenter.bearingTo(solvedCenter), offset)
+
+        exposure = exposureSourceList[index][0]
+        bboxD = afwGeom.Box2D(exposure.getBBox())
+        fieldRadius = exposure.getWcs().getPixelScale(bboxD.getCenter())*math.hypot(*bboxD.getDimensions())/2
+        searchRadius = fieldRadius + 2*offset + self.config.neighborSearchMargin*afwGeom.arcseconds
+        return center, min(searchRadius, commandedRadius)
+
+    @pipeBase.timeMethod
+    def solve(self, exposure, sourceCat, **kwargs):
         r"""!Match with reference sources and calculate an astrometric solution
 
         \param[in,out] exposure Exposure to calibrate; wcs is updated
         \param[in] sourceCat catalog of measured sources (an lsst.afw.table.SourceCatalog)
+        \param[in] kwargs additional arguments for the solver's determineWcs, e.g. radecCenter
         \return a pipeBase.Struct with fields:
         - refCat  reference object catalog of objects that overlap the exposure (with some margin)
             (an lsst::afw::table::SimpleCatalog)
@@ -225,7 +512,7 @@ class ANetAstrometryTask(pipeBase.Task):
 
         \note ignores config.forceKnownWcs
         """
-        results = self._astrometry(sourceCat=sourceCat, exposure=exposure)
+        results = self._astrometry(sourceCat=sourceCat, exposure=exposure, **kwargs)
 
         if results.matches:
             self.refitWcs(sourceCat=sourceCat, exposure=exposure, matches=results.matches)
@@ -251,32 +538,19 @@ class ANetAstrometryTask(pipeBase.Task):
         \return bounding box of distorted exposure
         """
         detector = exposure.getDetector()
-        pixToTanXYTransform = None
         if detector is None:
             self.log.warn("No detector associated with exposure; assuming null distortion")
-        else:
-            pixToTanXYTransform = detector.getTransform(PIXELS, TAN_PIXELS)
-
-        if pixToTanXYTransform is None:
             self.log.info("Null distortion correction")
-            for s in sourceCat:
-                s.set(self.centroidKey, s.getCentroid())
-                s.set(self.centroidErrKey, s.getCentroidErr())
-                s.set(self.centroidFlagKey, s.getCentroidFlag())
+            self._setDistortedCentroids(sourceCat, lambda x, y: (x, y))
             return exposure.getBBox()
 
         # Distort source positions
         self.log.info("Applying distortion correction")
-        for s in sourceCat:
-            centroid = pixToTanXYTransform.forwardTransform(s.getCentroid())
-            s.set(self.centroidKey, centroid)
-            s.set(self.centroidErrKey, s.getCentroidErr())
-            s.set(self.centroidFlagKey, s.getCentroidFlag())
+        distortion = self.distortionCache.get(detector)
+        self._setDistortedCentroids(sourceCat, distortion.apply)
 
         # Get distorted image size so that astrometry_net does not clip.
-        bboxD = afwGeom.Box2D()
-        for corner in detector.getCorners(TAN_PIXELS):
-            bboxD.include(corner)
+        bboxD = afwGeom.Box2D(distortion.tanBBox)
 
         if lsstDebug.Info(__name__).display:
             frame = lsstDebug.Info(__name__).frame
@@ -286,6 +560,37 @@ class ANetAstrometryTask(pipeBase.Task):
 
         return afwGeom.Box2I(bboxD)
 
+    def _setDistortedCentroids(self, sourceCat, distort):
+        """!Set the distorted centroid, centroid error and centroid flag columns of a catalog
+
+        @param[in,out] sourceCat  SourceCatalog; the centroid slot is read and the distorted columns set
+        @param[in] distort  function taking numpy arrays of x and y positions and returning
+            the distorted x and y positions
+        """
+        if not sourceCat.isContiguous():
+            # Column views require contiguous memory, so fall back to setting each record
+            tanX, tanY = distort(np.array([s.getX() for s in sourceCat]),
+                                 np.array([s.getY() for s in sourceCat]))
+            for s, x, y in zip(sourceCat, tanX, tanY):
+                s.set(self.centroidKey, afwGeom.Point2D(x, y))
+                s.set(self.centroidErrKey, s.getCentroidErr())
+                s.set(self.centroidFlagKey, s.getCentroidFlag())
+            return
+
+        tanX, tanY = distort(sourceCat.getX(), sourceCat.getY())
+        sourceCat[self.centroidXKey][:] = tanX
+        sourceCat[self.centroidYKey][:] = tanY
+        for errKey, name in ((self.centroidXErrKey, "slot_Centroid_xErr"),
+                             (self.centroidYErrKey, "slot_Centroid_yErr")):
+            try:
+                sourceCat[errKey][:] = sourceCat[name]
+            except (KeyError, lsst.pex.exceptions.Exception):
+                sourceCat[errKey][:] = np.nan
+        flags = np.asarray(sourceCat["slot_Centroid_flag"], dtype=bool)
+        # Flag columns cannot be written through a view, so only touch records whose flag changes
+        for i in np.flatnonzero(sourceCat[self.centroidFlagKey] != flags):
+            sourceCat[int(i)].set(self.centroidFlagKey, bool(flags[i]))
+
     @pipeBase.timeMethod
     def loadAndMatch(self, exposure, sourceCat, bbox=None):
         """!Load reference objects overlapping an exposure and match to sources detected on that exposure
@@ -334,12 +639,13 @@ class ANetAstrometryTask(pipeBase.Task):
         )
 
     @pipeBase.timeMethod
-    def _astrometry(self, sourceCat, exposure, bbox=None):
+    def _astrometry(self, sourceCat, exposure, bbox=None, **kwargs):
         r"""!Solve astrometry to produce WCS
 
         \param[in] sourceCat Sources on exposure, an lsst.afw.table.SourceCatalog
         \param[in,out] exposure Exposure to process, an lsst.afw.image.ExposureF or D; wcs is updated
         \param[in] bbox Bounding box, or None to use exposure
+        \param[in] kwargs additional arguments for the solver's determineWcs, e.g. radecCenter
         \return a pipe.base.Struct with fields:
         - refCat  reference object catalog of objects that overlap the exposure (with some margin)
             (an lsst::afw::table::SimpleCatalog)
@@ -353,7 +659,7 @@ class ANetAstrometryTask(pipeBase.Task):
         if not self.solver:
             self.makeSubtask("solver")
 
-        astrom = self.solver.determineWcs(sourceCat=sourceCat, exposure=exposure, bbox=bbox)
+        astrom = self.solver.determineWcs(sourceCat=sourceCat, exposure=exposure, bbox=bbox, **kwargs)
 
         if astrom is None or astrom.getWcs() is None:
             raise RuntimeError("Unable to solve astrometry")
@@ -390,11 +696,20 @@ class ANetAstrometryTask(pipeBase.Task):
         @param matches Astrometric matches, as a list of lsst.afw.table.ReferenceMatch
 
         @return the resolved-Wcs object, or None if config.solver.calculateSip is False.
+
+        The task metadata records the fit time, rejection time and number of matches
+        kept in each rejection iteration (as arrays "refitWcsFitTime", "refitWcsRejectTime"
+        and "refitWcsNumMatches") and the time of the final fit ("refitWcsFinalFitTime").
+        Each call sets these entries, replacing the values of the previous call, so the
+        metadata does not grow when one task solves many exposures (e.g. in runVisit).
         """
         sip = None
         if self.config.solver.calculateSip:
             self.log.info("Refitting WCS")
+            if not self.solver:
+                self.makeSubtask("solver")
             origMatches = matches
+            matchArrays = MatchArrays.fromReferenceMatches(matches)
             wcs = exposure.getWcs()
 
             import lsstDebug
@@ -402,46 +717,64 @@ class ANetAstrometryTask(pipeBase.Task):
             frame = lsstDebug.Info(__name__).frame
             pause = lsstDebug.Info(__name__).pause
 
+            fitter = None
+            if self.config.solver.sipFitter == "numpy":
+                fitter = TanSipFitter(matchArrays.srcX, matchArrays.srcY, wcs.getPixelOrigin(),
+                                      self.config.solver.sipOrder)
+
             def fitWcs(initialWcs, title=None):
                 """!Do the WCS fitting and display of the results"""
-                sip = makeCreateWcsWithSip(matches, initialWcs, self.config.solver.sipOrder)
-                resultWcs = sip.getNewWcs()
+                fit = self.solver.fitSipWcs(matchArrays, initialWcs, fitter=fitter)
                 if display:
-                    showAstrometry(exposure, resultWcs, origMatches, matches, frame=frame,
-                                   title=title, pause=pause)
-                return resultWcs, sip.getScatterOnSky()
+                    showAstrometry(exposure, fit.wcs, origMatches, matchArrays.toReferenceMatches(),
+                                   frame=frame, title=title, pause=pause)
+                return fit.wcs, fit.scatterOnSky
 
             numRejected = 0
+            scatter = None
+            iterationStats = dict(refitWcsFitTime=[], refitWcsRejectTime=[], refitWcsNumMatches=[])
             try:
                 for i in range(self.config.rejectIter):
+                    t0 = time.time()
                     wcs, scatter = fitWcs(wcs, title="Iteration %d" % i)
-
-                    ref = np.array([wcs.skyToPixel(m.first.getCoord()) for m in matches])
-                    src = np.array([m.second.getCentroid() for m in matches])
-                    diff = ref - src
-                    rms = diff.std()
-                    trimmed = []
-                    for d, m in zip(diff, matches):
-                        if np.all(np.abs(d) < self.config.rejectThresh*rms):
-                            trimmed.append(m)
-                        else:
-                            numRejected += 1
-                    if len(matches) == len(trimmed):
+                    t1 = time.time()
+
+                    refX, refY = matchArrays.getRefPixels(wcs)
+                    diff = np.array([refX - matchArrays.srcX, refY - matchArrays.srcY])
+                    rms = self._getScatter(diff)
+                    good = np.all(np.abs(diff) < self.config.rejectThresh*rms, axis=0)
+                    numGood = int(good.sum())
+                    if numGood < len(good):
+                        numRejected += len(good) - numGood
+                        matchArrays = matchArrays.subset(good)
+                    iterationStats["refitWcsFitTime"].append(t1 - t0)
+                    iterationStats["refitWcsRejectTime"].append(time.time() - t1)
+                    iterationStats["refitWcsNumMatches"].append(numGood)
+                    if numGood == len(good):
                         break
-                    matches = trimmed
 
                 # Final fit after rejection iterations
+                t0 = time.time()
                 wcs, scatter = fitWcs(wcs, title="Final astrometry")
+                self.metadata.set("refitWcsFinalFitTime", time.time() - t0)
 
-            except lsst.pex.exceptions.LengthError as e:
+            except (lsst.pex.exceptions.LengthError, lsst.pex.exceptions.RuntimeError) as e:
                 self.log.warn("Unable to fit SIP: %s", e)
 
-            self.log.info("Astrometric scatter: %f arcsec (%d matches, %d rejected)",
-                          scatter.asArcseconds(), len(matches), numRejected)
+            for name, values in iterationStats.items():
+                if values:
+                    self.metadata.set(name, values)
+                elif self.metadata.exists(name):
+                    self.metadata.remove(name)
+
+            matches = matchArrays.toReferenceMatches()
+            if scatter is not None:
+                self.log.info("Astrometric scatter: %f arcsec (%d matches, %d rejected)",
+                              scatter.asArcseconds(), len(matches), numRejected)
             exposure.setWcs(wcs)
 
             # Apply WCS to sources
-            updateSourceCoords(wcs, sourceCat)
+            setSourceCoords(wcs, sourceCat)
         else:
             self.log.warn("Not calculating a SIP solution; matches may be suspect")
 
@@ -452,6 +785,15 @@ class ANetAstrometryTask(pipeBase.Task):
 
         return sip
 
+    def _getScatter(self, diff):
+        """!Estimate the scatter of match residuals, according to config.rejectScatter
+
+        @param[in] diff  residuals (pixels); a numpy array
+        """
+        if self.config.rejectScatter == "mad":
+            return 1.4826*np.median(np.abs(diff - np.median(diff)))
+        return diff.std()
+
 
 def showAstrometry(exposure, wcs, allMatches, useMatches, frame=0, title=None, pause=False):
     r"""!Show results of astrometry fitting
@@ -31,21 +31,32 @@ from builtins import range
 from builtins import object
 import math
 import sys
+import threading
+import time
 
 import numpy as np
 
 import lsst.daf.base as dafBase
-from lsst.pex.config import Field, RangeField, ListField
+from lsst.pex.config import Field, RangeField, ListField, ChoiceField
 import lsst.pex.exceptions as pexExceptions
 import lsst.pipe.base as pipeBase
 import lsst.afw.geom as afwGeom
-import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.afw.table as afwTable
 import lsst.meas.algorithms.utils as maUtils
 from .loadAstrometryNetObjects import LoadAstrometryNetObjectsTask, LoadMultiIndexes
 from lsst.meas.astrom import displayAstrometry, makeMatchStatisticsInRadians
 import lsst.meas.astrom.sip as astromSip
+from .astrometry_net import healpixDistance
+from .indexHitStats import IndexHitStats
+from .matchArrays import MatchArrays
+from .pointingModel import PointingModel
+from .sipFitter import TanSipFitter, fitTanSip
+from .sipWarmStart import SipWarmStartCache
+from .skyMatcher import SkyMatcher
+from .solveCache import SolveCache
+from .sourceThinning import selectBrightestPerCell
+from .wcsUtils import pixelToSkyArrays, skyToPixelArrays, setSourceCoords
 from . import cleanBadPoints
 
 
@@ -176,6 +187,12 @@ class ANetBasicAstrometryConfig(LoadAstrometryNetObjectsTask.ConfigClass):
         default=3.0,
         min=0.0,
     )
+    cleaningUseY = Field(
+        doc="In cleanBadPoints.py, clip matches jointly on their X and Y residuals, rather than "
+        "on their X residuals alone?",
+        dtype=bool,
+        default=False,
+    )
     calculateSip = Field(
         doc="Compute polynomial SIP distortion terms?",
         dtype=bool,
@@ -187,6 +204,16 @@ class ANetBasicAstrometryConfig(LoadAstrometryNetObjectsTask.ConfigClass):
         default=4,
         min=2,
     )
+    sipFitter = ChoiceField(
+        doc="Engine used to fit TAN-SIP WCSs",
+        dtype=str,
+        default="meas_astrom",
+        allowed={
+            "meas_astrom": "lsst.meas.astrom.sip.makeCreateWcsWithSip",
+            "numpy": "the linear least-squares fitter in sipFitter.py, which builds its design matrix "
+                     "once per set of sources",
+        },
+    )
     badFlags = ListField(
         doc="List of flags which cause a source to be rejected as bad",
         dtype=str,
@@ -218,6 +245,125 @@ class ANetBasicAstrometryConfig(LoadAstrometryNetObjectsTask.ConfigClass):
         default=2,
         min=0,
     )
+    doSpatialThinning = Field(
+        doc="Before solving, divide the image into a grid of thinningNumCells x thinningNumCells cells "
+        "and keep only the brightest thinningNumPerCell sources in each, so that the stars given to "
+        "Astrometry.net cover the image uniformly? Note that at most maxStars of these are used.",
+        dtype=bool,
+        default=False,
+    )
+    thinningNumCells = RangeField(
+        doc="Number of cells along each axis of the image for spatial thinning",
+        dtype=int,
+        default=4,
+        min=1,
+    )
+    thinningNumPerCell = RangeField(
+        doc="Maximum number of sources kept in each cell for spatial thinning",
+        dtype=int,
+        default=3,
+        min=1,
+    )
+    useHierarchicalSolve = Field(
+        doc="When no RA,Dec center is available, first solve against only the coarsest-scale indexes "
+        "to get a rough pointing, then refine using only the indexes around that pointing?",
+        dtype=bool,
+        default=False,
+    )
+    doVerifyPrior = Field(
+        doc="Before blind solving, test whether the input WCS already matches the reference catalog "
+        "(a log-odds test against matchThreshold) and if so skip the blind solve?",
+        dtype=bool,
+        default=False,
+    )
+    verifyPriorRadius = RangeField(
+        doc="Matching radius (arcsec) for verifying the input WCS",
+        dtype=float,
+        default=2.0,
+        min=0.0,
+        inclusiveMin=False,
+    )
+    verifyPriorDistractorFraction = RangeField(
+        doc="Assumed fraction of sources with no reference counterpart when verifying the input WCS",
+        dtype=float,
+        default=0.25,
+        min=0.0,
+        max=1.0,
+        inclusiveMin=False,
+        inclusiveMax=False,
+    )
+    pointingModelFile = Field(
+        doc="JSON file holding a model of the telescope pointing error, updated from each successful "
+        "solve and used to correct the RA,Dec center from the input WCS and to shrink the search "
+        "radius; None to disable",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    pointingModelTelescope = Field(
+        doc="Name of the telescope whose pointing model is to be used",
+        dtype=str,
+        default="default",
+    )
+    pointingModelMinUpdates = RangeField(
+        doc="Minimum number of solves contributing to the pointing model before it is used",
+        dtype=int,
+        default=3,
+        min=1,
+    )
+    pointingModelMinSigma = RangeField(
+        doc="Minimum pointing model scatter (arcsec) used for the search radius, so that a model "
+        "fit to a few consistent solves does not shrink the search to the field alone",
+        dtype=float,
+        default=5.0,
+        min=0.0,
+    )
+    pointingModelNumSigma = RangeField(
+        doc="Search radius around the corrected center, in units of the pointing model scatter, "
+        "in addition to the field radius",
+        dtype=float,
+        default=5.0,
+        min=0.0,
+    )
+    orderIndexes = Field(
+        doc="Give indexes to the solver in order of expected success (distance from the RA,Dec "
+        "center, then historical hit rate, then match of quad scale to the image) rather than "
+        "in the order in which they are configured?",
+        dtype=bool,
+        default=False,
+    )
+    indexHitStatsFile = Field(
+        doc="JSON file recording how often each index provides the solution, used when ordering "
+        "indexes; None to order by geometry alone",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    solveCacheDir = Field(
+        doc="Directory for a persistent cache of Astrometry.net solutions, keyed on the stars given to "
+        "the solver, the solve parameters and the index files; None to disable the cache",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
+    validationLevel = ChoiceField(
+        doc="Consistency checks of the match lists made by useKnownWcs",
+        dtype=str,
+        default="fast",
+        allowed={
+            "none": "no checks",
+            "fast": "check that every matched source is in the source catalog, by ID, using a set",
+            "full": "also check that every matched source record is in the source catalog; "
+                    "this is quadratic in the catalog size, so is for debugging only",
+        },
+    )
+    sipWarmStartFile = Field(
+        doc="JSON file holding the last good SIP distortion of each detector and filter, used to start "
+        "SIP fitting from a better WCS than the TAN solution; None to disable",
+        dtype=str,
+        default=None,
+        optional=True,
+    )
 
 
 class ANetBasicAstrometryTask(pipeBase.Task):
@@ -279,6 +425,26 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             name="loadAN",
         )
         self.refObjLoader._readIndexFiles()
+        self.solveCache = None
+        if self.config.solveCacheDir is not None:
+            self.solveCache = SolveCache(self.config.solveCacheDir)
+        self.indexHitStats = None
+        if self.config.indexHitStatsFile is not None:
+            self.indexHitStats = IndexHitStats(self.config.indexHitStatsFile,
+                                               self.refObjLoader.multiInds.getIdentity())
+        self.pointingModel = None
+        if self.config.pointingModelFile is not None:
+            self.pointingModel = PointingModel(self.config.pointingModelFile,
+                                               self.config.pointingModelTelescope)
+        self.sipWarmStartCache = None
+        if self.config.sipWarmStartFile is not None:
+            self.sipWarmStartCache = SipWarmStartCache(self.config.sipWarmStartFile)
+        # Statistics for the verify-prior fast path and the SIP warm start, for task metadata
+        self._verifyPriorStats = dict(attempts=0, hits=0, verifyTime=0.0, numBlind=0, blindTime=0.0)
+        self._sipWarmStartStats = dict(hits=0, misses=0, iterationsSaved=0)
+        # Guards the persisted statistics and models above, and the shared indexes while they are
+        # added to a solver, when solving in several threads
+        self._lock = threading.Lock()
 
     def memusage(self, prefix=''):
         # Not logging at DEBUG: do nothing
@@ -371,42 +537,76 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         catids = [src.getId() for src in refCat]
         uids = set(catids)
         self.log.debug('%i reference sources; %i unique IDs', len(catids), len(uids))
-        matches = self._getMatchList(sourceCat, refCat, wcs)
-        uniq = set([sm.second.getId() for sm in matches])
-        if len(matches) != len(uniq):
+        matcher = self._makeMatcher(refCat, wcs, bbox)
+        srcX, srcY = self._getCentroidArrays(sourceCat)
+        matches = self._getMatchArrays(sourceCat, refCat, wcs, matcher, srcX, srcY)
+        numUnique = len(np.unique(matches.srcIndex))
+        if len(matches) != numUnique:
             self.log.warn('The list of matched stars contains duplicate reference source IDs '
-                          '(%i sources, %i unique ids)', len(matches), len(uniq))
+                          '(%i sources, %i unique ids)', len(matches), numUnique)
         if len(matches) == 0:
             self.log.warn('No matches found between input sources and reference catalogue.')
             return astrom
 
         self.log.debug('%i reference objects match input sources using input WCS', len(matches))
-        astrom.tanMatches = matches
+        astrom.tanMatches = matches.toReferenceMatches()
         astrom.tanWcs = wcs
-
-        srcids = [s.getId() for s in sourceCat]
-        for m in matches:
-            assert(m.second.getId() in srcids)
-            assert(m.second in sourceCat)
+        self.validateMatches(astrom.tanMatches, sourceCat, self.config.validationLevel)
 
         if calculateSip:
-            sipwcs, matches = self._calculateSipTerms(wcs, refCat, sourceCat, matches, bbox=bbox)
-            if sipwcs == wcs:
+            detectorName = self._getDetectorName(exposure)
+            startWcs, startMatches = wcs, matches
+            seedWcs = self._getSipSeedWcs(detectorName, filterName, wcs)
+            if seedWcs is not None:
+                seedMatches = self._getMatchArrays(sourceCat, refCat, seedWcs, matcher, srcX, srcY)
+                if len(seedMatches) >= len(matches):
+                    startWcs, startMatches = seedWcs, seedMatches
+                else:
+                    self.log.debug('Not using the cached SIP distortion: %i matches, vs %i with the TAN WCS',
+                                   len(seedMatches), len(matches))
+            warm = startWcs is not wcs
+            sipwcs, matches, numIterations = self._calculateSipTerms(startWcs, refCat, sourceCat,
+                                                                     startMatches, bbox=bbox,
+                                                                     matcher=matcher)
+            if sipwcs is startWcs:
                 self.log.debug('Failed to find a SIP WCS better than the initial one.')
             else:
                 self.log.debug('%i reference objects match input sources using SIP WCS',
                                len(matches))
                 astrom.sipWcs = sipwcs
-                astrom.sipMatches = matches
+                astrom.sipMatches = matches.toReferenceMatches()
+                self.validateMatches(astrom.sipMatches, sourceCat, self.config.validationLevel)
+            self._updateSipWarmStart(detectorName, filterName, seedWcs is not None, warm,
+                                     sipwcs if sipwcs is not startWcs else None, numIterations)
 
         wcs = astrom.getWcs()
-        # _getMatchList() modifies the source list RA,Dec coordinates.
-        # Here, we make them consistent with the WCS we are returning.
-        for src in sourceCat:
-            src.updateCoord(wcs)
+        # Make the source list RA,Dec coordinates consistent with the WCS we are returning.
+        setSourceCoords(wcs, sourceCat)
         astrom.matchMeta = _createMetadata(bbox, wcs, filterName)
         return astrom
 
+    @staticmethod
+    def validateMatches(matches, sourceCat, level):
+        """!Check that the sources of a match list are in a source catalog
+
+        @param[in] matches  list of lsst.afw.table.ReferenceMatch
+        @param[in] sourceCat  source catalog
+        @param[in] level  "none", "fast" or "full"; see ANetBasicAstrometryConfig.validationLevel
+
+        @throw RuntimeError if a check fails
+        """
+        if level == "none":
+            return
+        srcIds = set(src.getId() for src in sourceCat)
+        for m in matches:
+            if m.second.getId() not in srcIds:
+                raise RuntimeError("Matched source %d is not in the source catalog" % (m.second.getId(),))
+        if level == "full":
+            for m in matches:
+                if m.second not in sourceCat:
+                    raise RuntimeError("Matched source record %d is not in the source catalog" %
+                                       (m.second.getId(),))
+
     def determineWcs(self, sourceCat, exposure, **kwargs):
         """Find a WCS solution for the given 'sourceCat' in the given
         'exposure', getting other parameters from config.
@@ -426,7 +626,12 @@ class ANetBasicAstrometryTask(pipeBase.Task):
 
         'searchRadius', in degrees, to search for a solution around
            the given 'radecCenter'; default from config option
-           'raDecSearchRadius'.
+           'raDecSearchRadius'.  If neither 'radecCenter' nor
+           'searchRadius' is given and the pointing model is enabled,
+           the center from the exposure's WCS is corrected by the model
+           and the default radius is reduced to what the model needs;
+           if that solve fails, it is retried once around the
+           uncorrected center with the default radius.
 
         'useParity': parity is the 'flip' of the image.  Knowing it
            reduces the search space (hence time) for Astrometry.net.
@@ -455,8 +660,6 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         assert(exposure is not None)
 
         margs = kwargs.copy()
-        if 'searchRadius' not in margs:
-            margs.update(searchRadius=self.config.raDecSearchRadius * afwGeom.degrees)
         if 'usePixelScale' not in margs:
             margs.update(usePixelScale=self.config.useWcsPixelScale)
         if 'useRaDecCenter' not in margs:
@@ -464,7 +667,27 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         if 'useParity' not in margs:
             margs.update(useParity=self.config.useWcsParity)
         margs.update(exposure=exposure)
-        return self.determineWcs2(sourceCat=sourceCat, **margs)
+        fallbackArgs = None
+        if 'searchRadius' not in margs:
+            margs.update(searchRadius=self.config.raDecSearchRadius * afwGeom.degrees)
+            if margs.get('radecCenter') is None and margs['useRaDecCenter']:
+                bbox, wcs, _ = self._getImageParams(exposure=exposure, bbox=margs.get('bbox'),
+                                                    wcs=margs.get('wcs'), filterName=margs.get('filterName'),
+                                                    wcsRequired=False)
+                if wcs is not None:
+                    corrected = self._applyPointingModel(wcs, bbox, margs['searchRadius'])
+                    if corrected is not None:
+                        fallbackArgs = margs.copy()
+                        margs.update(radecCenter=corrected[0], searchRadius=corrected[1])
+        if fallbackArgs is None:
+            return self.determineWcs2(sourceCat=sourceCat, **margs)
+        try:
+            return self.determineWcs2(sourceCat=sourceCat, **margs)
+        except RuntimeError as e:
+            # The pointing model may be stale; it is only corrected by solves that succeed
+            self.log.warn('Solve around the pointing model center failed (%s); retrying around the '
+                          'input WCS center within %.3f deg', e, fallbackArgs['searchRadius'].asDegrees())
+            return self.determineWcs2(sourceCat=sourceCat, **fallbackArgs)
 
     def determineWcs2(self, sourceCat, **kwargs):
         """Get a blind astrometric solution for the given catalog of sources.
@@ -526,17 +749,22 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         bboxD = afwGeom.Box2D(bbox)
         xc, yc = bboxD.getCenter()
         parity = None
+        commandedCenter = None
+        uncorrected = None  # RA,Dec center and search radius to retry with if the pointing model fails
 
         if wcs is not None:
+            commandedCenter = wcs.pixelToSky(xc, yc)
             if pixelScale is None:
                 if usePixelScale:
                     pixelScale = wcs.getPixelScale()
                     self.log.debug('Setting pixel scale estimate = %.3f from given WCS estimate',
                                    pixelScale.asArcseconds())
 
+            usePointingModel = radecCenter is None and searchRadius is None
+
             if radecCenter is None:
                 if useRaDecCenter:
-                    radecCenter = wcs.pixelToSky(xc, yc)
+                    radecCenter = commandedCenter
                     self.log.debug('Setting RA,Dec center estimate = (%.3f, %.3f) from given WCS '
                                    'estimate, using pixel center = (%.1f, %.1f)',
                                    radecCenter.getLongitude().asDegrees(),
@@ -549,7 +777,14 @@ class ANetBasicAstrometryTask(pipeBase.Task):
                     searchRadius = (pixelScale * pixRadius * searchRadiusScale)
                     self.log.debug('Using RA,Dec search radius = %.3f deg, from pixel scale, '
                                    'image size, and searchRadiusScale = %g',
-                                   searchRadius, searchRadiusScale)
+                                   searchRadius.asDegrees(), searchRadiusScale)
+
+            if usePointingModel and useRaDecCenter:
+                corrected = self._applyPointingModel(wcs, bbox, searchRadius)
+                if corrected is not None:
+                    uncorrected = (radecCenter, max(searchRadius,
+                                                    self.config.raDecSearchRadius * afwGeom.degrees))
+                    radecCenter, searchRadius = corrected
             if useParity:
                 parity = wcs.isFlipped
                 self.log.debug('Using parity = %s' % (parity and 'True' or 'False'))
@@ -563,9 +798,45 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             sourceCat = self._trimBadPoints(sourceCat, exposureBBoxD)
             self.log.debug("Trimming: kept %i of %i sources", n, len(sourceCat))
 
+        if wcs is not None and self.config.doVerifyPrior:
+            qa = self._verifyPrior(sourceCat, wcs=wcs, bbox=bbox, filterName=filterName)
+            if qa is not None:
+                # The accepted WCS is the input WCS, so it says nothing about the pointing error
+                # and must not update the pointing model
+                return wcs, qa
+
+        t0 = time.time()
+        coarseWcs = None
+        if radecCenter is None and self.config.useHierarchicalSolve:
+            # Get a rough pointing from the (few, usually all-sky) coarsest indexes,
+            # so that the refinement need only load the fine indexes around it.
+            coarseWcs, coarseQa = self._solve(
+                sourceCat=sourceCat,
+                wcs=wcs,
+                bbox=bbox,
+                pixelScale=pixelScale,
+                radecCenter=None,
+                searchRadius=None,
+                parity=parity,
+                filterName=filterName,
+                coarseOnly=True,
+            )
+            if coarseWcs is None:
+                self.log.warn('Coarse solve failed; falling back to a full blind solve')
+            else:
+                radecCenter = coarseWcs.pixelToSky(xc, yc)
+                pixRadius = math.hypot(*bboxD.getDimensions()) / 2
+                searchRadius = coarseWcs.getPixelScale() * pixRadius * searchRadiusScale
+                if pixelScale is None and usePixelScale:
+                    pixelScale = coarseWcs.getPixelScale()
+                self.log.debug('Coarse solve gives RA,Dec center = (%.3f, %.3f); refining within %.3f deg',
+                               radecCenter.getLongitude().asDegrees(),
+                               radecCenter.getLatitude().asDegrees(), searchRadius.asDegrees())
+
+        initialWcs = wcs
         wcs, qa = self._solve(
             sourceCat=sourceCat,
-            wcs=wcs,
+            wcs=initialWcs,
             bbox=bbox,
             pixelScale=pixelScale,
             radecCenter=radecCenter,
@@ -573,6 +844,27 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             parity=parity,
             filterName=filterName,
         )
+        if wcs is None and coarseWcs is not None:
+            self.log.warn('Refinement solve failed; using the coarse solution')
+            wcs, qa = coarseWcs, coarseQa
+        if wcs is None and uncorrected is not None:
+            # The pointing model may be stale; it is only corrected by solves that succeed
+            radecCenter, searchRadius = uncorrected
+            self.log.warn('Solve around the pointing model center failed; retrying around the '
+                          'input WCS center within %.3f deg', searchRadius.asDegrees())
+            wcs, qa = self._solve(
+                sourceCat=sourceCat,
+                wcs=initialWcs,
+                bbox=bbox,
+                pixelScale=pixelScale,
+                radecCenter=radecCenter,
+                searchRadius=searchRadius,
+                parity=parity,
+                filterName=filterName,
+            )
+        with self._lock:
+            self._verifyPriorStats["numBlind"] += 1
+            self._verifyPriorStats["blindTime"] += time.time() - t0
         if wcs is None:
             raise RuntimeError("Unable to match sources with catalog.")
         self.log.info('Got astrometric solution from Astrometry.net')
@@ -580,9 +872,128 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         rdc = wcs.pixelToSky(xc, yc)
         self.log.debug('New WCS says image center pixel (%.1f, %.1f) -> RA,Dec (%.3f, %.3f)',
                        xc, yc, rdc.getLongitude().asDegrees(), rdc.getLatitude().asDegrees())
+        self._updatePointingModel(commandedCenter, rdc)
         return wcs, qa
 
-    def getSipWcsFromWcs(self, wcs, bbox, ngrid=20, linearizeAtCenter=True):
+    def _applyPointingModel(self, wcs, bbox, searchRadius):
+        """!Correct the field center of an input WCS with the pointing model, if it is ready
+
+        @param[in] wcs  input WCS
+        @param[in] bbox  bounding box of image (an afwGeom.Box2I)
+        @param[in] searchRadius  search radius that would otherwise be used (an afwGeom.Angle)
+        @return the corrected field center (an afwGeom.SpherePoint) and the search radius,
+            no larger than searchRadius, that the model needs (an afwGeom.Angle);
+            or None if the pointing model is disabled or has too few updates
+        """
+        if self.pointingModel is None:
+            return None
+        bboxD = afwGeom.Box2D(bbox)
+        with self._lock:
+            if self.pointingModel.getNumUpdates() < self.config.pointingModelMinUpdates:
+                return None
+            radecCenter = self.pointingModel.correct(wcs.pixelToSky(bboxD.getCenter()))
+            uncertainty = max(self.pointingModel.getUncertainty(),
+                              self.config.pointingModelMinSigma * afwGeom.arcseconds)
+        pixRadius = math.hypot(*bboxD.getDimensions()) / 2
+        modelRadius = wcs.getPixelScale() * pixRadius + self.config.pointingModelNumSigma * uncertainty
+        searchRadius = min(searchRadius, modelRadius)
+        self.log.debug('Pointing model corrects RA,Dec center to (%.3f, %.3f); '
+                       'using search radius = %.3f deg',
+                       radecCenter.getLongitude().asDegrees(),
+                       radecCenter.getLatitude().asDegrees(), searchRadius.asDegrees())
+        return radecCenter, searchRadius
+
+    def _updatePointingModel(self, commandedCenter, solvedCenter):
+        """!Update and persist the pointing model, if enabled, with the result of a solve
+
+        @param[in] commandedCenter  field center according to the input WCS
+            (an afwGeom.SpherePoint), or None if there was no input WCS
+        @param[in] solvedCenter  field center according to the solution (an afwGeom.SpherePoint)
+        """
+        if self.pointingModel is None or commandedCenter is None:
+            return
+        with self._lock:
+            self.pointingModel.update(commandedCenter, solvedCenter)
+            self.pointingModel.write()
+
+    def _verifyPrior(self, sourceCat, wcs, bbox, filterName):
+        """!Test whether an input WCS already matches the reference catalog
+
+        The brightest config.maxStars good sources are matched (within
+        config.verifyPriorRadius) to the reference objects projected with the
+        input WCS, and the log-odds that the WCS is correct rather than
+        random is computed in the same spirit as astrometry.net's
+        verification: each matched source contributes
+        log((1 - d + d*q)/q) and each unmatched source contributes log(d),
+        where d is config.verifyPriorDistractorFraction and q is the
+        probability of a chance match given the reference object density.
+
+        Hit statistics are recorded in the task metadata.
+
+        @param[in] sourceCat  catalog of sources detected on the image
+        @param[in] wcs  input WCS to verify
+        @param[in] bbox  bounding box of image (an afwGeom.Box2I)
+        @param[in] filterName  filter name, or None
+        @return solve statistics (an lsst.daf.base.PropertyList) if the WCS
+            verifies with log-odds of at least config.matchThreshold, else None
+        """
+        t0 = time.time()
+        good = self._getGoodSourceArrays(sourceCat)
+        order = np.argsort(-good.flux)[:self.config.maxStars]
+        srcX = good.x[order]
+        srcY = good.y[order]
+
+        refCat = self.refObjLoader.loadPixelBox(bbox=bbox, wcs=wcs, filterName=filterName, calib=None).refCat
+        if not refCat.isContiguous():
+            refCat = refCat.copy(deep=True)
+        refX = refCat["centroid_x"]
+        refY = refCat["centroid_y"]
+
+        logodds = -np.inf
+        numMatched = 0
+        if len(srcX) > 0 and len(refX) > 0:
+            radius = self.config.verifyPriorRadius/wcs.getPixelScale().asArcseconds()
+            dist2 = (srcX[:, np.newaxis] - refX[np.newaxis, :])**2 + \
+                (srcY[:, np.newaxis] - refY[np.newaxis, :])**2
+            matched = dist2.min(axis=1) < radius**2
+            numMatched = int(matched.sum())
+            area = afwGeom.Box2D(bbox).getArea()
+            chance = min(len(refX)*math.pi*radius**2/area, 1.0 - 1e-6)
+            distractor = self.config.verifyPriorDistractorFraction
+            logodds = numMatched*math.log((1.0 - distractor + distractor*chance)/chance) + \
+                (len(srcX) - numMatched)*math.log(distractor)
+
+        elapsed = time.time() - t0
+        verified = logodds >= self.config.matchThreshold
+        self.log.info("Verifying input WCS: %d of %d sources match %d reference objects; "
+                      "log-odds = %.1f (threshold %.1f): %s", numMatched, len(srcX), len(refX),
+                      logodds, self.config.matchThreshold, "accepted" if verified else "rejected")
+
+        with self._lock:
+            stats = self._verifyPriorStats
+            stats["attempts"] += 1
+            stats["verifyTime"] += elapsed
+            if verified:
+                stats["hits"] += 1
+            # Time saved is estimated from the blind solves done so far by this task
+            meanBlindTime = stats["blindTime"]/stats["numBlind"] if stats["numBlind"] > 0 else 0.0
+            self.metadata.set("verifyPriorAttempts", stats["attempts"])
+            self.metadata.set("verifyPriorHits", stats["hits"])
+            self.metadata.set("verifyPriorHitRate", stats["hits"]/stats["attempts"])
+            self.metadata.set("verifyPriorTime", stats["verifyTime"])
+            self.metadata.set("verifyPriorTimeSaved", stats["hits"]*meanBlindTime - stats["verifyTime"])
+
+        if not verified:
+            return None
+        qa = dafBase.PropertyList()
+        qa.set("meas_astrom*verify_prior*logodds", float(logodds))
+        qa.set("meas_astrom*verify_prior*nmatch", numMatched)
+        qa.set("meas_astrom*verify_prior*nfield", len(srcX))
+        qa.set("meas_astrom*verify_prior*nindex", len(refX))
+        qa.set("meas_astrom*verify_prior*time_used", elapsed)
+        return qa
+
+    def getSipWcsFromWcs(self, wcs, bbox, ngrid=20, linearizeAtCenter=True, maxResidual=None, maxGrid=50):
         """!Get a TAN-SIP WCS, starting from an existing WCS.
 
         It uses your WCS to compute a fake grid of corresponding "stars" in pixel and sky coords,
@@ -590,48 +1001,77 @@ class ANetBasicAstrometryTask(pipeBase.Task):
 
         @param[in] wcs  initial WCS
         @param[in] bbox  bounding box of image
-        @param[in] ngrid  number of grid points along x and y for fitting (fit at ngrid^2 points)
+        @param[in] ngrid  number of grid points along x and y for fitting (fit at ngrid^2 points);
+          if maxResidual is set, the initial number
         @param[in] linearizeAtCenter  if True, get a linear approximation of the input
           WCS at the image center and use that as the TAN initialization for
           the TAN-SIP solution.  You probably want this if your WCS has its
           CRPIX outside the image bounding box.
+        @param[in] maxResidual  if not None, choose the grid density adaptively: the grid is
+          refined (roughly doubling ngrid, up to maxGrid) until the fit reproduces the input WCS
+          to within this many pixels at the centers of the grid cells
+        @param[in] maxGrid  maximum number of grid points along x and y when maxResidual is set
         """
-        # Ugh, build src and ref tables
-        srcSchema = afwTable.SourceTable.makeMinimalSchema()
-        key = srcSchema.addField("centroid", type="PointD")
-        srcTable = afwTable.SourceTable.make(srcSchema)
-        srcTable.defineCentroid("centroid")
-        srcs = srcTable
-        refs = afwTable.SimpleTable.make(afwTable.SimpleTable.makeMinimalSchema())
-        cref = []
-        csrc = []
-        (W, H) = bbox.getDimensions()
-        x0, y0 = bbox.getMin()
-        for xx in np.linspace(0., W, ngrid):
-            for yy in np.linspace(0, H, ngrid):
-                src = srcs.makeRecord()
-                src.set(key.getX(), x0 + xx)
-                src.set(key.getY(), y0 + yy)
-                csrc.append(src)
-                rd = wcs.pixelToSky(xx + x0, yy + y0)
-                ref = refs.makeRecord()
-                ref.setCoord(rd)
-                cref.append(ref)
-
         if linearizeAtCenter:
             # Linearize the original WCS around the image center to create a
             # TAN WCS.
-            # Reference pixel in LSST coords
             crpix = afwGeom.Box2D(bbox).getCenter()
-            crval = wcs.pixelToSky(crpix)
-            crval = crval.getPosition(afwGeom.degrees)
-            # Linearize *AT* crval to get effective CD at crval.
-            # (we use the default skyUnit of degrees as per WCS standard)
-            aff = wcs.linearizePixelToSky(crval)
-            cd = aff.getLinear().getMatrix()
-            wcs = afwImage.Wcs(crval, crpix, cd)
+            initialWcs = afwGeom.makeSkyWcs(crpix=crpix, crval=wcs.pixelToSky(crpix),
+                                            cdMatrix=wcs.getCdMatrix(crpix))
+        else:
+            initialWcs = wcs
+
+        while True:
+            gridX, gridY, cellX, cellY = self._makePixelGrid(bbox, ngrid)
+            ra, dec = pixelToSkyArrays(wcs, gridX, gridY)
+            matches = self._makeGridMatches(gridX, gridY, ra, dec)
+            sipWcs = self.fitSipWcs(matches, initialWcs, bbox).wcs
+            if maxResidual is None or ngrid >= maxGrid:
+                return sipWcs
+            # Check the fit between the grid points
+            fitX, fitY = skyToPixelArrays(sipWcs, *pixelToSkyArrays(wcs, cellX, cellY))
+            residual = np.max(np.hypot(fitX - cellX, fitY - cellY))
+            self.log.debug("getSipWcsFromWcs: max residual %g pixels with a %dx%d grid",
+                           residual, ngrid, ngrid)
+            if residual <= maxResidual:
+                return sipWcs
+            ngrid = min(2*ngrid - 1, maxGrid)
+
+    @staticmethod
+    def _makePixelGrid(bbox, ngrid):
+        """!Return the points of an ngrid x ngrid grid spanning bbox, and the centers of its cells
+
+        @return x and y of the grid points, and x and y of the cell centers, as flattened numpy arrays
+        """
+        (W, H) = bbox.getDimensions()
+        x0, y0 = bbox.getMin()
+        xGrid = x0 + np.linspace(0., W, ngrid)
+        yGrid = y0 + np.linspace(0., H, ngrid)
+        gridX, gridY = np.meshgrid(xGrid, yGrid)
+        cellX, cellY = np.meshgrid(0.5*(xGrid[1:] + xGrid[:-1]), 0.5*(yGrid[1:] + yGrid[:-1]))
+        return gridX.ravel(), gridY.ravel(), cellX.ravel(), cellY.ravel()
 
-        return self.getSipWcsFromCorrespondences(wcs, cref, csrc, (W, H), x0=x0, y0=y0)
+    @staticmethod
+    def _makeGridMatches(x, y, ra, dec):
+        """!Make a MatchArrays of perfect correspondences between pixel and sky positions
+
+        The records are filled by column, for fitters that need ReferenceMatch objects.
+        """
+        num = len(x)
+        srcSchema = afwTable.SourceTable.makeMinimalSchema()
+        afwTable.Point2DKey.addFields(srcSchema, "centroid", "centroid", "pixel")
+        srcSchema.getAliasMap().set("slot_Centroid", "centroid")
+        srcCat = afwTable.SourceCatalog(srcSchema)
+        refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+        for cat in (srcCat, refCat):
+            cat.reserve(num)
+            cat.resize(num)
+        srcCat["centroid_x"][:] = x
+        srcCat["centroid_y"][:] = y
+        refCat["coord_ra"][:] = ra
+        refCat["coord_dec"][:] = dec
+        indices = np.arange(num)
+        return MatchArrays(refCat, srcCat, indices, indices, np.zeros(num), ra, dec, x, y)
 
     def getSipWcsFromCorrespondences(self, origWcs, refCat, sourceCat, bbox):
         """Produce a SIP solution given a list of known correspondences.
@@ -647,15 +1087,48 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         @param[in] sourceCat  source catalog
         @param[in] bbox  bounding box of image
         """
-        sipOrder = self.config.sipOrder
         matches = []
         for ci, si in zip(refCat, sourceCat):
             matches.append(afwTable.ReferenceMatch(ci, si, 0.))
 
-        sipObject = astromSip.makeCreateWcsWithSip(matches, origWcs, sipOrder, bbox)
-        return sipObject.getNewWcs()
+        return self.fitSipWcs(matches, origWcs, bbox).wcs
+
+    def fitSipWcs(self, matches, wcs, bbox=None, fitter=None):
+        """!Fit a TAN-SIP WCS to matches, using the engine chosen by config.sipFitter
 
-    def _calculateSipTerms(self, origWcs, refCat, sourceCat, matches, bbox):
+        @param[in] matches  matches; a MatchArrays or a list of lsst.afw.table.ReferenceMatch
+        @param[in] wcs  initial WCS, whose CRVAL is kept; CRPIX is shifted to absorb the zero point
+        @param[in] bbox  bounding box of image, over which the reverse SIP terms are fit;
+            None for the bounding box of the matched sources
+        @param[in] fitter  a TanSipFitter over the sources indexed by matches.srcIndex, to reuse
+            its design matrix; ignored unless config.sipFitter is "numpy"
+
+        @return an lsst.pipe.base.Struct containing:
+        - wcs  the TAN-SIP WCS
+        - scatterOnSky  scatter of the fit on the sky (an afwGeom.Angle)
+
+        @throw lsst.pex.exceptions.Exception if the fit fails
+        """
+        sipOrder = self.config.sipOrder
+        if self.config.sipFitter == "numpy":
+            if not isinstance(matches, MatchArrays):
+                matches = MatchArrays.fromReferenceMatches(matches)
+            if fitter is None:
+                return fitTanSip(matches, wcs, sipOrder, bbox=bbox)
+            return fitter.fit(matches.refRa, matches.refDec, wcs.getSkyOrigin(), rows=matches.srcIndex,
+                              bbox=bbox)
+
+        if isinstance(matches, MatchArrays):
+            matches = matches.toReferenceMatches()
+        if bbox is None:
+            bbox = afwGeom.Box2I()
+        sipObject = astromSip.makeCreateWcsWithSip(matches, wcs, sipOrder, bbox)
+        return pipeBase.Struct(
+            wcs=sipObject.getNewWcs(),
+            scatterOnSky=sipObject.getScatterOnSky(),
+        )
+
+    def _calculateSipTerms(self, origWcs, refCat, sourceCat, matches, bbox, matcher=None):
         """!Iteratively calculate SIP distortions and regenerate matches based on improved WCS.
 
         @param[in] origWcs  original WCS object, probably (but not necessarily) a TAN WCS;
@@ -664,33 +1137,41 @@ class ANetBasicAstrometryTask(pipeBase.Task):
            can be found.
         @param[in] refCat  reference source catalog
         @param[in] sourceCat  sources in the image to be solved
-        @param[in] matches  list of supposedly matched sources, using the "origWcs".
+        @param[in] matches  supposedly matched sources, using the "origWcs"; a MatchArrays
+            or a list of lsst.afw.table.ReferenceMatch
         @param[in] bbox  bounding box of image, which is used when finding reverse SIP coefficients.
+        @param[in] matcher  SkyMatcher over refCat, or None to make one; it is reused for every iteration
+
+        @return the WCS, its matches (as a MatchArrays) and the number of SIP fits made
         """
-        sipOrder = self.config.sipOrder
         wcs = origWcs
+        if matcher is None:
+            matcher = self._makeMatcher(refCat, wcs, bbox)
+        if not isinstance(matches, MatchArrays):
+            matches = MatchArrays.fromReferenceMatches(matches)
+        srcX, srcY = self._getCentroidArrays(sourceCat)
+        fitter = None
+        if self.config.sipFitter == "numpy" and matches.srcRecords is sourceCat:
+            # One design matrix for all sources; each iteration selects the matched rows
+            fitter = TanSipFitter(srcX, srcY, origWcs.getPixelOrigin(), self.config.sipOrder)
 
         lastMatchSize = len(matches)
         lastMatchStats = self._computeMatchStatsOnSky(wcs=wcs, matchList=matches)
+        numIterations = 0
         for i in range(self.config.maxIter):
             # fit SIP terms
+            numIterations += 1
             try:
-                sipObject = astromSip.makeCreateWcsWithSip(matches, wcs, sipOrder, bbox)
-                proposedWcs = sipObject.getNewWcs()
+                proposedWcs = self.fitSipWcs(matches, wcs, bbox, fitter=fitter).wcs
                 self.plotSolution(matches, proposedWcs, bbox.getDimensions())
             except pexExceptions.Exception as e:
                 self.log.warn('Failed to calculate distortion terms. Error: ', str(e))
                 break
 
-            # update the source catalog
-            for source in sourceCat:
-                skyPos = proposedWcs.pixelToSky(source.getCentroid())
-                source.setCoord(skyPos)
-
-            # use new WCS to get new matchlist.
-            proposedMatchlist = self._getMatchList(sourceCat, refCat, proposedWcs)
-            proposedMatchSize = len(proposedMatchlist)
-            proposedMatchStats = self._computeMatchStatsOnSky(wcs=proposedWcs, matchList=proposedMatchlist)
+            # use new WCS to get new matches; only the source positions are re-projected
+            proposedMatches = self._getMatchArrays(sourceCat, refCat, proposedWcs, matcher, srcX, srcY)
+            proposedMatchSize = len(proposedMatches)
+            proposedMatchStats = self._computeMatchStatsOnSky(wcs=proposedWcs, matchList=proposedMatches)
 
             self.log.debug(
                 "SIP iteration %i: %i objects match, previous = %i;" %
@@ -710,16 +1191,61 @@ class ANetBasicAstrometryTask(pipeBase.Task):
                 break
 
             wcs = proposedWcs
-            matches = proposedMatchlist
+            matches = proposedMatches
             lastMatchSize = proposedMatchSize
             lastMatchStats = proposedMatchStats
 
-        return wcs, matches
+        return wcs, matches, numIterations
+
+    @staticmethod
+    def _getDetectorName(exposure):
+        """!Return the name of the detector of an exposure, or None if unknown"""
+        if exposure is None or exposure.getDetector() is None:
+            return None
+        return exposure.getDetector().getName()
+
+    def _getSipSeedWcs(self, detectorName, filterName, tanWcs):
+        """!Return a TAN-SIP WCS from the cached distortion of a detector and filter, or None
+
+        See config.sipWarmStartFile.
+        """
+        if self.sipWarmStartCache is None or detectorName is None:
+            return None
+        with self._lock:
+            return self.sipWarmStartCache.makeSeedWcs(detectorName, filterName, tanWcs)
+
+    def _updateSipWarmStart(self, detectorName, filterName, hit, warm, sipWcs, numIterations):
+        """!Update the SIP warm-start cache and its statistics after fitting SIP terms
+
+        @param[in] detectorName  name of the detector, or None if unknown
+        @param[in] filterName  name of the filter
+        @param[in] hit  was there a cached distortion for the detector and filter?
+        @param[in] warm  was fitting started from the cached distortion?
+        @param[in] sipWcs  the fitted WCS, or None if no better WCS was found
+        @param[in] numIterations  number of SIP fits made
+        """
+        if self.sipWarmStartCache is None or detectorName is None:
+            return
+        with self._lock:
+            stats = self._sipWarmStartStats
+            if hit:
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+            if warm:
+                coldIterations = self.sipWarmStartCache.getColdIterations(detectorName, filterName)
+                stats["iterationsSaved"] += max(0, coldIterations - numIterations)
+            if sipWcs is not None and \
+                    self.sipWarmStartCache.update(detectorName, filterName, sipWcs, numIterations, warm):
+                self.sipWarmStartCache.write()
+            self.metadata.set("sipWarmStartHits", stats["hits"])
+            self.metadata.set("sipWarmStartMisses", stats["misses"])
+            self.metadata.set("sipWarmStartIterationsSaved", stats["iterationsSaved"])
 
     def plotSolution(self, matches, wcs, imageSize):
         """Plot the solution, when debugging is turned on.
 
-        @param matches   The list of matches
+        @param matches   The matches; a MatchArrays or a list of lsst.afw.table.ReferenceMatch
         @param wcs         The Wcs
         @param imageSize   2-tuple with the image size (W,H)
         """
@@ -741,17 +1267,12 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         except Exception:                                 # protect against API changes
             pass
 
-        num = len(matches)
-        x = np.zeros(num)
-        y = np.zeros(num)
-        dx = np.zeros(num)
-        dy = np.zeros(num)
-        for i, m in enumerate(matches):
-            x[i] = m.second.getX()
-            y[i] = m.second.getY()
-            pixel = wcs.skyToPixel(m.first.getCoord())
-            dx[i] = x[i] - pixel.getX()
-            dy[i] = y[i] - pixel.getY()
+        if not isinstance(matches, MatchArrays):
+            matches = MatchArrays.fromReferenceMatches(matches)
+        x, y = matches.srcX, matches.srcY
+        refX, refY = matches.getRefPixels(wcs)
+        dx = x - refX
+        dy = y - refY
 
         subplots = maUtils.makeSubplots(fig, 2, 2, xgutter=0.1, ygutter=0.1, pygutter=0.04)
 
@@ -798,8 +1319,8 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         """Compute on-sky radial distance statistics for a match list
 
         @param[in] wcs  WCS for match list; an lsst.afw.image.Wcs
-        @param[in] matchList  list of matches between reference object and sources;
-            a list of lsst.afw.table.ReferenceMatch;
+        @param[in] matchList  matches between reference object and sources;
+            a MatchArrays or a list of lsst.afw.table.ReferenceMatch;
             the source centroid and reference object coord are read
 
         @return a pipe_base Struct containing these fields:
@@ -807,8 +1328,12 @@ class ANetBasicAstrometryTask(pipeBase.Task):
         - distStdDev  clipped standard deviation of on-sky radial separation
         - maxMatchDist  distMean + self.config.matchDistanceSigma*distStdDev
         """
-        distStatsInRadians = makeMatchStatisticsInRadians(wcs, matchList,
-                                                          afwMath.MEANCLIP | afwMath.STDEVCLIP)
+        if isinstance(matchList, MatchArrays):
+            distStatsInRadians = afwMath.makeStatistics(matchList.getSeparations(wcs),
+                                                        afwMath.MEANCLIP | afwMath.STDEVCLIP)
+        else:
+            distStatsInRadians = makeMatchStatisticsInRadians(wcs, matchList,
+                                                              afwMath.MEANCLIP | afwMath.STDEVCLIP)
         distMean = distStatsInRadians.getValue(afwMath.MEANCLIP)*afwGeom.radians
         distStdDev = distStatsInRadians.getValue(afwMath.STDEVCLIP)*afwGeom.radians
         return pipeBase.Struct(
@@ -817,36 +1342,60 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             maxMatchDist=distMean + self.config.matchDistanceSigma*distStdDev,
         )
 
-    def _getMatchList(self, sourceCat, refCat, wcs):
-        dist = self.config.catalogMatchDist * afwGeom.arcseconds
-        clean = self.config.cleaningParameter
-        matcher = astromSip.MatchSrcToCatalogue(refCat, sourceCat, wcs, dist)
-        matches = matcher.getMatches()
-        if matches is None:
-            # Produce debugging stats...
-            X = [src.getX() for src in sourceCat]
-            Y = [src.getY() for src in sourceCat]
-            R1 = [src.getRa().asDegrees() for src in sourceCat]
-            D1 = [src.getDec().asDegrees() for src in sourceCat]
-            R2 = [src.getRa().asDegrees() for src in refCat]
-            D2 = [src.getDec().asDegrees() for src in refCat]
-            # for src in sourceCat:
-            #     self.log.debug("source: x,y (%.1f, %.1f), RA,Dec (%.3f, %.3f)" %
-            #                    (src.getX(), src.getY(), src.getRa().asDegrees(), src.getDec().asDegrees()))
-            # for src in refCat:
-            #     self.log.debug("ref: RA,Dec (%.3f, %.3f)" %
-            #                    (src.getRa().asDegrees(), src.getDec().asDegrees()))
-            self.loginfo('_getMatchList: %i sources, %i reference sources' % (len(sourceCat), len(refCat)))
-            if len(sourceCat):
-                self.loginfo(
-                    'Source range: x [%.1f, %.1f], y [%.1f, %.1f], RA [%.3f, %.3f], Dec [%.3f, %.3f]' %
-                    (min(X), max(X), min(Y), max(Y), min(R1), max(R1), min(D1), max(D1)))
-            if len(refCat):
-                self.loginfo('Reference range: RA [%.3f, %.3f], Dec [%.3f, %.3f]' %
-                             (min(R2), max(R2), min(D2), max(D2)))
-            raise RuntimeError('No matches found between image and catalogue')
-        matches = cleanBadPoints.clean(matches, wcs, nsigma=clean)
-        return matches
+    def _makeMatcher(self, refCat, wcs, bbox):
+        """!Make a SkyMatcher over a reference catalog, for matching with _getMatchList
+
+        @param[in] refCat  reference object catalog
+        @param[in] wcs  WCS used to find the center of the field
+        @param[in] bbox  bounding box of image
+        """
+        center = wcs.pixelToSky(afwGeom.Box2D(bbox).getCenter())
+        return SkyMatcher.fromCatalog(refCat, center=center,
+                                      radius=self.config.catalogMatchDist*afwGeom.arcseconds)
+
+    def _getMatchList(self, sourceCat, refCat, wcs, matcher=None):
+        """!Match sources to reference objects using a WCS, and clean outliers from the matches
+
+        @param[in] sourceCat  sources in the image
+        @param[in] refCat  reference object catalog
+        @param[in] wcs  WCS mapping source centroids to the sky
+        @param[in] matcher  SkyMatcher over refCat (see _makeMatcher), or None to make one
+        @return a list of afwTable.ReferenceMatch
+        """
+        if matcher is None:
+            matcher = SkyMatcher.fromCatalog(refCat, center=wcs.getSkyOrigin(),
+                                             radius=self.config.catalogMatchDist*afwGeom.arcseconds)
+        srcX, srcY = self._getCentroidArrays(sourceCat)
+        return self._getMatchArrays(sourceCat, refCat, wcs, matcher, srcX, srcY).toReferenceMatches()
+
+    def _getMatchArrays(self, sourceCat, refCat, wcs, matcher, srcX, srcY):
+        """!Match sources to reference objects using a WCS, and clean outliers from the matches
+
+        @param[in] sourceCat  sources in the image
+        @param[in] refCat  reference object catalog
+        @param[in] wcs  WCS mapping source centroids to the sky
+        @param[in] matcher  SkyMatcher over refCat (see _makeMatcher)
+        @param[in] srcX, srcY  source centroids, as numpy arrays (see _getCentroidArrays)
+        @return a MatchArrays
+        """
+        found = matcher.matchPixels(srcX, srcY, wcs)
+        matches = MatchArrays(refCat, sourceCat, found.refIndex, found.srcIndex, found.distance,
+                              refRa=matcher.refRa[found.refIndex], refDec=matcher.refDec[found.refIndex],
+                              srcX=srcX[found.srcIndex], srcY=srcY[found.srcIndex])
+        if len(matches) == 0:
+            self.log.debug('_getMatchArrays: no matches between %i sources and %i reference objects',
+                           len(sourceCat), len(refCat))
+            return matches
+        return cleanBadPoints.clean(matches, wcs, nsigma=self.config.cleaningParameter,
+                                    useY=self.config.cleaningUseY)
+
+    @staticmethod
+    def _getCentroidArrays(sourceCat):
+        """!Return the source centroids as x and y numpy arrays"""
+        if sourceCat.isContiguous():
+            return np.array(sourceCat.getX(), dtype=float), np.array(sourceCat.getY(), dtype=float)
+        xy = np.array([(src.getX(), src.getY()) for src in sourceCat], dtype=float).reshape(-1, 2)
+        return xy[:, 0], xy[:, 1]
 
     def getColumnName(self, filterName, columnMap, default=None):
         """
@@ -865,35 +1414,85 @@ class ANetBasicAstrometryTask(pipeBase.Task):
                           (filterName, default))
             return default
 
-    def _solve(self, sourceCat, wcs, bbox, pixelScale, radecCenter, searchRadius, parity, filterName=None):
+    def solveArrays(self, x, y, flux, bbox, pixelScale=None, radecCenter=None, searchRadius=None,
+                    parity=None):
+        """!Blind-solve for a TAN WCS from arrays of source positions and fluxes
+
+        This is the same solve as getBlindWcsSolution, without the need to put the
+        sources in a SourceCatalog; sources with non-finite x, y or flux are ignored.
+
+        @param[in] x  x positions of the sources (pixels); array-like
+        @param[in] y  y positions of the sources (pixels); array-like
+        @param[in] flux  fluxes of the sources, used to pick the brightest; array-like
+        @param[in] bbox  bounding box of the image (an afwGeom.Box2I)
+        @param[in] pixelScale  estimated pixel scale (an afwGeom.Angle), or None if unknown
+        @param[in] radecCenter  estimated ICRS RA,Dec of the field center (an afwGeom.SpherePoint),
+            or None if unknown
+        @param[in] searchRadius  radius about radecCenter to search (an afwGeom.Angle);
+            if None then use config.raDecSearchRadius
+        @param[in] parity  True for flipped parity, False for normal parity, None to try both
+        @return an lsst.pipe.base.Struct containing:
+        - wcs  the TAN WCS (an lsst.afw.geom.SkyWcs), or None if the solve failed
+        - solveQa  solve statistics (an lsst.daf.base.PropertyList)
+        """
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        flux = np.ascontiguousarray(flux, dtype=np.float64)
+        if not (x.shape == y.shape == flux.shape):
+            raise RuntimeError("x, y and flux must have the same shape")
+        good = np.isfinite(x) & np.isfinite(y) & np.isfinite(flux)
+        if not good.all():
+            x, y, flux = x[good], y[good], flux[good]
+        if radecCenter is not None and searchRadius is None:
+            searchRadius = self.config.raDecSearchRadius*afwGeom.degrees
+        wcs, qa = self._solveArrays(x, y, flux, bbox=bbox, pixelScale=pixelScale, radecCenter=radecCenter,
+                                    searchRadius=searchRadius, parity=parity)
+        return pipeBase.Struct(wcs=wcs, solveQa=qa)
+
+    def _solve(self, sourceCat, wcs, bbox, pixelScale, radecCenter, searchRadius, parity, filterName=None,
+               coarseOnly=False):
         """
         @param[in] parity  True for flipped parity, False for normal parity, None to leave parity unchanged
+        @param[in] coarseOnly  if True then only use the coarsest-scale indexes that overlap the
+            quad size range (see _getIndexesToLoad)
+        """
+        good = self._getGoodSourceArrays(sourceCat)
+        numGood = len(good.x)
+        self.log.info("Number of selected sources for astrometry : %d" % (numGood,))
+        if numGood < len(sourceCat):
+            self.log.debug('Keeping %i of %i sources with finite X,Y positions and PSF flux',
+                           numGood, len(sourceCat))
+        return self._solveArrays(good.x, good.y, good.flux, bbox=bbox, pixelScale=pixelScale,
+                                 radecCenter=radecCenter, searchRadius=searchRadius, parity=parity,
+                                 filterName=filterName, coarseOnly=coarseOnly, wcs=wcs)
+
+    def _solveArrays(self, x, y, flux, bbox, pixelScale, radecCenter, searchRadius, parity, filterName=None,
+                     coarseOnly=False, wcs=None):
+        """!Run the solver on contiguous float64 arrays of good source positions and fluxes
+
+        @param[in] wcs  initial WCS, used only for debug display; may be None
+        @return these items:
+        - wcs  the TAN WCS, or None if the solve failed
+        - qa  solve statistics (an lsst.daf.base.PropertyList)
         """
         solver = self.refObjLoader._getSolver()
 
         imageSize = bbox.getDimensions()
         x0, y0 = bbox.getMin()
 
-        # select sources with valid x, y, flux
-        xybb = afwGeom.Box2D()
-        goodsources = afwTable.SourceCatalog(sourceCat.table)
-        badkeys = [goodsources.getSchema().find(name).key for name in self.config.badFlags]
-
-        for s in sourceCat:
-            if np.isfinite(s.getX()) and np.isfinite(s.getY()) and np.isfinite(s.getPsfInstFlux()) \
-                    and self._isGoodSource(s, badkeys):
-                goodsources.append(s)
-                xybb.include(afwGeom.Point2D(s.getX() - x0, s.getY() - y0))
-        self.log.info("Number of selected sources for astrometry : %d" % (len(goodsources)))
-        if len(goodsources) < len(sourceCat):
-            self.log.debug('Keeping %i of %i sources with finite X,Y positions and PSF flux',
-                           len(goodsources), len(sourceCat))
-        self.log.debug('Feeding sources in range x=[%.1f, %.1f], y=[%.1f, %.1f] ' +
-                       '(after subtracting x0,y0 = %.1f,%.1f) to Astrometry.net',
-                       xybb.getMinX(), xybb.getMaxX(), xybb.getMinY(), xybb.getMaxY(), x0, y0)
-        # setStars sorts them by PSF flux.
-        solver.setStars(goodsources, x0, y0)
+        if self.config.doSpatialThinning:
+            keep = selectBrightestPerCell(x, y, flux, bbox, numCells=self.config.thinningNumCells,
+                                          numPerCell=self.config.thinningNumPerCell)
+            self.log.debug('Spatial thinning kept %d of %d sources', len(keep), len(x))
+            x, y, flux = x[keep], y[keep], flux[keep]
+
+        if len(x) > 0:
+            self.log.debug('Feeding sources in range x=[%.1f, %.1f], y=[%.1f, %.1f] ' +
+                           '(after subtracting x0,y0 = %.1f,%.1f) to Astrometry.net',
+                           x.min() - x0, x.max() - x0, y.min() - y0, y.max() - y0, x0, y0)
+        # setStars keeps the brightest maxStars, so setMaxStars must come first
         solver.setMaxStars(self.config.maxStars)
+        solver.setStars(x, y, flux, x0, y0)
         solver.setImageSize(*imageSize)
         solver.setMatchThreshold(self.config.matchThreshold)
         raDecRadius = None
@@ -918,32 +1517,47 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             solver.setParity(parity)
             self.log.debug('Searching for match with parity = %s', str(parity))
 
+        cacheKey = None
+        if self.solveCache is not None:
+            cacheKey = SolveCache.makeKey(
+                x=x,
+                y=y,
+                flux=flux,
+                bbox=bbox,
+                pixelScale=pixelScale,
+                radecCenter=radecCenter,
+                searchRadius=searchRadius,
+                parity=parity,
+                indexIdentity=self.refObjLoader.multiInds.getIdentity(),
+                extra=(self.config.maxStars, self.config.matchThreshold,
+                       self.config.pixelScaleUncertainty, coarseOnly),
+            )
+            cached = self.solveCache.get(cacheKey, self.refObjLoader.multiInds.getFingerprint())
+            if cached is not None:
+                self.log.info('Using cached astrometric solution')
+                return cached
+
         # Find and load index files within RA,Dec range and scale range.
         if radecCenter is not None:
             multiInds = self.refObjLoader._getMIndexesWithinRange(radecCenter, searchRadius)
         else:
             multiInds = self.refObjLoader.multiInds
         qlo, qhi = solver.getQuadSizeRangeArcsec()
-
-        toload_multiInds = set()
-        toload_inds = []
-        for mi in multiInds:
-            for i in range(len(mi)):
-                ind = mi[i]
-                if not ind.overlapsScaleRange(qlo, qhi):
-                    continue
-                toload_multiInds.add(mi)
-                toload_inds.append(ind)
+        toload_multiInds, toload_inds = self._getIndexesToLoad(multiInds, qlo, qhi, coarseOnly=coarseOnly,
+                                                               radecCenter=radecCenter)
 
         import lsstDebug
-        if lsstDebug.Info(__name__).display:
+        if lsstDebug.Info(__name__).display and wcs is not None:
             # Use separate context for display, since astrometry.net can segfault if we don't...
             with LoadMultiIndexes(toload_multiInds):
                 displayAstrometry(refCat=self.refObjLoader.loadPixelBox(bbox, wcs, filterName).refCat,
                                   frame=lsstDebug.Info(__name__).frame, pause=lsstDebug.Info(__name__).pause)
 
         with LoadMultiIndexes(toload_multiInds):
-            solver.addIndices(toload_inds)
+            # Adding the indexes reopens (and then closes) their files, which may be shared with
+            # solves in other threads; the solve itself only reads them
+            with self._lock:
+                solver.addIndices(toload_inds)
             self.memusage('Index files loaded: ')
 
             cpulimit = self.config.maxCpuTime
@@ -960,44 +1574,140 @@ class ANetBasicAstrometryTask(pipeBase.Task):
             if x0 != 0 or y0 != 0:
                 wcs = wcs.copyAtShiftedPixelOrigin(afwGeom.Extent2D(x0, y0))
 
+            if cacheKey is not None:
+                self.solveCache.put(cacheKey, self.refObjLoader.multiInds.getFingerprint(), wcs,
+                                    solver.getSolveStats())
+
         else:
             self.log.warn('Did not get an astrometric solution from Astrometry.net')
             wcs = None
             # Gather debugging info...
 
             # -are there any reference stars in the proposed search area?
-            # log the number found and discard the results
+            # count them without loading a catalog
             if radecCenter is not None:
-                self.refObjLoader.loadSkyCircle(radecCenter, searchRadius, filterName)
+                countRes = self.refObjLoader.countSkyCircle(radecCenter, searchRadius)
+                self.log.info('Found about %d reference objects within %.3f deg of the search center '
+                              '(counts in each of %d indices: %s)', countRes.numStars,
+                              searchRadius.asDegrees(), len(countRes.counts), list(countRes.counts))
 
         qa = solver.getSolveStats()
         self.log.debug('qa: %s', qa.toString())
+
+        if self.indexHitStats is not None:
+            bestId = qa.get("meas_astrom*an*best_index*id") if wcs is not None else None
+            with self._lock:
+                self.indexHitStats.update([ind.indexid for ind in toload_inds], bestId)
+                self.indexHitStats.write()
         return wcs, qa
 
-    def _isGoodSource(self, candsource, keys):
-        for k in keys:
-            if candsource.get(k):
-                return False
-        return True
+    def _getIndexesToLoad(self, multiInds, qlo, qhi, coarseOnly=False, radecCenter=None):
+        """!Select the indexes to give to the solver
+
+        If config.orderIndexes is set, the indexes are ordered by increasing
+        distance of their healpix from radecCenter, then by decreasing
+        historical hit rate (if config.indexHitStatsFile is set), then by
+        increasing mismatch (in log scale) between the middle of their quad
+        scale range and the middle of [qlo, qhi]; otherwise they are given
+        in the order in which they are configured.
+
+        @param[in] multiInds  candidate multi-indexes (MultiIndexCache objects)
+        @param[in] qlo  minimum quad size (arcsec)
+        @param[in] qhi  maximum quad size (arcsec)
+        @param[in] coarseOnly  if True then only keep the indexes with the largest
+            quad scale of those that overlap [qlo, qhi]
+        @param[in] radecCenter  RA,Dec center estimate (an afwGeom.SpherePoint), or None
+        @return these items:
+        - toload_multiInds  set of multi-indexes that must be loaded
+        - toload_inds  list of indexes (index_t) to add to the solver
+        """
+        # Select using the scale ranges known to the cache, so that only the chosen
+        # multi-indexes are loaded (by indexing them) below
+        selected = []
+        for mi in multiInds:
+            for i, (lower, upper) in enumerate(mi.getScaleRanges()):
+                # index_overlaps_scale_range
+                if qlo > upper or qhi < lower:
+                    continue
+                selected.append((mi, i, upper))
+
+        if coarseOnly and selected:
+            maxScale = max(upper for mi, i, upper in selected)
+            selected = [(mi, i, upper) for mi, i, upper in selected if upper >= maxScale]
+            self.log.debug('Using %d coarse indexes with quad scale up to %g arcsec',
+                           len(selected), maxScale)
+        candidates = [(mi, mi[i]) for mi, i, upper in selected]
+
+        if self.config.orderIndexes and candidates:
+            logQuadScale = 0.5*math.log(qlo*qhi)
+
+            def sortKey(candidate):
+                ind = candidate[1]
+                hitRate = 0.0 if self.indexHitStats is None else self.indexHitStats.getHitRate(ind.indexid)
+                distance = 0.0
+                if radecCenter is not None and ind.healpix >= 0:
+                    distance = healpixDistance(ind.healpix, ind.hpnside, radecCenter).asDegrees()
+                indexScale = max(ind.index_scale_lower, 1e-3)*ind.index_scale_upper
+                scaleMismatch = abs(0.5*math.log(indexScale) - logQuadScale)
+                return (distance, -hitRate, scaleMismatch)
+
+            candidates.sort(key=sortKey)
+
+        toload_multiInds = set(mi for mi, ind in candidates)
+        toload_inds = [ind for mi, ind in candidates]
+        return toload_multiInds, toload_inds
+
+    def _getGoodSourceMask(self, sourceCat):
+        """!Get a mask of sources with finite x, y and PSF flux and none of config.badFlags set
+
+        @param[in] sourceCat  contiguous catalog of sources (an lsst.afw.table.SourceCatalog)
+        @return boolean array, True for good sources
+        """
+        good = np.isfinite(sourceCat.getX()) & np.isfinite(sourceCat.getY()) & \
+            np.isfinite(sourceCat.getPsfInstFlux())
+        for name in self.config.badFlags:
+            good &= np.logical_not(sourceCat[name])
+        return good
+
+    def _getGoodSourceArrays(self, sourceCat):
+        """!Get positions and PSF fluxes of the sources selected by _getGoodSourceMask
+
+        @param[in] sourceCat  catalog of sources (an lsst.afw.table.SourceCatalog)
+        @return an lsst.pipe.base.Struct containing contiguous float64 arrays x, y and flux
+        """
+        if not sourceCat.isContiguous():
+            sourceCat = sourceCat.copy(deep=True)
+        good = self._getGoodSourceMask(sourceCat)
+        return pipeBase.Struct(
+            x=np.ascontiguousarray(sourceCat.getX()[good], dtype=np.float64),
+            y=np.ascontiguousarray(sourceCat.getY()[good], dtype=np.float64),
+            flux=np.ascontiguousarray(sourceCat.getPsfInstFlux()[good], dtype=np.float64),
+        )
 
     @staticmethod
     def _trimBadPoints(sourceCat, bbox, wcs=None):
         """Remove elements from catalog whose xy positions are not within the given bbox.
 
         sourceCat:  a Catalog of SimpleRecord or SourceRecord objects
-        bbox: an afwImage.Box2D
+        bbox: an afwImage.Box2D; as for Box2D.contains, the minimum edges are
+              inside and the maximum edges outside
         wcs:  if not None, will be used to compute the xy positions on-the-fly;
               this is required when sources actually contains SimpleRecords.
 
         Returns:
-        a list of Source objects with xAstrom, yAstrom within the bbox.
+        a contiguous deep copy of the sources with positions within the bbox.
         """
-        keep = type(sourceCat)(sourceCat.table)
-        for s in sourceCat:
-            point = s.getCentroid() if wcs is None else wcs.skyToPixel(s.getCoord())
-            if bbox.contains(point):
-                keep.append(s)
-        return keep
+        if not sourceCat.isContiguous():
+            sourceCat = sourceCat.copy(deep=True)
+        if wcs is None:
+            x, y = sourceCat.getX(), sourceCat.getY()
+        else:
+            x, y = skyToPixelArrays(wcs, sourceCat["coord_ra"], sourceCat["coord_dec"])
+        bbox = afwGeom.Box2D(bbox)
+        with np.errstate(invalid="ignore"):
+            inside = (x >= bbox.getMinX()) & (x < bbox.getMaxX()) & \
+                (y >= bbox.getMinY()) & (y < bbox.getMaxY())
+        return sourceCat[inside].copy(deep=True)
 
 
 def _createMetadata(bbox, wcs, filterName):
@@ -25,9 +25,11 @@ extern "C" {
 #include <sstream>
 
 #include "pybind11/pybind11.h"
+#include "pybind11/numpy.h"
 #include "pybind11/stl.h"
 
 #include "lsst/log/Log.h"
+#include "lsst/pex/exceptions.h"
 #include "lsst/utils/python.h"
 #include "lsst/meas/extensions/astrometryNet/astrometry_net.h"
 
@@ -64,6 +66,8 @@ static void declareIndex(py::module& mod) {
     cls.def_readonly("hpnside", &index_t::hpnside);
     cls.def_readonly("nstars", &index_t::nstars);
     cls.def_readonly("nquads", &index_t::nquads);
+    cls.def_readonly("index_scale_lower", &index_t::index_scale_lower);
+    cls.def_readonly("index_scale_upper", &index_t::index_scale_upper);
 }
 
 /**
@@ -127,10 +131,25 @@ static void declareSolver(py::module& mod) {
     cls.def("getCatalog", &Solver::getCatalog, "inds"_a, "ctrCoord"_a, "radius"_a, "idCol"_a,
             "filterNameList"_a, "magColList"_a, "magErrColList"_a, "starGalCol"_a, "varCol"_a,
             "uniqueIds"_a = true);
+    cls.def("countStars", &Solver::countStars, "inds"_a, "ctrCoord"_a, "radius"_a);
+    cls.def("getMagHistograms", &Solver::getMagHistograms, "inds"_a, "ctrCoord"_a, "radius"_a, "magCol"_a,
+            "binEdges"_a);
+    cls.def("getStarArrays",
+            [](Solver const& self, std::vector<index_t*> inds, lsst::afw::geom::SpherePoint const& ctrCoord,
+               lsst::afw::geom::Angle const& radius, std::string const& magCol) {
+                auto const arrays = self.getStarArrays(inds, ctrCoord, radius, magCol);
+                auto toArray = [](std::vector<double> const& vec) {
+                    return py::array_t<double>(vec.size(), vec.data());
+                };
+                return py::make_tuple(toArray(std::get<0>(arrays)), toArray(std::get<1>(arrays)),
+                                      toArray(std::get<2>(arrays)));
+            },
+            "inds"_a, "ctrCoord"_a, "radius"_a, "magCol"_a);
     cls.def("getSolveStats", &Solver::getSolveStats);
     cls.def("getWcs", &Solver::getWcs);
     cls.def("didSolve", &Solver::didSolve);
-    cls.def("run", &Solver::run, "cpulimit"_a);
+    // Release the GIL so that several solvers may run in parallel threads
+    cls.def("run", &Solver::run, "cpulimit"_a, py::call_guard<py::gil_scoped_release>());
     cls.def("getQuadSizeRangeArcsec", &Solver::getQuadSizeRangeArcsec);
     cls.def("addIndices", &Solver::addIndices, "indices"_a);
     cls.def("setParity", &Solver::setParity, "setParityFlipped", "parity"_a);
@@ -139,7 +158,30 @@ static void declareSolver(py::module& mod) {
     cls.def("setRaDecRadius", &Solver::setRaDecRadius, "ra"_a, "dec"_a, "rad"_a);
     cls.def("setImageSize", &Solver::setImageSize, "width"_a, "height"_a);
     cls.def("setMaxStars", &Solver::setMaxStars, "maxStars"_a);
-    cls.def("setStars", &Solver::setStars, "sourceCat"_a, "x0"_a, "y0"_a);
+    cls.def("setStars",
+            (void (Solver::*)(lsst::afw::table::SourceCatalog const&, int, int)) & Solver::setStars,
+            "sourceCat"_a, "x0"_a, "y0"_a);
+    // Contiguous float64 arrays are used in place; anything else is converted first
+    using DoubleArray = py::array_t<double, py::array::c_style | py::array::forcecast>;
+    cls.def("setStars",
+            [](Solver& self, DoubleArray const& x, DoubleArray const& y, DoubleArray const& flux, int x0,
+               int y0) {
+                if (x.ndim() != 1 || y.ndim() != 1 || flux.ndim() != 1) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                                      "x, y and flux must be one-dimensional arrays");
+                }
+                if (x.size() != y.size() || x.size() != flux.size()) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                                      "x, y and flux must have the same length");
+                }
+                self.setStars(x.data(), y.data(), flux.data(), x.size(), x0, y0);
+            },
+            "x"_a, "y"_a, "flux"_a, "x0"_a, "y0"_a);
+}
+
+/// Distance (deg) from an ICRS position (deg) to the nearest point of a healpix
+double healpixDistanceDeg(int hp, int nside, double ra, double dec) {
+    return healpix_distance_to_radec(hp, nside, ra, dec, NULL);
 }
 
 // declare logging functions for use by the Python
@@ -200,6 +242,9 @@ PYBIND11_MODULE(astrometry_net, mod) {
     start_an_logging();
 
     mod.def("healpixDistance", &healpixDistance, "hp"_a, "nside"_a, "coord"_a);
+    // Array versions, for ICRS positions in degrees
+    mod.def("healpixDistanceDeg", py::vectorize(healpixDistanceDeg), "hp"_a, "nside"_a, "ra"_a, "dec"_a);
+    mod.def("radecDegToHealpix", py::vectorize(radecdegtohealpix), "ra"_a, "dec"_a, "nside"_a);
 
     mod.def("an_log_init", [](int level) { log_init(static_cast<log_level>(level)); }, "level"_a);
 
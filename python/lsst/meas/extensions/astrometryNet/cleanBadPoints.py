@@ -25,106 +25,110 @@ __all__ = ["clean"]
 
 import numpy as np
 
-from lsst.meas.astrom.sip import LeastSqFitter1dPoly
+from .matchArrays import MatchArrays
+from .wcsUtils import coordsToArrays, skyToPixelArrays
 
 
-def clean(srcMatch, wcs, order=3, nsigma=3):
+def clean(srcMatch, wcs, order=3, nsigma=3, useY=False):
     """Remove bad points from srcMatch
 
     Input:
-    srcMatch : list of det::SourceMatch
+    srcMatch : list of det::SourceMatch, or a MatchArrays
     order:      Order of polynomial to use in robust fitting
     nsigma:    Sources more than this far away from the robust best fit
                 polynomial are removed
+    useY:      If False, clip on the X residuals (as a function of X) alone;
+                if True, clip jointly on the X residuals (as a function of X)
+                and the Y residuals (as a function of Y), each in units of its
+                scatter, added in quadrature
 
     Return:
-    list of det::SourceMatch of the good data points
+    list of det::SourceMatch of the good data points (a MatchArrays if srcMatch is one)
     """
+    if isinstance(srcMatch, MatchArrays):
+        catX, catY = srcMatch.getRefPixels(wcs)
+        x, y = srcMatch.srcX, srcMatch.srcY
+    else:
+        ra, dec = coordsToArrays([m.first.getCoord() for m in srcMatch])
+        catX, catY = skyToPixelArrays(wcs, ra, dec)
+        srcXY = np.array([(m.second.getX(), m.second.getY()) for m in srcMatch], dtype=float).reshape(-1, 2)
+        x, y = srcXY[:, 0], srcXY[:, 1]
 
-    N = len(srcMatch)
-    catX = np.zeros(N)
-    # catY = np.zeros(N)
-    for i in range(N):
-        x, y = wcs.skyToPixel(srcMatch[i].first.getCoord())
-        catX[i] = x
-        # catY[i] = y
-
-    # TODO -- why does this only use X?
-
-    x = np.array([s.second.getX() for s in srcMatch])
     dx = x - catX
-    sigma = np.zeros_like(dx) + 0.1
-
-    idx = indicesOfGoodPoints(x, dx, sigma, order=order, nsigma=nsigma)
-
-    clean = []
-    for i in idx:
-        clean.append(srcMatch[i])
-    return clean
+    if useY:
+        dy = y - catY
+        deviance2 = np.zeros_like(dx)
+        for values, residuals in ((x, dx), (y, dy)):
+            residuals = _robustFitResiduals(values, residuals, order)
+            if residuals is None:
+                deviance2 = None
+                break
+            sigma = residuals.std()
+            if sigma > 0:
+                deviance2 += (residuals/sigma)**2
+        idx = np.zeros(0, dtype=int) if deviance2 is None else np.flatnonzero(deviance2 < nsigma**2)
+    else:
+        sigma = np.zeros_like(dx) + 0.1
+        idx = indicesOfGoodPoints(x, dx, sigma, order=order, nsigma=nsigma)
+
+    if isinstance(srcMatch, MatchArrays):
+        return srcMatch.subset(idx)
+    return [srcMatch[i] for i in idx]
 
 
 def indicesOfGoodPoints(x, y, s, order=1, nsigma=3, maxiter=100):
     """Return a list of indices in the range [0, len(x)]
     of points that lie less than nsigma away from the robust
     best fit polynomial
-    """
 
+    The polynomial (with "order" coefficients) is fit to order+1 points:
+    the mean of x and median of y in each of order+1 groups of points
+    of increasing x. The groups do not change as points are rejected, so
+    one pass suffices; "s" and "maxiter" are retained for compatibility.
+    """
+    residuals = _robustFitResiduals(x, y, order)
+    if residuals is None:
+        # too few points to fill each group, so no fit is possible
+        return np.zeros(0, dtype=int)
+
+    sigma = residuals.std()
+    if sigma == 0:
+        # all points are good
+        return x.argsort()
+    deviance = np.fabs(residuals / sigma)
+    return np.flatnonzero(deviance < nsigma)
+
+
+def _robustFitResiduals(x, y, order):
+    """Return the residuals of y from the robust polynomial fit of indicesOfGoodPoints,
+    or None if there are too few points to fit"""
     # Indices of elements of x sorted in order of increasing value
     idx = x.argsort()
-    newidx = []
-    for niter in range(maxiter):
-        rx = chooseRx(x, idx, order)
-        ry = chooseRy(y, idx, order)
-        rs = np.ones((len(rx)))
-
-        lsf = LeastSqFitter1dPoly(list(rx), list(ry), list(rs), order)
-        fit = [lsf.valueAt(value) for value in rx]
-        f = [lsf.valueAt(value) for value in x]
-
-        sigma = (y-f).std()
-        if sigma == 0:
-            # all remaining points are good; short circuit
-            return newidx if newidx else idx
-        deviance = np.fabs((y - f) / sigma)
-        newidx = np.flatnonzero(deviance < nsigma)
-
-        if False:
-            import matplotlib.pyplot as plt
-            plt.plot(x, y, 'ks')
-            plt.plot(rx, ry, 'b-')
-            plt.plot(rx, ry, 'bs')
-            plt.plot(rx, fit, 'ms')
-            plt.plot(rx, fit, 'm-')
-            # plt.plot(x[newidx], y[newidx], 'rs')
-            plt.show()
-
-        # If we haven't culled any points we're finished cleaning
-        if len(newidx) == len(idx):
-            break
-
-    # We get here because we either a) stopped finding bad points
-    # or b) ran out of iterations. Either way, we just return our
-    # list of indices of good points.
-    return newidx
+    if len(idx) < order + 1:
+        return None
+    rx = chooseRx(x, idx, order)
+    ry = chooseRy(y, idx, order)
+    coeffs = np.polyfit(rx, ry, order - 1)
+    return y - np.polyval(coeffs, x)
 
 
-def chooseRx(x, idx, order):
-    """Create order+1 values of the ordinate based on the median of groups of elements of x"""
-    rSize = len(idx)/float(order+1)  # Note, a floating point number
-    rx = np.zeros((order+1))
+def _splitSorted(values, idx, order):
+    """Split values[idx] into order+1 consecutive groups
+
+    Group i is [int(rSize*i), int(rSize*(i+1))) with rSize = len(idx)/(order+1).
+    (np.array_split would put the larger groups first, and so choose different points.)
+    """
+    rSize = len(idx)/float(order + 1)  # Note, a floating point number
+    bounds = (rSize*np.arange(order + 2)).astype(int)
+    sortedValues = values[idx]
+    return [sortedValues[bounds[i]:bounds[i + 1]] for i in range(order + 1)]
 
-    for i in range(order+1):
-        rng = list(range(int(rSize*i), int(rSize*(i+1))))
-        rx[i] = np.mean(x[idx[rng]])
-    return rx
+
+def chooseRx(x, idx, order):
+    """Create order+1 values of the ordinate based on the mean of groups of elements of x"""
+    return np.array([np.mean(group) for group in _splitSorted(x, idx, order)])
 
 
 def chooseRy(y, idx, order):
     """Create order+1 values of the ordinate based on the median of groups of elements of y"""
-    rSize = len(idx)/float(order+1)  # Note, a floating point number
-    ry = np.zeros((order+1))
-
-    for i in range(order+1):
-        rng = list(range(int(rSize*i), int(rSize*(i+1))))
-        ry[i] = np.median(y[idx[rng]])
-    return ry
+    return np.array([np.median(group) for group in _splitSorted(y, idx, order)])
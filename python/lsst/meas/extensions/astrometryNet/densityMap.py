@@ -0,0 +1,148 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["DensityMap"]
+
+from builtins import object
+import math
+
+import numpy as np
+
+import lsst.pipe.base as pipeBase
+from .astrometry_net import healpixDistanceDeg, radecDegToHealpix
+
+
+class DensityMap(object):
+    """!A coarse healpix map of the reference objects of one star kd-tree
+
+    For each healpix of the map we hold the number of reference objects
+    and quantiles of their magnitudes, so the number and brightness of the
+    reference objects in a region may be estimated without reading the
+    index files.
+    """
+
+    def __init__(self, nside, quantiles, counts, magQuantiles):
+        """!Constructor
+
+        @param[in] nside  healpix nside of the map
+        @param[in] quantiles  quantile levels, each in [0, 1]; array-like
+        @param[in] counts  number of reference objects in each healpix; array of length 12*nside**2
+        @param[in] magQuantiles  magnitude at each quantile level in each healpix (NaN where there
+            are no magnitudes); array of shape (12*nside**2, len(quantiles))
+        """
+        self.nside = int(nside)
+        self.quantiles = np.asarray(quantiles, dtype=float)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.magQuantiles = np.asarray(magQuantiles, dtype=float).reshape(len(self.counts),
+                                                                          len(self.quantiles))
+        if len(self.counts) != self.getNumPixels(self.nside):
+            raise RuntimeError("Density map with nside %d needs %d counts, not %d" %
+                               (self.nside, self.getNumPixels(self.nside), len(self.counts)))
+
+    @staticmethod
+    def getNumPixels(nside):
+        """!Get the number of healpixes for an nside"""
+        return 12*nside**2
+
+    @classmethod
+    def fromArrays(cls, ra, dec, mag, nside, quantiles):
+        """!Construct from the positions and magnitudes of the reference objects
+
+        @param[in] ra  ICRS RA (deg); array-like
+        @param[in] dec  ICRS Dec (deg); array-like
+        @param[in] mag  magnitudes; array-like (NaN values are counted but not used for the quantiles)
+        @param[in] nside  healpix nside of the map
+        @param[in] quantiles  quantile levels, each in [0, 1]; array-like
+        """
+        quantiles = np.asarray(quantiles, dtype=float)
+        numPixels = cls.getNumPixels(nside)
+        mag = np.asarray(mag, dtype=float)
+        magQuantiles = np.full((numPixels, len(quantiles)), np.nan)
+        if len(mag) == 0:
+            return cls(nside, quantiles, np.zeros(numPixels, dtype=np.int64), magQuantiles)
+
+        pixels = np.asarray(radecDegToHealpix(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float),
+                                              nside), dtype=np.int64)
+        counts = np.bincount(pixels, minlength=numPixels)
+
+        # Sort by pixel, then by magnitude (NaN last), so each pixel's finite magnitudes are
+        # a sorted run at the start of its range
+        finite = np.isfinite(mag)
+        order = np.lexsort((np.where(finite, mag, 0.0), np.logical_not(finite), pixels))
+        sortedMag = mag[order]
+        numFinite = np.bincount(pixels[finite], minlength=numPixels)
+        start = np.cumsum(counts) - counts
+        have = np.flatnonzero(numFinite > 0)
+        # Linear interpolation between order statistics, as numpy.percentile
+        position = (numFinite[have, np.newaxis] - 1)*quantiles[np.newaxis, :]
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, numFinite[have, np.newaxis] - 1)
+        frac = position - lower
+        base = start[have, np.newaxis]
+        magQuantiles[have] = sortedMag[base + lower]*(1 - frac) + sortedMag[base + upper]*frac
+        return cls(nside, quantiles, counts, magQuantiles)
+
+    def getPixelArea(self):
+        """!Get the area of one healpix (sr)"""
+        return 4*math.pi/self.getNumPixels(self.nside)
+
+    def getPixelsInRange(self, ctrCoord, radius):
+        """!Get the healpixes within range of a circular sky region
+
+        @param[in] ctrCoord  center of region (an afwGeom.SpherePoint)
+        @param[in] radius  radius of region (an afwGeom.Angle)
+        @return indices of the healpixes that overlap the region (a numpy array)
+        """
+        pixels = np.arange(self.getNumPixels(self.nside))
+        distance = healpixDistanceDeg(pixels, self.nside, ctrCoord.getLongitude().asDegrees(),
+                                      ctrCoord.getLatitude().asDegrees())
+        return pixels[np.asarray(distance) <= radius.asDegrees()]
+
+    def query(self, ctrCoord, radius):
+        """!Estimate the number and magnitudes of the reference objects in a circular sky region
+
+        The number is the circle's area times the mean density of the healpixes that overlap it;
+        the magnitude quantiles are the count-weighted mean of those of the same healpixes.
+        Both are approximations, best for regions much larger or much smaller than a healpix.
+
+        @param[in] ctrCoord  center of region (an afwGeom.SpherePoint)
+        @param[in] radius  radius of region (an afwGeom.Angle)
+        @return an lsst.pipe.base.Struct containing:
+        - numStars  estimated number of reference objects (float)
+        - magQuantiles  estimated magnitude at each of self.quantiles (a numpy array; NaN if unknown)
+        - pixels  indices of the healpixes used (a numpy array)
+        """
+        pixels = self.getPixelsInRange(ctrCoord, radius)
+        counts = self.counts[pixels]
+        radiusRad = min(radius.asRadians(), math.pi)
+        circleArea = 2*math.pi*(1 - math.cos(radiusRad))
+        numStars = 0.0
+        if len(pixels) > 0:
+            numStars = circleArea*counts.sum()/(len(pixels)*self.getPixelArea())
+
+        magQuantiles = np.full(len(self.quantiles), np.nan)
+        values = self.magQuantiles[pixels]
+        useful = (counts > 0) & np.all(np.isfinite(values), axis=1)
+        if np.any(useful):
+            magQuantiles = np.average(values[useful], axis=0, weights=counts[useful])
+        return pipeBase.Struct(numStars=numStars, magQuantiles=magQuantiles, pixels=pixels)
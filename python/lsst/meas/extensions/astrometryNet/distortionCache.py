@@ -0,0 +1,148 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["DetectorDistortion", "DistortionCache"]
+
+from builtins import object
+import math
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+from lsst.afw.cameraGeom import PIXELS, TAN_PIXELS
+
+
+class DetectorDistortion(object):
+    """!The PIXELS -> TAN_PIXELS distortion of one detector, sampled on a grid
+
+    Positions within the detector bounding box are evaluated by bilinear
+    interpolation on the grid, provided that the interpolation error
+    (measured at the grid cell centers when the grid is built) is within
+    tolerance; otherwise, and for positions outside the bounding box,
+    the exact transform is applied to the whole array at once.
+    """
+
+    def __init__(self, detector, gridSpacing, tolerance):
+        """!Constructor
+
+        @param[in] detector  detector (an lsst.afw.cameraGeom.Detector)
+        @param[in] gridSpacing  approximate spacing of the grid points (pixels)
+        @param[in] tolerance  maximum interpolation error (pixels) for which the grid is used
+        """
+        self.transform = detector.getTransform(PIXELS, TAN_PIXELS)
+        bbox = afwGeom.Box2D(detector.getBBox())
+        numX = int(math.ceil(bbox.getWidth()/gridSpacing)) + 1
+        numY = int(math.ceil(bbox.getHeight()/gridSpacing)) + 1
+        self._xGrid = np.linspace(bbox.getMinX(), bbox.getMaxX(), numX)
+        self._yGrid = np.linspace(bbox.getMinY(), bbox.getMaxY(), numY)
+        xx, yy = np.meshgrid(self._xGrid, self._yGrid)
+        self._tanX, self._tanY = (grid.reshape(xx.shape) for grid in self._applyExact(xx.ravel(), yy.ravel()))
+
+        # Interpolation error is largest far from the grid points
+        xMid, yMid = np.meshgrid(0.5*(self._xGrid[1:] + self._xGrid[:-1]),
+                                 0.5*(self._yGrid[1:] + self._yGrid[:-1]))
+        exactX, exactY = self._applyExact(xMid.ravel(), yMid.ravel())
+        approxX, approxY = self._interpolate(xMid.ravel(), yMid.ravel())
+        self.maxError = float(np.max(np.hypot(approxX - exactX, approxY - exactY)))
+        self.useGrid = self.maxError <= tolerance
+
+        tanBBox = afwGeom.Box2D()
+        for corner in detector.getCorners(TAN_PIXELS):
+            tanBBox.include(corner)
+        self.tanBBox = afwGeom.Box2I(tanBBox)
+
+    def apply(self, x, y):
+        """!Compute distorted positions
+
+        @param[in] x  x positions (pixels); a numpy array
+        @param[in] y  y positions (pixels); a numpy array
+        @return distorted x and y positions (TAN_PIXELS), as two numpy arrays
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if not self.useGrid:
+            return self._applyExact(x, y)
+        inside = (x >= self._xGrid[0]) & (x <= self._xGrid[-1]) & \
+            (y >= self._yGrid[0]) & (y <= self._yGrid[-1])
+        if inside.all():
+            return self._interpolate(x, y)
+        tanX = np.empty_like(x)
+        tanY = np.empty_like(y)
+        tanX[inside], tanY[inside] = self._interpolate(x[inside], y[inside])
+        outside = np.logical_not(inside)
+        tanX[outside], tanY[outside] = self._applyExact(x[outside], y[outside])
+        return tanX, tanY
+
+    def _applyExact(self, x, y):
+        if len(x) == 0:
+            return np.zeros(0), np.zeros(0)
+        result = self.transform.applyForward(np.array([x, y]))
+        return np.asarray(result[0]), np.asarray(result[1])
+
+    def _interpolate(self, x, y):
+        xGrid, yGrid = self._xGrid, self._yGrid
+        fx = (x - xGrid[0])/(xGrid[1] - xGrid[0])
+        fy = (y - yGrid[0])/(yGrid[1] - yGrid[0])
+        ix = np.clip(np.floor(fx).astype(int), 0, len(xGrid) - 2)
+        iy = np.clip(np.floor(fy).astype(int), 0, len(yGrid) - 2)
+        tx = fx - ix
+        ty = fy - iy
+
+        def bilinear(grid):
+            return (grid[iy, ix]*(1 - tx)*(1 - ty) + grid[iy, ix + 1]*tx*(1 - ty) +
+                    grid[iy + 1, ix]*(1 - tx)*ty + grid[iy + 1, ix + 1]*tx*ty)
+
+        return bilinear(self._tanX), bilinear(self._tanY)
+
+
+class DistortionCache(object):
+    """!A cache of DetectorDistortion, one per detector
+
+    Entries are keyed on the detector name, serial and bounding box, so
+    a cache may be kept for the lifetime of a task and reused for every
+    visit of the same camera.
+    """
+
+    def __init__(self, gridSpacing, tolerance):
+        """!Constructor
+
+        @param[in] gridSpacing  approximate spacing of the grid points (pixels)
+        @param[in] tolerance  maximum interpolation error (pixels) for which the grid is used
+        """
+        self.gridSpacing = gridSpacing
+        self.tolerance = tolerance
+        self._entries = {}
+
+    def get(self, detector):
+        """!Get the distortion of a detector, sampling it if it is not cached
+
+        @param[in] detector  detector (an lsst.afw.cameraGeom.Detector)
+        @return a DetectorDistortion
+        """
+        bbox = detector.getBBox()
+        key = (detector.getName(), detector.getSerial(), tuple(bbox.getMin()), tuple(bbox.getDimensions()))
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = DetectorDistortion(detector, gridSpacing=self.gridSpacing, tolerance=self.tolerance)
+            self._entries[key] = entry
+        return entry
@@ -0,0 +1,85 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["IndexHitStats"]
+
+from builtins import object
+import json
+import os
+
+from .jsonUtils import writeJsonAtomic
+
+
+class IndexHitStats(object):
+    """!Persisted record of how often each index provided the solution
+
+    For each index set (identified by AstrometryNetCatalog.getIdentity) and
+    each index ID, we count the number of solves the index was given to and
+    the number of those in which it was the best index (the
+    "meas_astrom*an*best_index*id" entry of Solver.getSolveStats).
+    All index sets are kept in a single JSON file.
+    """
+
+    def __init__(self, filename, indexIdentity):
+        """!Constructor
+
+        @param[in] filename  name of the JSON file holding the statistics; it need not exist yet
+        @param[in] indexIdentity  identity of the index set in use
+        """
+        self.filename = filename
+        self.indexIdentity = indexIdentity
+        self._stats = {}
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                self._stats = json.load(fd)
+
+    def _getCounts(self, indexId):
+        counts = self._stats.setdefault(self.indexIdentity, {})
+        # JSON object keys are always strings
+        return counts.setdefault(str(indexId), dict(tries=0, hits=0))
+
+    def getHitRate(self, indexId):
+        """!Get the estimated probability that an index provides the solution
+
+        The estimate is (hits + 1)/(tries + 2), so that an index with no
+        history has a rate of one half.
+        """
+        counts = self._stats.get(self.indexIdentity, {}).get(str(indexId))
+        if counts is None:
+            return 0.5
+        return (counts["hits"] + 1)/(counts["tries"] + 2)
+
+    def update(self, triedIds, bestId):
+        """!Record the result of a solve
+
+        @param[in] triedIds  IDs of the indexes given to the solver
+        @param[in] bestId  ID of the index that provided the solution, or None if it failed
+        """
+        for indexId in set(triedIds):
+            self._getCounts(indexId)["tries"] += 1
+        if bestId is not None:
+            self._getCounts(bestId)["hits"] += 1
+
+    def write(self):
+        """!Write the statistics to the file"""
+        writeJsonAtomic(self.filename, self._stats, indent=2, sort_keys=True)
@@ -0,0 +1,51 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Utilities for the JSON files in which solver state is persisted"""
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["writeJsonAtomic"]
+
+import json
+import os
+import tempfile
+
+
+def writeJsonAtomic(filename, data, **kwargs):
+    """!Write data to a JSON file, so that readers never see a partial file
+
+    The data are written to a temporary file in the same directory, which is
+    then renamed to filename; the temporary file is removed if that fails.
+
+    @param[in] filename  name of the file to write
+    @param[in] data  data to write; must be serializable by json.dump
+    @param[in] kwargs  further keyword arguments for json.dump, e.g. indent
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpName = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as outFile:
+            json.dump(data, outFile, **kwargs)
+        os.rename(tmpName, filename)
+    except BaseException:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
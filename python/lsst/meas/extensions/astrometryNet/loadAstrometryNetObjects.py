@@ -160,6 +160,69 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
             fluxField=fluxField,
         )
 
+    @pipeBase.timeMethod
+    def countSkyCircle(self, ctrCoord, radius, filterName=None, magBinEdges=None):
+        """!Count reference objects in a circular sky region, without loading them
+
+        Only the star kd-trees are searched: no records are made, and the tag-along table
+        is only read (for the one magnitude column) if a histogram is requested.
+        This is much faster than loadSkyCircle, so it suits diagnostics and quick checks.
+
+        @param[in] ctrCoord  center of search region (an afwGeom.SpherePoint)
+        @param[in] radius  radius of search region (an afwGeom.Angle)
+        @param[in] filterName  name of filter for the magnitude histogram, or None for the default
+            magnitude column
+        @param[in] magBinEdges  increasing magnitude bin edges for the histogram; if None then
+            no histogram is made
+
+        @return an lsst.pipe.base.Struct containing:
+        - indexIds  ID of each index searched (a list of int)
+        - counts  number of reference objects found in each index (a list of int)
+        - numStars  estimated number of distinct reference objects (0 if none); see
+            _countDistinctStars
+        - magHistograms  for each index, the number of reference objects in each magnitude bin
+            (a list of lists of int), or None if magBinEdges is None
+        """
+        self._readIndexFiles()
+
+        solver = self._getSolver()
+        multiInds = self._getMIndexesWithinRange(ctrCoord, radius)
+
+        self.log.debug("count objects at %s with radius %s deg", ctrCoord, radius.asDegrees())
+        with LoadMultiIndexes(multiInds):
+            inds = tuple(mi[0] for mi in multiInds)
+            indexIds = [ind.indexid for ind in inds]
+            counts = solver.countStars(inds, ctrCoord, radius)
+            magHistograms = None
+            if magBinEdges is not None:
+                magCol = self._getMagColumn(filterName)
+                magHistograms = solver.getMagHistograms(inds, ctrCoord, radius, magCol,
+                                                        [float(edge) for edge in magBinEdges])
+
+        numStars = _countDistinctStars(inds, counts)
+        self.log.debug("counted about %d distinct objects in %d indices", numStars, len(counts))
+        return pipeBase.Struct(
+            indexIds=indexIds,
+            counts=counts,
+            numStars=numStars,
+            magHistograms=magHistograms,
+        )
+
+    def _getMagColumn(self, filterName):
+        """!Get the name of the magnitude column in the index files for a filter
+
+        @param[in] filterName  name of filter, or None for the default magnitude column
+        @return name of magnitude column
+        @throw RuntimeError if the filter is not in the astrometry.net data config's magColumnMap
+        """
+        if filterName is None:
+            return self.andConfig.defaultMagColumn
+        refFilterName = self.config.filterMap.get(filterName, filterName)
+        magCol = self.andConfig.magColumnMap.get(refFilterName)
+        if magCol is None:
+            raise RuntimeError("Filter %r is not in the astrometry.net data magColumnMap" % (filterName,))
+        return magCol
+
     @pipeBase.timeMethod
     def _readIndexFiles(self):
         """!Read all astrometry.net index files, if not already read
@@ -193,18 +256,55 @@ class LoadAstrometryNetObjectsTask(LoadReferenceObjectsTask):
         return solver
 
 
+def _countDistinctStars(inds, counts):
+    """!Estimate the number of distinct stars found in several indices
+
+    Indices covering the same healpix tile (e.g. different quad scales built from
+    the same catalog) share their stars, so only the largest count of each tile is
+    used; distinct tiles of the same healpix nside do not overlap, so their counts
+    are summed. Tilings of different nside (including all-sky indices) overlap,
+    so the largest of their sums is returned. Stars in the margin that a tile may
+    share with its neighbors are counted once per tile.
+
+    @param[in] inds  indices searched (astrometry_net.index_t)
+    @param[in] counts  number of stars found in each index
+    @return estimated number of distinct stars
+    """
+    tileCounts = {}
+    for ind, count in zip(inds, counts):
+        nside = None if ind.healpix < 0 else ind.hpnside
+        key = (nside, ind.healpix)
+        tileCounts[key] = max(tileCounts.get(key, 0), count)
+    tilingCounts = {}
+    for (nside, healpix), count in tileCounts.items():
+        tilingCounts[nside] = tilingCounts.get(nside, 0) + count
+    return max(tilingCounts.values()) if tilingCounts else 0
+
+
 class LoadMultiIndexes(object):
     """Context manager for loading and unloading astrometry.net multi-index files
+
+    The multi-indexes are pinned for the duration of the context, so a multi-index
+    used by several contexts at once (e.g. solves in different threads) is unloaded
+    only when the last of them exits. Nesting the contexts of several solves in an
+    outer one over the union of their multi-indexes therefore shares a single load.
     """
 
     def __init__(self, multiInds):
-        self.multiInds = multiInds
+        self.multiInds = list(multiInds)
 
     def __enter__(self):
-        for mi in self.multiInds:
-            mi.reload()
+        pinned = []
+        try:
+            for mi in self.multiInds:
+                mi.pin()
+                pinned.append(mi)
+        except Exception:
+            for mi in pinned:
+                mi.unpin()
+            raise
         return self.multiInds
 
     def __exit__(self, typ, val, trace):
         for mi in self.multiInds:
-            mi.unload()
+            mi.unpin()
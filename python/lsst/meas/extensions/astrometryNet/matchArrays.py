@@ -0,0 +1,112 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["MatchArrays"]
+
+from builtins import object
+from builtins import zip
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+from .wcsUtils import coordsToArrays, pixelToSkyArrays, skyToPixelArrays, separationArrays
+
+
+class MatchArrays(object):
+    """!Matches between reference objects and sources, held as parallel numpy arrays
+
+    Used in place of a list of lsst.afw.table.ReferenceMatch while iterating
+    over matches, so that positions are gathered once rather than on every
+    iteration; use toReferenceMatches to get the list.
+
+    Attributes (numpy arrays with one element per match):
+    - refIndex  index of the reference object in refRecords
+    - srcIndex  index of the source in srcRecords
+    - distance  match distance (radians)
+    - refRa, refDec  reference object position (ICRS radians)
+    - srcX, srcY  source centroid (pixels)
+    """
+
+    def __init__(self, refRecords, srcRecords, refIndex, srcIndex, distance, refRa, refDec, srcX, srcY):
+        """!Constructor
+
+        @param[in] refRecords  reference objects (a catalog or a sequence of records)
+        @param[in] srcRecords  sources (a catalog or a sequence of records)
+        @param[in] refIndex  index of the matched reference object in refRecords, per match
+        @param[in] srcIndex  index of the matched source in srcRecords, per match
+        @param[in] distance  match distance (radians), per match
+        @param[in] refRa  RA of the matched reference object (radians), per match
+        @param[in] refDec  Dec of the matched reference object (radians), per match
+        @param[in] srcX  x centroid of the matched source (pixels), per match
+        @param[in] srcY  y centroid of the matched source (pixels), per match
+        """
+        self.refRecords = refRecords
+        self.srcRecords = srcRecords
+        self.refIndex = np.asarray(refIndex, dtype=int)
+        self.srcIndex = np.asarray(srcIndex, dtype=int)
+        self.distance = np.asarray(distance, dtype=float)
+        self.refRa = np.asarray(refRa, dtype=float)
+        self.refDec = np.asarray(refDec, dtype=float)
+        self.srcX = np.asarray(srcX, dtype=float)
+        self.srcY = np.asarray(srcY, dtype=float)
+
+    @classmethod
+    def fromReferenceMatches(cls, matches):
+        """!Construct from a list of lsst.afw.table.ReferenceMatch"""
+        refRecords = [m.first for m in matches]
+        srcRecords = [m.second for m in matches]
+        refRa, refDec = coordsToArrays([ref.getCoord() for ref in refRecords])
+        srcXY = np.array([(src.getX(), src.getY()) for src in srcRecords], dtype=float).reshape(-1, 2)
+        indices = np.arange(len(matches))
+        return cls(refRecords, srcRecords, indices, indices, [m.distance for m in matches],
+                   refRa, refDec, srcXY[:, 0], srcXY[:, 1])
+
+    def __len__(self):
+        return len(self.refIndex)
+
+    def subset(self, selection):
+        """!Return the matches selected by a boolean mask or an array of indices"""
+        return MatchArrays(self.refRecords, self.srcRecords, self.refIndex[selection],
+                           self.srcIndex[selection], self.distance[selection], self.refRa[selection],
+                           self.refDec[selection], self.srcX[selection], self.srcY[selection])
+
+    def getRefPixels(self, wcs):
+        """!Return the pixel positions of the reference objects, as x and y numpy arrays"""
+        return skyToPixelArrays(wcs, self.refRa, self.refDec)
+
+    def getSourceSky(self, wcs):
+        """!Return the sky positions of the sources, as RA and Dec (radians) numpy arrays"""
+        return pixelToSkyArrays(wcs, self.srcX, self.srcY)
+
+    def getSeparations(self, wcs):
+        """!Return the angular separation (radians) of each source, mapped to the sky by wcs,
+        from its reference object
+        """
+        ra, dec = self.getSourceSky(wcs)
+        return separationArrays(ra, dec, self.refRa, self.refDec)
+
+    def toReferenceMatches(self):
+        """!Return the matches as a list of lsst.afw.table.ReferenceMatch"""
+        return [afwTable.ReferenceMatch(self.refRecords[int(refIndex)], self.srcRecords[int(srcIndex)],
+                                        float(distance))
+                for refIndex, srcIndex, distance in zip(self.refIndex, self.srcIndex, self.distance)]
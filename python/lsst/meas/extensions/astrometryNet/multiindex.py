@@ -5,15 +5,21 @@ __all__ = ["getIndexPath", "getConfigFromEnvironment", "AstrometryNetCatalog", "
 from builtins import zip
 from builtins import range
 from builtins import object
+import hashlib
 import os
+import threading
 
 import numpy as np
 from astropy.io import fits
 
+import lsst.afw.geom as afwGeom
+import lsst.pex.exceptions
+import lsst.pipe.base as pipeBase
 import lsst.utils
 from lsst.log import Log
-from .astrometry_net import MultiIndex, healpixDistance
+from .astrometry_net import MultiIndex, Solver, healpixDistance
 from .astrometryNetDataConfig import AstrometryNetDataConfig
+from .densityMap import DensityMap
 
 
 def getIndexPath(fn):
@@ -84,6 +90,11 @@ class MultiIndexCache(object):
         self._nside = int(nside)
         self._mi = None
         self._loaded = False
+        self._pinCount = 0
+        # Guards loading and unloading, which may be requested by solves in several threads
+        self._lock = threading.RLock()
+        self.densityMap = None  # a DensityMap of the star kd-tree, if known
+        self._scaleRanges = None  # quad scale range (arcsec) of each index, if known
         self.log = Log.getDefaultLogger()
 
     @classmethod
@@ -102,6 +113,7 @@ class MultiIndexCache(object):
         assert len(nsides) == 1
         self._healpix = healpixes.pop()
         self._nside = nsides.pop()
+        self.getScaleRanges()  # record them while the indices are loaded
         return self
 
     def read(self):
@@ -132,20 +144,60 @@ class MultiIndexCache(object):
 
     def reload(self):
         """Reload the indices."""
-        if self._loaded:
-            return
-        if self._mi is None:
-            self.read()
-        else:
-            self._mi.reload()
-        self._loaded = True
+        with self._lock:
+            if self._loaded:
+                return
+            if self._mi is None:
+                self.read()
+            else:
+                self._mi.reload()
+            self._loaded = True
 
     def unload(self):
-        """Unload the indices"""
-        if not self._loaded:
-            return
-        self._mi.unload()
-        self._loaded = False
+        """Unload the indices, unless they are pinned"""
+        with self._lock:
+            if not self._loaded or self._pinCount > 0:
+                return
+            self._mi.unload()
+            self._loaded = False
+
+    def pin(self):
+        """Load the indices and keep them loaded (ignoring unload) until a matching unpin"""
+        with self._lock:
+            self.reload()
+            self._pinCount += 1
+
+    def unpin(self):
+        """Undo a pin; the indices are unloaded when the last pin is removed"""
+        with self._lock:
+            if self._pinCount <= 0:
+                raise RuntimeError("MultiIndexCache %s is not pinned" % (self._filenameList[0],))
+            self._pinCount -= 1
+            self.unload()
+
+    def getScaleRanges(self):
+        """!Get the quad scale range of each index
+
+        The ranges are read from the cache if it recorded them, else from the indices
+        (which are loaded if necessary).
+
+        @return a list of (lower, upper) quad scale (arcsec), one per index
+        """
+        if self._scaleRanges is None:
+            self.reload()
+            self._scaleRanges = [(ind.index_scale_lower, ind.index_scale_upper) for ind in self._mi]
+        return self._scaleRanges
+
+    def setScaleRanges(self, scaleRanges):
+        """!Set the quad scale range of each index, e.g. from the cache
+
+        @param[in] scaleRanges  a list of (lower, upper) quad scale (arcsec), one per index
+        """
+        self._scaleRanges = [(float(lower), float(upper)) for lower, upper in scaleRanges]
+
+    def getFilenameList(self):
+        """!Get the filenames: the multiindex star file, then the index files"""
+        return list(self._filenameList)
 
     def isWithinRange(self, coord, distance):
         """!Is the index within range of the provided coordinates?
@@ -184,6 +236,7 @@ class AstrometryNetCatalog(object):
         @param andConfig   Configuration (an AstrometryNetDataConfig)
         """
         self.config = andConfig
+        self._fingerprint = None
         cacheName = getIndexPath(self._cacheFilename)
         if self.config.allowCache and os.path.exists(cacheName):
             self._initFromCache(cacheName)
@@ -202,8 +255,12 @@ class AstrometryNetCatalog(object):
         build the AstrometryNetCatalog quickly.  The first table extension
         contains a row for each multiindex, storing the healpix and nside
         values.  The second table extension contains a row for each filename
-        in all the multiindexes.  The two may be JOINed through the 'id'
-        column.
+        in all the multiindexes, with the quad scale range of the index it
+        holds (NaN for the first filename, the star file).  The two may be
+        JOINed through the 'id' column.  If the multiindexes have density maps (see
+        computeDensityMaps) then a third table extension contains a row for
+        each non-empty healpix of each map, also JOINed through the 'id'
+        column, with the map nside and quantile levels in its header.
         """
         outName = getIndexPath(self._cacheFilename)
         numFilenames = sum(len(ind._filenameList) for ind in self._multiInds)
@@ -221,17 +278,132 @@ class AstrometryNetCatalog(object):
         # Second table
         second = fits.BinTableHDU.from_columns([fits.Column(name="id", format="K"),
                                                 fits.Column(name="filename", format="%dA" % (maxLength)),
+                                                fits.Column(name="scaleLower", format="D"),
+                                                fits.Column(name="scaleUpper", format="D"),
                                                 ], nrows=numFilenames)
         ident = second.data.field("id")
         filenames = second.data.field("filename")
+        scaleLower = second.data.field("scaleLower")
+        scaleUpper = second.data.field("scaleUpper")
         i = 0
         for j, ind in enumerate(self._multiInds):
-            for fn in ind._filenameList:
+            scaleRanges = [(np.nan, np.nan)] + list(ind.getScaleRanges())
+            for k, fn in enumerate(ind._filenameList):
                 ident[i] = j
                 filenames[i] = fn
+                scaleLower[i], scaleUpper[i] = scaleRanges[k] if k < len(scaleRanges) else (np.nan, np.nan)
                 i += 1
 
-        fits.HDUList([fits.PrimaryHDU(), first, second]).writeto(outName, overwrite=True)
+        hduList = [fits.PrimaryHDU(), first, second]
+        if self.hasDensityMaps():
+            hduList.append(self._makeDensityTable())
+        fits.HDUList(hduList).writeto(outName, overwrite=True)
+
+    def _makeDensityTable(self):
+        """Make the cache table extension holding the density maps"""
+        maps = [ind.densityMap for ind in self._multiInds]
+        nside, quantiles = maps[0].nside, maps[0].quantiles
+        pixels = [np.flatnonzero(densityMap.counts) for densityMap in maps]
+        numRows = sum(len(pix) for pix in pixels)
+        table = fits.BinTableHDU.from_columns([fits.Column(name="id", format="K"),
+                                               fits.Column(name="healpix", format="K"),
+                                               fits.Column(name="count", format="K"),
+                                               fits.Column(name="magQuantiles",
+                                                           format="%dD" % (len(quantiles),)),
+                                               ], nrows=numRows, name="DENSITY")
+        table.data.field("id")[:] = np.concatenate([np.full(len(pix), i, dtype=int)
+                                                    for i, pix in enumerate(pixels)])
+        table.data.field("healpix")[:] = np.concatenate(pixels)
+        table.data.field("count")[:] = np.concatenate([densityMap.counts[pix] for densityMap, pix in
+                                                       zip(maps, pixels)])
+        table.data.field("magQuantiles")[:] = np.concatenate(
+            [densityMap.magQuantiles[pix] for densityMap, pix in zip(maps, pixels)]).reshape(numRows, -1)
+        table.header["NSIDE"] = nside
+        table.header["NQUANT"] = len(quantiles)
+        for i, level in enumerate(quantiles):
+            table.header["QUANT%d" % (i,)] = level
+        return table
+
+    def _readDensityTable(self, table):
+        """Set the density maps of the multiindexes from the cache table extension"""
+        nside = int(table.header["NSIDE"])
+        quantiles = [table.header["QUANT%d" % (i,)] for i in range(table.header["NQUANT"])]
+        data = table.data
+        ident = np.asarray(data.field("id"))
+        healpix = np.asarray(data.field("healpix"))
+        count = np.asarray(data.field("count"))
+        magQuantiles = np.asarray(data.field("magQuantiles"), dtype=float).reshape(len(ident), len(quantiles))
+        numPixels = DensityMap.getNumPixels(nside)
+        for i, ind in enumerate(self._multiInds):
+            rows = ident == i
+            counts = np.zeros(numPixels, dtype=np.int64)
+            counts[healpix[rows]] = count[rows]
+            mags = np.full((numPixels, len(quantiles)), np.nan)
+            mags[healpix[rows]] = magQuantiles[rows]
+            ind.densityMap = DensityMap(nside, quantiles, counts, mags)
+
+    def computeDensityMaps(self, nside, quantiles=(0.1, 0.5, 0.9), magColumn=None):
+        """!Compute a density map for each multiindex, from all the reference objects in its
+        star kd-tree
+
+        The multiindexes must be loaded (e.g. with LoadMultiIndexes).
+
+        @param[in] nside  healpix nside of the maps
+        @param[in] quantiles  magnitude quantile levels to record, each in [0, 1]
+        @param[in] magColumn  name of magnitude column in the index files;
+            if None then use the config's defaultMagColumn. Index files without a
+            tag-along table or without this column get maps with counts but no
+            magnitude quantiles (NaN).
+        """
+        if magColumn is None:
+            magColumn = self.config.defaultMagColumn
+        magColumn = magColumn or ""
+        solver = Solver()
+        allSky = afwGeom.SpherePoint(0, 0, afwGeom.degrees)
+        for ind in self._multiInds:
+            try:
+                ra, dec, mag = solver.getStarArrays([ind[0]], allSky, 180*afwGeom.degrees, magColumn)
+            except lsst.pex.exceptions.NotFoundError as e:
+                Log.getDefaultLogger().warn("No magnitudes for the density map of %s: %s",
+                                            ind.getFilenameList()[0], e)
+                ra, dec, mag = solver.getStarArrays([ind[0]], allSky, 180*afwGeom.degrees, "")
+            ind.densityMap = DensityMap.fromArrays(ra, dec, mag, nside, quantiles)
+
+    def hasDensityMaps(self):
+        """!Does every multiindex have a density map?"""
+        return len(self._multiInds) > 0 and all(ind.densityMap is not None for ind in self._multiInds)
+
+    def planSkyCircle(self, ctrCoord, radius):
+        """!Estimate the reference objects in a circular sky region from the density maps
+
+        No index file is read, so this is cheap enough to choose search limits before loading
+        or solving, or to predict the size of a loadSkyCircle result.
+
+        @param[in] ctrCoord  center of region (an afwGeom.SpherePoint)
+        @param[in] radius  radius of region (an afwGeom.Angle)
+        @return an lsst.pipe.base.Struct containing:
+        - multiInds  the multiindexes within range of the region (MultiIndexCache objects)
+        - counts  estimated number of reference objects from each of multiInds (a list of float)
+        - numStars  estimated number of reference objects, the sum of counts; loadSkyCircle removes
+            objects with duplicate IDs, so its result may be smaller if multiindexes share objects
+        - quantiles  the magnitude quantile levels (a numpy array)
+        - magQuantiles  estimated magnitude at each quantile level for each of multiInds
+            (a list of numpy arrays)
+
+        @throw RuntimeError if there are no density maps
+        """
+        if not self.hasDensityMaps():
+            raise RuntimeError("No density maps; regenerate %s with generateCache" % (self._cacheFilename,))
+        multiInds = [ind for ind in self._multiInds if ind.isWithinRange(ctrCoord, radius)]
+        results = [ind.densityMap.query(ctrCoord, radius) for ind in multiInds]
+        counts = [res.numStars for res in results]
+        return pipeBase.Struct(
+            multiInds=multiInds,
+            counts=counts,
+            numStars=sum(counts),
+            quantiles=self._multiInds[0].densityMap.quantiles,
+            magQuantiles=[res.magQuantiles for res in results],
+        )
 
     def _initFromCache(self, filename):
         """Initialise from a cache file
@@ -249,12 +421,56 @@ class AstrometryNetCatalog(object):
                 filenames[id2].append(fn)
             self._multiInds = [MultiIndexCache(filenames[i], hp, nside) for i, hp, nside in
                                zip(first.field("id"), first.field("healpix"), first.field("nside"))]
+            if "scaleLower" in second.columns.names:
+                scaleRanges = {i: [] for i in first.field("id")}
+                for id2, lower, upper in zip(second.field("id"), second.field("scaleLower"),
+                                             second.field("scaleUpper")):
+                    scaleRanges[id2].append((lower, upper))
+                for i, ind in zip(first.field("id"), self._multiInds):
+                    # The first filename is the star file, which has no scale range
+                    ind.setScaleRanges(scaleRanges[i][1:])
+            if len(hduList) > 3:
+                self._readDensityTable(hduList[3])
 
         # Check for consistency
         cacheFiles = set(second.field("filename"))
         configFiles = set(sum(self.config.multiIndexFiles, []) + self.config.indexFiles)
         assert(cacheFiles == configFiles)
 
+    def getIdentity(self):
+        """!Get a string identifying the set of index files
+
+        This depends only on the filenames, so it is the same for any
+        installation of the same astrometry_net_data configuration.
+        """
+        hasher = hashlib.sha1()
+        for ind in self._multiInds:
+            for fn in ind._filenameList:
+                hasher.update(str(fn).encode())
+                hasher.update(b"\0")
+            hasher.update(b"\n")
+        return hasher.hexdigest()
+
+    def getFingerprint(self):
+        """!Get a string identifying the contents of the index files
+
+        This combines the identity with the size and modification time of
+        each file, so it changes if any index file is rewritten.
+        The value is computed on first use and then remembered.
+        """
+        if self._fingerprint is None:
+            hasher = hashlib.sha1(self.getIdentity().encode())
+            for ind in self._multiInds:
+                for fn in ind._filenameList:
+                    path = getIndexPath(fn)
+                    try:
+                        stat = os.stat(path)
+                        hasher.update(("%s %d %d\n" % (path, stat.st_size, stat.st_mtime)).encode())
+                    except OSError:
+                        hasher.update(("%s missing\n" % (path,)).encode())
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
     def __getitem__(self, ii):
         return self._multiInds[ii]
 
@@ -265,14 +481,26 @@ class AstrometryNetCatalog(object):
         return len(self._multiInds)
 
 
-def generateCache(andConfig=None):
-    """Generate a cache file"""
+def generateCache(andConfig=None, densityNside=16, quantiles=(0.1, 0.5, 0.9), magColumn=None):
+    """!Generate a cache file
+
+    @param[in] andConfig  astrometry.net data config (an AstrometryNetDataConfig);
+        if None then read it from the environment
+    @param[in] densityNside  healpix nside of the density maps (see
+        AstrometryNetCatalog.computeDensityMaps); if 0 or None then no maps are made
+    @param[in] quantiles  magnitude quantile levels for the density maps
+    @param[in] magColumn  name of magnitude column for the density maps;
+        if None then use the config's defaultMagColumn; indexes without it
+        get maps without magnitude quantiles
+    """
     if andConfig is None:
         andConfig = getConfigFromEnvironment()
     catalog = AstrometryNetCatalog(andConfig)
     try:
         for index in catalog:
             index.reload()
+        if densityNside:
+            catalog.computeDensityMaps(densityNside, quantiles=quantiles, magColumn=magColumn)
         catalog.writeCache()
     finally:
         for index in catalog:
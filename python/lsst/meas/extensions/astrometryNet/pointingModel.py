@@ -0,0 +1,115 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["PointingModel"]
+
+from builtins import object
+import json
+import math
+import os
+
+import lsst.afw.geom as afwGeom
+from .jsonUtils import writeJsonAtomic
+
+
+class PointingModel(object):
+    """!A persisted model of the pointing error of a telescope
+
+    The pointing error is the offset, in the tangent plane at the commanded
+    position, from the commanded field center (as given by the raw WCS) to
+    the solved field center.  It drifts slowly during a night, so it is
+    tracked with an exponentially-weighted mean and variance, updated from
+    each successful solve.  The model can then correct the commanded center
+    of the next field and say how large a search radius is needed.
+
+    The models for all telescopes are kept in a single JSON file.
+    """
+
+    def __init__(self, filename, telescope, weight=0.3):
+        """!Constructor
+
+        @param[in] filename  name of the JSON file holding the models; it need not exist yet
+        @param[in] telescope  name of the telescope whose model is to be used
+        @param[in] weight  weight of each new measurement in the exponentially-weighted averages
+        """
+        self.filename = filename
+        self.telescope = telescope
+        self.weight = weight
+        self._models = {}
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                self._models = json.load(fd)
+
+    def _getModel(self):
+        return self._models.get(self.telescope)
+
+    def getNumUpdates(self):
+        """!Get the number of solves that have contributed to the model"""
+        model = self._getModel()
+        return 0 if model is None else model["numUpdates"]
+
+    def correct(self, center):
+        """!Apply the mean pointing offset to a commanded field center
+
+        @param[in] center  commanded field center (an afwGeom.SpherePoint)
+        @return corrected field center (an afwGeom.SpherePoint)
+        """
+        model = self._getModel()
+        if model is None:
+            return center
+        xi, eta = model["xi"], model["eta"]
+        if xi == 0 and eta == 0:
+            return center
+        return center.offset(math.atan2(eta, xi)*afwGeom.radians, math.hypot(xi, eta)*afwGeom.arcseconds)
+
+    def getUncertainty(self):
+        """!Get the RMS scatter of the pointing offset about the model (an afwGeom.Angle)"""
+        model = self._getModel()
+        if model is None:
+            return None
+        return math.sqrt(model["varXi"] + model["varEta"])*afwGeom.arcseconds
+
+    def update(self, commanded, solved):
+        """!Update the model with the result of a solve
+
+        @param[in] commanded  commanded field center (an afwGeom.SpherePoint)
+        @param[in] solved  solved field center (an afwGeom.SpherePoint)
+        """
+        xiAngle, etaAngle = commanded.getTangentPlaneOffset(solved)
+        xi, eta = xiAngle.asArcseconds(), etaAngle.asArcseconds()
+        model = self._getModel()
+        if model is None:
+            self._models[self.telescope] = dict(xi=xi, eta=eta, varXi=0.0, varEta=0.0, numUpdates=1)
+            return
+        w = self.weight
+        dXi = xi - model["xi"]
+        dEta = eta - model["eta"]
+        model["xi"] += w*dXi
+        model["eta"] += w*dEta
+        model["varXi"] = (1.0 - w)*(model["varXi"] + w*dXi**2)
+        model["varEta"] = (1.0 - w)*(model["varEta"] + w*dEta**2)
+        model["numUpdates"] += 1
+
+    def write(self):
+        """!Write the models to the file"""
+        writeJsonAtomic(self.filename, self._models, indent=2, sort_keys=True)
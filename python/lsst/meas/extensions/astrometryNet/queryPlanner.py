@@ -0,0 +1,301 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["makePointing", "readPointings", "QueryPlanner"]
+
+from builtins import object
+import argparse
+from collections import Counter, OrderedDict
+import json
+import math
+import os
+
+import lsst.afw.geom as afwGeom
+import lsst.pipe.base as pipeBase
+from .anetBasicAstrometry import ANetBasicAstrometryConfig
+from .astrometryNetDataConfig import AstrometryNetDataConfig
+from .multiindex import AstrometryNetCatalog, getConfigFromEnvironment, getIndexPath
+
+
+def makePointing(name, bbox, wcs=None, pixelScale=None, visit=None):
+    """!Make a description of one field to plan for
+
+    @param[in] name  name of the field, e.g. a data ID string
+    @param[in] bbox  bounding box of the image (an afwGeom.Box2I)
+    @param[in] wcs  initial WCS (an afwGeom.SkyWcs), or None for a blind solve
+    @param[in] pixelScale  pixel scale estimate (an afwGeom.Angle); if None then use that of wcs
+    @param[in] visit  visit the field belongs to, or None; fields of one visit may share an index load
+    @return an lsst.pipe.base.Struct with the same attributes
+    """
+    return pipeBase.Struct(name=name, bbox=bbox, wcs=wcs, pixelScale=pixelScale, visit=visit)
+
+
+def readPointings(filename):
+    """!Read pointings from a JSON file
+
+    The file holds a list of objects, each with these keys:
+    - name  name of the field
+    - bbox  [minX, minY, width, height] of the image (pixels)
+    - ra, dec  ICRS position of the center of the image (deg); omit both for a blind solve
+    - pixelScale  pixel scale (arcsec); required with ra and dec
+    - visit  (optional) visit the field belongs to
+
+    A TAN WCS centered on the image is made from ra, dec and pixelScale.
+
+    @param[in] filename  name of the JSON file
+    @return a list of pointings (see makePointing)
+    """
+    with open(filename) as fd:
+        entries = json.load(fd)
+    pointings = []
+    for entry in entries:
+        minX, minY, width, height = entry["bbox"]
+        bbox = afwGeom.Box2I(afwGeom.Point2I(minX, minY), afwGeom.Extent2I(width, height))
+        pixelScale = entry.get("pixelScale")
+        if pixelScale is not None:
+            pixelScale = pixelScale*afwGeom.arcseconds
+        wcs = None
+        if "ra" in entry:
+            if pixelScale is None:
+                raise RuntimeError("Pointing %s has ra and dec but no pixelScale" % (entry["name"],))
+            wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Box2D(bbox).getCenter(),
+                                     crval=afwGeom.SpherePoint(entry["ra"], entry["dec"], afwGeom.degrees),
+                                     cdMatrix=afwGeom.makeCdMatrix(scale=pixelScale))
+        pointings.append(makePointing(entry["name"], bbox, wcs=wcs, pixelScale=pixelScale,
+                                      visit=entry.get("visit")))
+    return pointings
+
+
+class QueryPlanner(object):
+    """!Predict which astrometry.net data files a workload will read, without solving
+
+    For each pointing the selection of ANetBasicAstrometryTask.determineWcs is replayed:
+    the multi-indexes within config.raDecSearchRadius of the WCS center (as
+    LoadAstrometryNetObjectsTask._getMIndexesWithinRange), then the indexes whose quad scale
+    range overlaps that of the image (as the overlapsScaleRange filter of _solve).
+    Only the healpixes and scale ranges in the catalog's cache are used, so no index file
+    is read if andCache.fits records the scale ranges; file sizes come from the file system.
+
+    The hierarchical coarse pass and the pointing model are not replayed: the coarse pass
+    loads a subset of the same files, and the pointing model can only shrink the search.
+    """
+
+    def __init__(self, catalog, config=None):
+        """!Constructor
+
+        @param[in] catalog  the astrometry.net catalog (an AstrometryNetCatalog)
+        @param[in] config  solver configuration (an ANetBasicAstrometryConfig);
+            if None then use the defaults
+        """
+        self.catalog = catalog
+        self.config = config if config is not None else ANetBasicAstrometryConfig()
+        self._sizes = {}
+
+    def getQuadSizeRange(self, bbox, wcs=None, pixelScale=None):
+        """!Get the quad size range (arcsec) the solver searches for an image
+
+        As Solver.setImageSize and Solver.setPixelScaleRange, with the pixel scale range of
+        _solveArrays (or the loader's default range if there is no pixel scale).
+
+        @param[in] bbox  bounding box of the image (an afwGeom.Box2I)
+        @param[in] wcs  initial WCS (an afwGeom.SkyWcs), or None
+        @param[in] pixelScale  pixel scale estimate (an afwGeom.Angle), or None
+        @return minimum and maximum quad size (arcsec)
+        """
+        if pixelScale is None and wcs is not None and self.config.useWcsPixelScale:
+            pixelScale = wcs.getPixelScale()
+        if pixelScale is not None:
+            scale = pixelScale.asArcseconds()
+            lo = scale/self.config.pixelScaleUncertainty
+            hi = scale*self.config.pixelScaleUncertainty
+        else:
+            lo, hi = 0.01, 3600.
+        width, height = bbox.getDimensions()
+        return 0.1*min(width, height)*lo, math.hypot(width, height)*hi
+
+    def selectFiles(self, bbox, wcs=None, pixelScale=None):
+        """!Get the files a solve of one image would load
+
+        @param[in] bbox  bounding box of the image (an afwGeom.Box2I)
+        @param[in] wcs  initial WCS (an afwGeom.SkyWcs), or None for a blind solve
+        @param[in] pixelScale  pixel scale estimate (an afwGeom.Angle), or None
+        @return the filenames (as in the astrometry.net data config), in load order
+        """
+        multiInds = list(self.catalog)
+        if wcs is not None and self.config.useWcsRaDecCenter:
+            center = wcs.pixelToSky(afwGeom.Box2D(bbox).getCenter())
+            radius = self.config.raDecSearchRadius*afwGeom.degrees
+            multiInds = [mi for mi in multiInds if mi.isWithinRange(center, radius)]
+        qlo, qhi = self.getQuadSizeRange(bbox, wcs=wcs, pixelScale=pixelScale)
+
+        filenames = OrderedDict()
+        for mi in multiInds:
+            filenameList = mi.getFilenameList()
+            # index_overlaps_scale_range
+            chosen = [filenameList[i + 1] for i, (lower, upper) in enumerate(mi.getScaleRanges())
+                      if not (qlo > upper or qhi < lower)]
+            if chosen:
+                for fn in [filenameList[0]] + chosen:
+                    filenames[fn] = None
+        return list(filenames)
+
+    def getFileSize(self, filename):
+        """!Get the size of a file in bytes; 0 if it does not exist"""
+        size = self._sizes.get(filename)
+        if size is None:
+            try:
+                size = os.path.getsize(getIndexPath(filename))
+            except OSError:
+                size = 0
+            self._sizes[filename] = size
+        return size
+
+    def _getBytes(self, filenames):
+        return sum(self.getFileSize(fn) for fn in filenames)
+
+    def plan(self, pointings):
+        """!Plan a workload
+
+        Memory is estimated as the total size of the files loaded at once, since the index
+        files are memory mapped and the solver may touch any part of them; a worker holds one
+        pointing's files at a time, or one visit's if the visit is solved as a batch.
+
+        @param[in] pointings  the fields to plan for (see makePointing)
+        @return an lsst.pipe.base.Struct containing:
+        - files  filenames loaded for each pointing (a list of lists, in the order of pointings)
+        - accessCounts  number of pointings loading each file (a collections.Counter)
+        - fileBytes  size of each file touched (a dict of filename: bytes)
+        - missingFiles  files touched that do not exist (a sorted list)
+        - totalBytes  total size of the distinct files touched
+        - pointingBytes  size of the files loaded for each pointing (a list)
+        - peakBytes  largest of pointingBytes: the peak resident set of a worker solving
+            one pointing at a time
+        - peakVisitBytes  size of the files loaded by the largest visit, for a worker solving
+            each visit as a batch (0 if no pointing has a visit)
+        - order  suggested order of the pointings (a list of indices into pointings)
+            that keeps consecutive pointings on the same files
+        - loadBytes  bytes loaded working in the given order, counting only files not
+            loaded for the previous pointing
+        - orderedLoadBytes  as loadBytes, working in the suggested order
+        """
+        files = [self.selectFiles(p.bbox, wcs=p.wcs, pixelScale=p.pixelScale) for p in pointings]
+        accessCounts = Counter(fn for fileList in files for fn in fileList)
+        fileBytes = {fn: self.getFileSize(fn) for fn in accessCounts}
+        missingFiles = sorted(fn for fn in accessCounts if not os.path.exists(getIndexPath(fn)))
+        pointingBytes = [self._getBytes(fileList) for fileList in files]
+
+        visitFiles = {}
+        for p, fileList in zip(pointings, files):
+            if p.visit is not None:
+                visitFiles.setdefault(p.visit, set()).update(fileList)
+        peakVisitBytes = max([self._getBytes(fns) for fns in visitFiles.values()] or [0])
+
+        order = self._getOrder(files)
+        return pipeBase.Struct(
+            files=files,
+            accessCounts=accessCounts,
+            fileBytes=fileBytes,
+            missingFiles=missingFiles,
+            totalBytes=sum(fileBytes.values()),
+            pointingBytes=pointingBytes,
+            peakBytes=max(pointingBytes or [0]),
+            peakVisitBytes=peakVisitBytes,
+            order=order,
+            loadBytes=self._getLoadBytes(files, range(len(files))),
+            orderedLoadBytes=self._getLoadBytes(files, order),
+        )
+
+    def _getLoadBytes(self, files, order):
+        """Get the bytes loaded working through pointings in order, reusing the previous load"""
+        total = 0
+        previous = set()
+        for i in order:
+            current = set(files[i])
+            total += self._getBytes(current - previous)
+            previous = current
+        return total
+
+    def _getOrder(self, files):
+        """Order pointings so consecutive ones share as many bytes of files as possible
+
+        Pointings with the same files are kept together (in their given order); the groups
+        are then chained greedily, each followed by the remaining group sharing the most bytes
+        with it, starting from the group with the most bytes.
+        """
+        groups = OrderedDict()
+        for i, fileList in enumerate(files):
+            groups.setdefault(frozenset(fileList), []).append(i)
+        remaining = list(groups)
+        if not remaining:
+            return []
+        current = max(remaining, key=self._getBytes)
+        order = []
+        while True:
+            remaining.remove(current)
+            order += groups[current]
+            if not remaining:
+                return order
+            previous = current
+            current = max(remaining, key=lambda fns: self._getBytes(fns & previous))
+
+
+def main(argv=None):
+    """!Command-line interface: print the plan for the pointings in a JSON file (see readPointings)"""
+    parser = argparse.ArgumentParser(description="Predict the astrometry.net data files, bytes and "
+                                     "memory used to solve a list of pointings, without solving")
+    parser.add_argument("pointings", help="JSON file of pointings")
+    parser.add_argument("--andConfig", default=None,
+                        help="astrometry.net data config file (default: andConfig.py of astrometry_net_data)")
+    parser.add_argument("--config", default=None, help="ANetBasicAstrometryConfig override file")
+    parser.add_argument("--numFiles", type=int, default=20, help="number of most used files to list")
+    parser.add_argument("--showOrder", action="store_true", help="list the pointings in suggested order")
+    args = parser.parse_args(argv)
+
+    if args.andConfig is None:
+        andConfig = getConfigFromEnvironment()
+    else:
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(args.andConfig)
+    config = ANetBasicAstrometryConfig()
+    if args.config is not None:
+        config.load(args.config)
+
+    pointings = readPointings(args.pointings)
+    plan = QueryPlanner(AstrometryNetCatalog(andConfig), config=config).plan(pointings)
+
+    megabyte = 1024.0**2
+    print("%d pointings touch %d files, %.1f MB in total" %
+          (len(pointings), len(plan.accessCounts), plan.totalBytes/megabyte))
+    print("peak per worker: %.1f MB per pointing, %.1f MB per visit batch" %
+          (plan.peakBytes/megabyte, plan.peakVisitBytes/megabyte))
+    print("bytes loaded: %.1f MB in given order, %.1f MB in suggested order" %
+          (plan.loadBytes/megabyte, plan.orderedLoadBytes/megabyte))
+    for fn in plan.missingFiles:
+        print("missing file: %s" % (fn,))
+    print("%8s %10s  %s" % ("accesses", "MB", "file"))
+    for fn, count in plan.accessCounts.most_common(args.numFiles):
+        print("%8d %10.1f  %s" % (count, plan.fileBytes[fn]/megabyte, fn))
+    if args.showOrder:
+        print("suggested order:")
+        for i in plan.order:
+            print("  %s" % (pointings[i].name,))
@@ -0,0 +1,242 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["TanSipFitter", "fitTanSip"]
+
+from builtins import object
+from builtins import range
+import math
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.pex.exceptions as pexExceptions
+import lsst.pipe.base as pipeBase
+from .wcsUtils import skyToTangentPlaneArrays
+
+
+def _polynomialTerms(order, minOrder):
+    """Return the exponents (p, q) of the terms u^p v^q with minOrder <= p + q <= order"""
+    return [(p, q) for p in range(order + 1) for q in range(order + 1 - p) if p + q >= minOrder]
+
+
+def _makeDesign(u, v, terms):
+    """Return the design matrix of the polynomial terms, one row per position"""
+    return np.column_stack([u**p*v**q for p, q in terms]) if len(u) else np.zeros((0, len(terms)))
+
+
+def _binomial(n, k):
+    """Return the binomial coefficient n choose k"""
+    return math.factorial(n)//(math.factorial(k)*math.factorial(n - k))
+
+
+def _evaluatePolynomial(terms, coeffs, u, v, du=0, dv=0):
+    """Return the polynomial with one row of coeffs per term, or its first derivative
+    in u (du=1) or v (dv=1), at the position (u, v)"""
+    value = np.zeros(coeffs.shape[1])
+    for (p, q), coeff in zip(terms, coeffs):
+        if p >= du and q >= dv:
+            value += coeff*(p if du else 1)*(q if dv else 1)*u**(p - du)*v**(q - dv)
+    return value
+
+
+def _findZero(terms, coeffs, maxIter=10, tolerance=1e-10):
+    """Return the position (u, v) at which the polynomial vanishes, found by Newton's method
+    starting at the origin
+
+    @throw numpy.linalg.LinAlgError if the Jacobian is singular
+    """
+    position = np.zeros(2)
+    for i in range(maxIter):
+        value = _evaluatePolynomial(terms, coeffs, *position)
+        jacobian = np.column_stack([_evaluatePolynomial(terms, coeffs, *position, du=1),
+                                    _evaluatePolynomial(terms, coeffs, *position, dv=1)])
+        step = np.linalg.solve(jacobian, value)
+        position -= step
+        if np.max(np.abs(step)) < tolerance:
+            break
+    return position
+
+
+def _shiftPolynomial(terms, coeffs, u0, v0):
+    """Return the coefficients of the polynomial re-expanded about (u0, v0)
+
+    terms must include every term of order up to that of the highest.
+    """
+    index = dict((term, i) for i, term in enumerate(terms))
+    shifted = np.zeros_like(coeffs)
+    for (p, q), coeff in zip(terms, coeffs):
+        for i in range(p + 1):
+            for j in range(q + 1):
+                shifted[index[(i, j)]] += coeff*_binomial(p, i)*_binomial(q, j)*u0**(p - i)*v0**(q - j)
+    return shifted
+
+
+def _makeSipMatrix(terms, coeffs, order):
+    """Return the SIP coefficient matrix M[p, q] for the given terms"""
+    matrix = np.zeros((order + 1, order + 1))
+    for (p, q), coeff in zip(terms, coeffs):
+        matrix[p, q] = coeff
+    return matrix
+
+
+class TanSipFitter(object):
+    """!Linear least-squares fitter for a TAN-SIP WCS
+
+    The TAN-SIP WCS maps pixel offsets (u, v) from CRPIX to standard
+    coordinates (xi, eta) at CRVAL as
+        (xi, eta) = CD (u + A(u, v), v + B(u, v))
+    which is linear in the combined coefficients of CD and CD (A, B), so
+    both are found together by one least-squares solve for xi and eta.
+    A constant term is fit too, to absorb a zero-point offset of the initial
+    WCS; it is folded into CRPIX by moving CRPIX to the pixel that the fit
+    maps to CRVAL and re-expanding the polynomial about it, as
+    lsst.meas.astrom.sip.makeCreateWcsWithSip shifts CRPIX.
+    The reverse coefficients (AP, BP) are then fit to the forward
+    distortion sampled on a grid over the bounding box.
+
+    The design matrix depends only on the source positions and CRPIX, so it
+    is built once by the constructor; each call to fit selects its rows, so
+    a fitter may be reused as the matches change while iterating.
+    Positions are scaled to about unity before fitting, for numerical stability.
+    """
+
+    def __init__(self, x, y, crpix, order, reverseOrder=None):
+        """!Constructor
+
+        @param[in] x  x positions of the sources (pixels); array-like
+        @param[in] y  y positions of the sources (pixels); array-like
+        @param[in] crpix  initial reference pixel (an afwGeom.Point2D); the fit WCS has the
+            reference pixel that maps to its CRVAL
+        @param[in] order  polynomial order of the forward SIP terms (at least 2)
+        @param[in] reverseOrder  polynomial order of the reverse SIP terms; None for order + 1
+        """
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.crpix = afwGeom.Point2D(crpix)
+        self.order = order
+        self.reverseOrder = order + 1 if reverseOrder is None else reverseOrder
+        u = self.x - self.crpix.getX()
+        v = self.y - self.crpix.getY()
+        self._scale = max(np.max(np.abs(u)) if len(u) else 0, np.max(np.abs(v)) if len(v) else 0, 1.0)
+        self._terms = _polynomialTerms(order, 0)
+        self._design = _makeDesign(u/self._scale, v/self._scale, self._terms)
+        self._termScale = np.array([self._scale**(p + q) for p, q in self._terms])
+
+    def fit(self, ra, dec, crval, rows=None, bbox=None):
+        """!Fit a TAN-SIP WCS
+
+        @param[in] ra  RA of the reference objects (radians), one per selected row
+        @param[in] dec  Dec of the reference objects (radians), one per selected row
+        @param[in] crval  tangent point (an afwGeom.SpherePoint)
+        @param[in] rows  indices (or a boolean mask) of the source positions matched to ra, dec;
+            None for all positions, in order
+        @param[in] bbox  bounding box over which the reverse SIP terms are fit (an afwGeom.Box2I
+            or Box2D); None or empty for the bounding box of the positions used
+
+        @return an lsst.pipe.base.Struct containing:
+        - wcs  the TAN-SIP WCS (an lsst.afw.geom.SkyWcs), with CRVAL crval
+        - scatterOnSky  rms of the residuals on the sky (an afwGeom.Angle)
+        - scatterInPixels  rms of the residuals in pixels
+        - numPoints  number of matches used
+
+        @throw lsst.pex.exceptions.LengthError if there are too few matches for the order
+        @throw lsst.pex.exceptions.RuntimeError if the fit is degenerate (e.g. a singular CD matrix,
+            as from sources along a line)
+        """
+        design = self._design if rows is None else self._design[rows]
+        numPoints = design.shape[0]
+        if numPoints < len(self._terms):
+            raise pexExceptions.LengthError("Too few matches (%d) to fit SIP order %d; need %d" %
+                                            (numPoints, self.order, len(self._terms)))
+        xi, eta = skyToTangentPlaneArrays(ra, dec, crval)
+        rhs = np.degrees(np.column_stack([xi, eta]))
+        linear = [self._terms.index((1, 0)), self._terms.index((0, 1))]
+        try:
+            coeffs, _, _, _ = np.linalg.lstsq(design, rhs, rcond=None)
+            residuals = rhs - design.dot(coeffs)
+            coeffs /= self._termScale[:, np.newaxis]
+            offset = _findZero(self._terms, coeffs)
+            coeffs = _shiftPolynomial(self._terms, coeffs, *offset)
+            crpix = self.crpix + afwGeom.Extent2D(*offset)
+            cdMatrix = coeffs[linear].T
+            cdInverse = np.linalg.inv(cdMatrix)
+        except np.linalg.LinAlgError as e:
+            raise pexExceptions.RuntimeError("Unable to fit SIP order %d to %d matches: %s" %
+                                             (self.order, numPoints, e))
+        higher = [i for i, (p, q) in enumerate(self._terms) if p + q >= 2]
+        higherTerms = [self._terms[i] for i in higher]
+        sipAB = cdInverse.dot(coeffs[higher].T)
+        sipA = _makeSipMatrix(higherTerms, sipAB[0], self.order)
+        sipB = _makeSipMatrix(higherTerms, sipAB[1], self.order)
+
+        if bbox is None or bbox.isEmpty():
+            x = self.x if rows is None else self.x[rows]
+            y = self.y if rows is None else self.y[rows]
+            bbox = afwGeom.Box2D(afwGeom.Point2D(x.min(), y.min()), afwGeom.Point2D(x.max(), y.max()))
+        sipAp, sipBp = self._fitReverse(afwGeom.Box2D(bbox), crpix, higherTerms, sipAB)
+
+        wcs = afwGeom.makeTanSipWcs(crpix, crval, cdMatrix, sipA, sipB, sipAp, sipBp)
+        scatterOnSky = np.sqrt(np.mean(np.sum(residuals**2, axis=1)))*afwGeom.degrees
+        pixelResiduals = cdInverse.dot(residuals.T)
+        scatterInPixels = float(np.sqrt(np.mean(np.sum(pixelResiduals**2, axis=0))))
+        return pipeBase.Struct(
+            wcs=wcs,
+            scatterOnSky=scatterOnSky,
+            scatterInPixels=scatterInPixels,
+            numPoints=numPoints,
+        )
+
+    def _fitReverse(self, bbox, crpix, higherTerms, sipAB):
+        """Fit the reverse SIP terms about crpix to the forward distortion sampled on a grid over bbox"""
+        reverseTerms = _polynomialTerms(self.reverseOrder, 0)
+        numGrid = 5*(self.reverseOrder + 1)
+        u, v = np.meshgrid(np.linspace(bbox.getMinX(), bbox.getMaxX(), numGrid) - crpix.getX(),
+                           np.linspace(bbox.getMinY(), bbox.getMaxY(), numGrid) - crpix.getY())
+        u, v = u.ravel(), v.ravel()
+        forward = _makeDesign(u, v, higherTerms).dot(sipAB.T)
+        uu = u + forward[:, 0]
+        vv = v + forward[:, 1]
+        scale = max(np.max(np.abs(uu)), np.max(np.abs(vv)), 1.0)
+        design = _makeDesign(uu/scale, vv/scale, reverseTerms)
+        coeffs, _, _, _ = np.linalg.lstsq(design, np.column_stack([u - uu, v - vv]), rcond=None)
+        coeffs /= np.array([scale**(p + q) for p, q in reverseTerms])[:, np.newaxis]
+        return (_makeSipMatrix(reverseTerms, coeffs[:, 0], self.reverseOrder),
+                _makeSipMatrix(reverseTerms, coeffs[:, 1], self.reverseOrder))
+
+
+def fitTanSip(matches, initialWcs, order, bbox=None):
+    """!Fit a TAN-SIP WCS to matches, with the tangent point of an initial WCS
+
+    A replacement for lsst.meas.astrom.sip.makeCreateWcsWithSip.
+
+    @param[in] matches  matches (a MatchArrays)
+    @param[in] initialWcs  initial WCS, whose CRVAL is kept and whose CRPIX is refit
+    @param[in] order  polynomial order of the forward SIP terms
+    @param[in] bbox  bounding box over which the reverse SIP terms are fit; None for the
+        bounding box of the matched sources
+
+    @return as for TanSipFitter.fit
+    """
+    fitter = TanSipFitter(matches.srcX, matches.srcY, initialWcs.getPixelOrigin(), order)
+    return fitter.fit(matches.refRa, matches.refDec, initialWcs.getSkyOrigin(), bbox=bbox)
@@ -0,0 +1,123 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["SipWarmStartCache"]
+
+from builtins import object
+import json
+import os
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+from .jsonUtils import writeJsonAtomic
+
+
+class SipWarmStartCache(object):
+    """!A persisted cache of the last good SIP distortion of each detector and filter
+
+    The SIP terms of a detector describe its optical distortion, which
+    changes little from visit to visit, whereas the linear part of the WCS
+    (CRVAL and the CD matrix) changes with every pointing. So an entry holds
+    only CRPIX and the SIP matrices; makeSeedWcs combines them with the
+    linear part of a new TAN solution to make a starting point for fitting.
+
+    Each entry also records the number of fit iterations needed when starting
+    from a TAN WCS, so that the iterations saved by starting from the cached
+    distortion can be counted.
+
+    The entries for all detectors are kept in a single JSON file.
+    """
+
+    def __init__(self, filename):
+        """!Constructor
+
+        @param[in] filename  name of the JSON file holding the entries; it need not exist yet
+        """
+        self.filename = filename
+        self._entries = {}
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                self._entries = json.load(fd)
+
+    @staticmethod
+    def _makeKey(detectorName, filterName):
+        return "%s/%s" % (detectorName, filterName)
+
+    def get(self, detectorName, filterName):
+        """!Get the cached entry for a detector and filter, or None"""
+        return self._entries.get(self._makeKey(detectorName, filterName))
+
+    def getColdIterations(self, detectorName, filterName):
+        """!Get the number of iterations of the last fit started from a TAN WCS, or None"""
+        entry = self.get(detectorName, filterName)
+        return None if entry is None else entry["coldIterations"]
+
+    def makeSeedWcs(self, detectorName, filterName, tanWcs):
+        """!Make a TAN-SIP WCS from the cached distortion and the linear part of a TAN WCS
+
+        @param[in] detectorName  name of the detector
+        @param[in] filterName  name of the filter
+        @param[in] tanWcs  TAN WCS for the exposure (an lsst.afw.geom.SkyWcs)
+        @return the seed WCS, or None if there is no entry for the detector and filter
+        """
+        entry = self.get(detectorName, filterName)
+        if entry is None:
+            return None
+        crpix = afwGeom.Point2D(*entry["crpix"])
+        crval = tanWcs.pixelToSky(crpix)
+        cdMatrix = tanWcs.getCdMatrix(crpix)
+        matrices = [np.array(entry[name], dtype=float) for name in ("sipA", "sipB", "sipAp", "sipBp")]
+        return afwGeom.makeTanSipWcs(crpix, crval, cdMatrix, *matrices)
+
+    def update(self, detectorName, filterName, sipWcs, numIterations, warm):
+        """!Record the distortion of a successful SIP fit
+
+        @param[in] detectorName  name of the detector
+        @param[in] filterName  name of the filter
+        @param[in] sipWcs  fitted TAN-SIP WCS (an lsst.afw.geom.SkyWcs)
+        @param[in] numIterations  number of fit iterations
+        @param[in] warm  was the fit started from the cached distortion?
+        @return False if sipWcs has no reverse SIP terms (so nothing was recorded), else True
+        """
+        metadata = sipWcs.getFitsMetadata()
+        if not all(afwGeom.hasSipMatrix(metadata, name) for name in ("A", "B", "AP", "BP")):
+            return False
+        key = self._makeKey(detectorName, filterName)
+        previous = self._entries.get(key)
+        coldIterations = numIterations
+        if warm and previous is not None:
+            coldIterations = previous["coldIterations"]
+        entry = dict(
+            crpix=list(sipWcs.getPixelOrigin()),
+            coldIterations=coldIterations,
+            numUpdates=1 if previous is None else previous["numUpdates"] + 1,
+        )
+        for name, matrixName in (("sipA", "A"), ("sipB", "B"), ("sipAp", "AP"), ("sipBp", "BP")):
+            entry[name] = afwGeom.getSipMatrixFromMetadata(metadata, matrixName).tolist()
+        self._entries[key] = entry
+        return True
+
+    def write(self):
+        """!Write the entries to the file"""
+        writeJsonAtomic(self.filename, self._entries, indent=2, sort_keys=True)
@@ -0,0 +1,160 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["SkyMatcher"]
+
+from builtins import object
+
+import numpy as np
+
+import lsst.pipe.base as pipeBase
+from .wcsUtils import pixelToSkyArrays, separationArrays, skyToTangentPlaneArrays
+
+
+class SkyMatcher(object):
+    """!Match sources to reference objects on the sky, with one index over the references per field
+
+    The reference objects are projected once onto a tangent plane at the
+    field center and hashed into a grid of cells the size of the match
+    radius. Each call to match then only projects the (possibly moved)
+    source positions and looks in the 3x3 cells around each, so the same
+    matcher may be reused for each iteration of a WCS fit.
+
+    Matches are one-to-one: each source is paired with its nearest reference
+    object within the radius, and where several sources pick the same
+    reference object only the nearest is kept.
+    """
+
+    def __init__(self, refRa, refDec, center, radius):
+        """!Constructor
+
+        @param[in] refRa  RA of the reference objects (radians); array-like
+        @param[in] refDec  Dec of the reference objects (radians); array-like
+        @param[in] center  center of the field (an afwGeom.SpherePoint)
+        @param[in] radius  match radius (an afwGeom.Angle)
+        """
+        self.refRa = np.asarray(refRa, dtype=float)
+        self.refDec = np.asarray(refDec, dtype=float)
+        self.center = center
+        self.radius = radius.asRadians()
+
+        xi, eta = skyToTangentPlaneArrays(self.refRa, self.refDec, self.center)
+        finite = np.isfinite(xi) & np.isfinite(eta)
+        cellX, cellY = self._getCells(xi, eta)
+        cells = self._combine(cellX, cellY)
+        # Sort finite references by cell, so each cell is a contiguous range
+        order = np.flatnonzero(finite)
+        order = order[np.argsort(cells[order], kind="mergesort")]
+        self._order = order
+        self._sortedCells = cells[order]
+        self._xi = xi
+        self._eta = eta
+
+    @classmethod
+    def fromCatalog(cls, refCat, center, radius):
+        """!Construct from a reference catalog with a "coord" field
+
+        Match indices refer to positions in refCat.
+        """
+        if not refCat.isContiguous():
+            refCat = refCat.copy(deep=True)
+        return cls(refCat["coord_ra"], refCat["coord_dec"], center, radius)
+
+    def _getCells(self, xi, eta):
+        with np.errstate(invalid="ignore"):
+            cellX = np.floor(np.where(np.isfinite(xi), xi, 0)/self.radius).astype(np.int64)
+            cellY = np.floor(np.where(np.isfinite(eta), eta, 0)/self.radius).astype(np.int64)
+        return cellX, cellY
+
+    @staticmethod
+    def _combine(cellX, cellY):
+        # Pack two cell indices into one sortable integer
+        return (cellX << 32) + cellY
+
+    def match(self, ra, dec):
+        """!Match sky positions to the reference objects
+
+        @param[in] ra  RA of the sources (radians); array-like
+        @param[in] dec  Dec of the sources (radians); array-like
+        @return an lsst.pipe.base.Struct containing numpy arrays of equal length:
+        - refIndex  index of the matched reference object
+        - srcIndex  index of the matched source
+        - distance  angular separation (radians)
+        """
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        xi, eta = skyToTangentPlaneArrays(ra, dec, self.center)
+        good = np.flatnonzero(np.isfinite(xi) & np.isfinite(eta))
+        cellX, cellY = self._getCells(xi[good], eta[good])
+
+        srcList, refList = [], []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                query = self._combine(cellX + dx, cellY + dy)
+                start = np.searchsorted(self._sortedCells, query, side="left")
+                end = np.searchsorted(self._sortedCells, query, side="right")
+                counts = end - start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                # Expand each source's range of candidate references
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                srcList.append(np.repeat(good, counts))
+                refList.append(self._order[np.repeat(start, counts) + offsets])
+
+        if not srcList:
+            return self._makeResult(np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+        srcIndex = np.concatenate(srcList)
+        refIndex = np.concatenate(refList)
+        dist2 = (xi[srcIndex] - self._xi[refIndex])**2 + (eta[srcIndex] - self._eta[refIndex])**2
+        within = dist2 < self.radius**2
+        srcIndex, refIndex, dist2 = srcIndex[within], refIndex[within], dist2[within]
+
+        # Nearest reference for each source, then nearest source for each reference
+        order = np.argsort(dist2, kind="mergesort")
+        srcIndex, refIndex = srcIndex[order], refIndex[order]
+        first = np.unique(srcIndex, return_index=True)[1]
+        srcIndex, refIndex = srcIndex[first], refIndex[first]
+        dist2 = dist2[order][first]
+        order = np.argsort(dist2, kind="mergesort")
+        srcIndex, refIndex = srcIndex[order], refIndex[order]
+        first = np.sort(np.unique(refIndex, return_index=True)[1])
+        srcIndex, refIndex = srcIndex[first], refIndex[first]
+
+        distance = separationArrays(ra[srcIndex], dec[srcIndex], self.refRa[refIndex], self.refDec[refIndex])
+        return self._makeResult(refIndex, srcIndex, distance)
+
+    def matchPixels(self, x, y, wcs):
+        """!Match pixel positions, mapped to the sky with a WCS, to the reference objects
+
+        @param[in] x  x positions of the sources (pixels); array-like
+        @param[in] y  y positions of the sources (pixels); array-like
+        @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+        @return as for match
+        """
+        ra, dec = pixelToSkyArrays(wcs, x, y)
+        return self.match(ra, dec)
+
+    @staticmethod
+    def _makeResult(refIndex, srcIndex, distance):
+        return pipeBase.Struct(refIndex=refIndex, srcIndex=srcIndex, distance=distance)
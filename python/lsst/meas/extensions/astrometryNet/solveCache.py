@@ -0,0 +1,152 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["SolveCache"]
+
+from builtins import object
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import lsst.daf.base as dafBase
+import lsst.afw.geom as afwGeom
+from lsst.log import Log
+from .jsonUtils import writeJsonAtomic
+
+
+class SolveCache(object):
+    """!A persistent on-disk cache of astrometry.net solutions
+
+    Each entry is a small JSON file in a local directory, named by a hash of
+    everything that determines the result of a solve: the positions and
+    fluxes of the stars given to the solver, the image bounding box, the
+    scale, RA,Dec and parity hints, the solver settings and the identity of
+    the set of index files.  An entry holds the TAN WCS and the solve
+    statistics (see Solver.getSolveStats), and also the fingerprint of the
+    index files it was made with; an entry whose fingerprint does not match
+    the current index files is removed rather than returned.
+    """
+
+    def __init__(self, directory):
+        """!Constructor
+
+        @param[in] directory  directory holding the cache entries; created if necessary
+        """
+        self.directory = directory
+        self.log = Log.getLogger("meas.astrom.astrometry_net.solveCache")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def makeKey(x, y, flux, bbox, pixelScale, radecCenter, searchRadius, parity, indexIdentity,
+                extra=()):
+        """!Compute the cache key for a solve
+
+        @param[in] x  x positions of the stars given to the solver (array of float)
+        @param[in] y  y positions of the stars given to the solver (array of float)
+        @param[in] flux  fluxes of the stars given to the solver (array of float)
+        @param[in] bbox  image bounding box (an afwGeom.Box2I)
+        @param[in] pixelScale  pixel scale estimate (an afwGeom.Angle), or None
+        @param[in] radecCenter  RA,Dec center estimate (an afwGeom.SpherePoint), or None
+        @param[in] searchRadius  search radius (an afwGeom.Angle), or None
+        @param[in] parity  True for flipped, False for normal, or None
+        @param[in] indexIdentity  identity of the index set (see AstrometryNetCatalog.getIdentity)
+        @param[in] extra  sequence of any other values that affect the solution (e.g. solver config)
+        @return the key, a string
+        """
+        hasher = hashlib.sha1()
+        for arr in (x, y, flux):
+            hasher.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        params = [
+            tuple(bbox.getMin()) + tuple(bbox.getDimensions()),
+            None if pixelScale is None else pixelScale.asArcseconds(),
+            None if radecCenter is None else (radecCenter.getLongitude().asDegrees(),
+                                              radecCenter.getLatitude().asDegrees()),
+            None if searchRadius is None else searchRadius.asDegrees(),
+            parity,
+            indexIdentity,
+        ] + list(extra)
+        hasher.update(repr(params).encode())
+        return hasher.hexdigest()
+
+    def _getPath(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key, indexFingerprint):
+        """!Look up a solution
+
+        @param[in] key  cache key (see makeKey)
+        @param[in] indexFingerprint  fingerprint of the current index files
+            (see AstrometryNetCatalog.getFingerprint)
+        @return (wcs, solveStats) if found, else None
+        """
+        path = self._getPath(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as fd:
+                entry = json.load(fd)
+        except (IOError, OSError, ValueError) as e:
+            self.log.warn("Unable to read solve cache entry %s: %s", path, e)
+            return None
+
+        if entry.get("indexFingerprint") != indexFingerprint:
+            self.log.debug("Removing solve cache entry %s made with different index files", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        wcs = afwGeom.makeSkyWcs(_propertyListFromItems(entry["wcs"]))
+        return wcs, _propertyListFromItems(entry["solveStats"])
+
+    def put(self, key, indexFingerprint, wcs, solveStats):
+        """!Store a solution
+
+        @param[in] key  cache key (see makeKey)
+        @param[in] indexFingerprint  fingerprint of the current index files
+        @param[in] wcs  TAN WCS found by the solver (an afwGeom.SkyWcs)
+        @param[in] solveStats  solve statistics (an lsst.daf.base.PropertyList)
+        """
+        entry = dict(
+            indexFingerprint=indexFingerprint,
+            wcs=_propertyListToItems(wcs.getFitsMetadata()),
+            solveStats=_propertyListToItems(solveStats),
+        )
+        writeJsonAtomic(self._getPath(key), entry)
+
+
+def _propertyListToItems(propertyList):
+    """Convert a PropertyList of scalars to an ordered list of (name, value) pairs"""
+    return [(name, propertyList.get(name)) for name in propertyList.names()]
+
+
+def _propertyListFromItems(items):
+    """Convert the output of _propertyListToItems back to a PropertyList"""
+    propertyList = dafBase.PropertyList()
+    for name, value in items:
+        propertyList.set(name, value)
+    return propertyList
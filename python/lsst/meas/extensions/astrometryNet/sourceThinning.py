@@ -0,0 +1,58 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["selectBrightestPerCell"]
+
+import numpy as np
+
+
+def selectBrightestPerCell(x, y, flux, bbox, numCells, numPerCell):
+    """!Select the brightest sources in each cell of a regular grid over an image
+
+    Sources outside bbox are assigned to the nearest edge cell.
+
+    @param[in] x  x positions of the sources (pixels); a numpy array
+    @param[in] y  y positions of the sources (pixels); a numpy array
+    @param[in] flux  fluxes of the sources; a numpy array
+    @param[in] bbox  bounding box of the image (an afwGeom.Box2I or Box2D)
+    @param[in] numCells  number of cells along each axis of the image
+    @param[in] numPerCell  maximum number of sources to keep in each cell
+    @return indices of the selected sources, in increasing order (a numpy array of int)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    if len(x) == 0:
+        return np.zeros(0, dtype=int)
+
+    x0, y0 = bbox.getMinX(), bbox.getMinY()
+    width, height = bbox.getWidth(), bbox.getHeight()
+    cellX = np.clip(np.floor((x - x0)*numCells/width).astype(int), 0, numCells - 1)
+    cellY = np.clip(np.floor((y - y0)*numCells/height).astype(int), 0, numCells - 1)
+    cell = cellY*numCells + cellX
+
+    # Sort by cell, then by decreasing flux within each cell (NaN fluxes last)
+    order = np.lexsort((-np.where(np.isnan(flux), -np.inf, flux), cell))
+    sortedCell = cell[order]
+    rank = np.arange(len(order)) - np.searchsorted(sortedCell, sortedCell, side="left")
+    return np.sort(order[rank < numPerCell])
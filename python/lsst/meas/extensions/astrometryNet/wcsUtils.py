@@ -0,0 +1,130 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsstcorp.org/).
+# See the COPYRIGHT file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""Array versions of common WCS operations
+
+Each transforms a whole array of positions in one call to the WCS's
+underlying transform, rather than one call per position.
+Sky positions are ICRS RA, Dec in radians.
+"""
+from __future__ import absolute_import, division, print_function
+
+__all__ = ["coordsToArrays", "skyToPixelArrays", "pixelToSkyArrays", "separationArrays",
+           "skyToTangentPlaneArrays", "setSourceCoords"]
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+
+
+def coordsToArrays(coords):
+    """!Get RA and Dec arrays (radians) from a sequence of afwGeom.SpherePoint
+
+    @param[in] coords  sequence of afwGeom.SpherePoint
+    @return RA and Dec (radians), as two numpy arrays
+    """
+    radec = np.array([(coord.getLongitude().asRadians(), coord.getLatitude().asRadians())
+                      for coord in coords], dtype=float).reshape(-1, 2)
+    return radec[:, 0], radec[:, 1]
+
+
+def skyToPixelArrays(wcs, ra, dec):
+    """!Convert sky positions to pixel positions
+
+    @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+    @param[in] ra  RA (radians); array-like
+    @param[in] dec  Dec (radians); array-like
+    @return x and y pixel positions, as two numpy arrays
+    """
+    ra = np.asarray(ra, dtype=float)
+    if len(ra) == 0:
+        return np.zeros(0), np.zeros(0)
+    pixels = wcs.getTransform().applyInverse(np.array([ra, np.asarray(dec, dtype=float)]))
+    return np.asarray(pixels[0]), np.asarray(pixels[1])
+
+
+def pixelToSkyArrays(wcs, x, y):
+    """!Convert pixel positions to sky positions
+
+    @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+    @param[in] x  x pixel positions; array-like
+    @param[in] y  y pixel positions; array-like
+    @return RA and Dec (radians), as two numpy arrays
+    """
+    x = np.asarray(x, dtype=float)
+    if len(x) == 0:
+        return np.zeros(0), np.zeros(0)
+    sky = wcs.getTransform().applyForward(np.array([x, np.asarray(y, dtype=float)]))
+    return np.asarray(sky[0]), np.asarray(sky[1])
+
+
+def separationArrays(ra1, dec1, ra2, dec2):
+    """!Compute the angular separation between pairs of sky positions, by the haversine formula
+
+    @param[in] ra1, dec1  first positions (radians); array-like
+    @param[in] ra2, dec2  second positions (radians); array-like
+    @return angular separation (radians), as a numpy array
+    """
+    ra1, dec1, ra2, dec2 = (np.asarray(value, dtype=float) for value in (ra1, dec1, ra2, dec2))
+    hav = np.sin(0.5*(dec2 - dec1))**2 + np.cos(dec1)*np.cos(dec2)*np.sin(0.5*(ra2 - ra1))**2
+    return 2*np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+
+
+def skyToTangentPlaneArrays(ra, dec, center):
+    """!Project sky positions onto the tangent plane at a point (gnomonic projection)
+
+    @param[in] ra  RA (radians); array-like
+    @param[in] dec  Dec (radians); array-like
+    @param[in] center  tangent point (an afwGeom.SpherePoint)
+    @return standard coordinates xi and eta (radians), as two numpy arrays;
+        positions more than 90 degrees from the tangent point are set to infinity
+    """
+    ra0 = center.getLongitude().asRadians()
+    dec0 = center.getLatitude().asRadians()
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    cosDec = np.cos(dec)
+    dRa = ra - ra0
+    cosC = np.sin(dec0)*np.sin(dec) + np.cos(dec0)*cosDec*np.cos(dRa)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xi = np.where(cosC > 0, cosDec*np.sin(dRa)/cosC, np.inf)
+        eta = np.where(cosC > 0, (np.cos(dec0)*np.sin(dec) - np.sin(dec0)*cosDec*np.cos(dRa))/cosC, np.inf)
+    return xi, eta
+
+
+def setSourceCoords(wcs, sourceCat):
+    """!Set the coord field of each source from its centroid, using a WCS
+
+    Equivalent to lsst.afw.table.updateSourceCoords, but for a contiguous catalog the centroid
+    columns are transformed in one call and the coord columns written as arrays; a
+    non-contiguous catalog falls back to updateSourceCoords.
+
+    @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
+    @param[in,out] sourceCat  source catalog with a centroid slot and a coord field
+    """
+    if len(sourceCat) == 0:
+        return
+    if not sourceCat.isContiguous():
+        afwTable.updateSourceCoords(wcs, sourceCat)
+        return
+    ra, dec = pixelToSkyArrays(wcs, sourceCat.getX(), sourceCat.getY())
+    sourceCat["coord_ra"][:] = ra
+    sourceCat["coord_dec"][:] = dec
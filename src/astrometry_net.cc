@@ -1,5 +1,9 @@
 // -*- lsst-C++ -*-
 
+#include <algorithm>
+#include <cmath>
+#include <limits>
+#include <numeric>
 #include <sstream>
 #include <utility>
 #include <vector>
@@ -27,6 +31,110 @@ static time_t timer_callback(void* baton) {
     return 1;
 }
 
+/*
+ * Get the indices of the (at most) maxStars brightest of n stars, in no particular order
+ *
+ * If maxStars <= 0 then all indices are returned. NaN fluxes rank below all others.
+ */
+std::vector<std::size_t> selectBrightest(double const* flux, std::size_t n, int maxStars) {
+    std::vector<std::size_t> indices(n);
+    std::iota(indices.begin(), indices.end(), 0);
+    if (maxStars > 0 && n > static_cast<std::size_t>(maxStars)) {
+        auto brighter = [flux](std::size_t a, std::size_t b) {
+            return flux[a] > flux[b] || (std::isnan(flux[b]) && !std::isnan(flux[a]));
+        };
+        std::nth_element(indices.begin(), indices.begin() + maxStars, indices.end(), brighter);
+        indices.resize(maxStars);
+    }
+    return indices;
+}
+
+/*
+ * Find the stars of an index within a circle, returning only their indices in the star kd-tree
+ *
+ * The caller owns the returned array (which is NULL if none are found) and must free it.
+ */
+int* searchStarInds(index_t* ind, double const* xyz, double r2, int* nstars) {
+    int* starinds = NULL;
+    *nstars = 0;
+    startree_search_for(ind->starkd, xyz, r2, NULL, NULL, &starinds, nstars);
+    return starinds;
+}
+
+/*
+ * Count the points of a kd-tree node within a squared distance of a unit vector
+ *
+ * Nodes entirely outside the circle are skipped and nodes entirely inside it are counted whole,
+ * using their bounding boxes, so only the points of leaves that straddle the edge are read,
+ * into a scratch buffer reused across leaves; no list of the points found is made.
+ * The tree must have bounding boxes.
+ */
+int countPointsWithin(kdtree_t const* kd, int node, double const* xyz, double r2,
+                      std::vector<double>& scratch) {
+    if (kdtree_node_point_mindist2_exceeds(kd, node, xyz, r2)) {
+        return 0;
+    }
+    if (!kdtree_node_point_maxdist2_exceeds(kd, node, xyz, r2)) {
+        return kdtree_npoints(kd, node);
+    }
+    if (!KD_IS_LEAF(kd, node)) {
+        return countPointsWithin(kd, KD_CHILD_LEFT(node), xyz, r2, scratch) +
+            countPointsWithin(kd, KD_CHILD_RIGHT(node), xyz, r2, scratch);
+    }
+    int const npoints = kdtree_npoints(kd, node);
+    scratch.resize(3*npoints);
+    kdtree_copy_data_double(kd, kdtree_left(kd, node), npoints, scratch.data());
+    int count = 0;
+    for (int i = 0; i < npoints; ++i) {
+        double const* point = &scratch[3*i];
+        double const dx = point[0] - xyz[0], dy = point[1] - xyz[1], dz = point[2] - xyz[2];
+        if (dx*dx + dy*dy + dz*dz <= r2) {
+            ++count;
+        }
+    }
+    return count;
+}
+
+/*
+ * Count the stars of an index within a circle
+ */
+int countStarsWithin(index_t* ind, double const* xyz, double r2, std::vector<double>& scratch) {
+    kdtree_t const* kd = ind->starkd->tree;
+    if (!kd->bb.any) {
+        // No bounding boxes to prune with: list the stars and count them
+        int nstars = 0;
+        free(searchStarInds(ind, xyz, r2, &nstars));
+        return nstars;
+    }
+    return countPointsWithin(kd, 0, xyz, r2, scratch);
+}
+
+/*
+ * Read a magnitude column of an index's tag-along table for the given stars
+ *
+ * The caller owns the returned array and must free it.
+ */
+float* readMagColumn(index_t* ind, std::string const& magCol, int* starinds, int nstars) {
+    fitstable_t* tag = startree_get_tagalong(ind->starkd);
+    float* mag = tag ? static_cast<float*>(fitstable_read_column_inds(
+        tag, magCol.c_str(), fitscolumn_float_type(), starinds, nstars)) : NULL;
+    if (!mag) {
+        std::ostringstream os;
+        os << "Unable to read data for " << magCol << " from " << ind->indexname;
+        throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError, os.str());
+    }
+    return mag;
+}
+
+/*
+ * Get the unit vector and squared chord distance for a search circle
+ */
+void getSearchCircle(lsst::afw::geom::SpherePoint const &ctrCoord, lsst::afw::geom::Angle const &radius,
+                     double xyz[3], double* r2) {
+    radecdeg2xyzarr(ctrCoord.getLongitude().asDegrees(), ctrCoord.getLatitude().asDegrees(), xyz);
+    *r2 = deg2distsq(radius.asDegrees());
+}
+
 }  // namespace <anonymous>
 
 MultiIndex::MultiIndex(std::string const & filepath) : _multiindex(multiindex_new(filepath.c_str())) {
@@ -60,7 +168,7 @@ void MultiIndex::reload() {
 }
 
 
-Solver::Solver() : _solver(solver_new()) {}
+Solver::Solver() : _solver(solver_new()), _maxStars(0) {}
 
 Solver::~Solver() {
     // Working around a bug in Astrometry.net: doesn't take ownership of the field.
@@ -97,6 +205,110 @@ lsst::afw::table::SimpleCatalog Solver::getCatalog(
         idCol, magColInfoList, starGalCol, varCol, uniqueIds);
 }
 
+std::vector<int> Solver::countStars(
+    std::vector<index_t*> inds,
+    lsst::afw::geom::SpherePoint const &ctrCoord,
+    lsst::afw::geom::Angle const &radius) const
+{
+    double xyz[3], r2;
+    getSearchCircle(ctrCoord, radius, xyz, &r2);
+    std::vector<int> counts;
+    counts.reserve(inds.size());
+    std::vector<double> scratch;
+    for (auto ind : inds) {
+        counts.push_back(countStarsWithin(ind, xyz, r2, scratch));
+    }
+    return counts;
+}
+
+std::vector<std::vector<int>> Solver::getMagHistograms(
+    std::vector<index_t*> inds,
+    lsst::afw::geom::SpherePoint const &ctrCoord,
+    lsst::afw::geom::Angle const &radius,
+    std::string const& magCol,
+    std::vector<double> const& binEdges) const
+{
+    if (binEdges.size() < 2 || !std::is_sorted(binEdges.begin(), binEdges.end()) ||
+        std::adjacent_find(binEdges.begin(), binEdges.end()) != binEdges.end()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          "binEdges must contain at least two strictly increasing values");
+    }
+    double xyz[3], r2;
+    getSearchCircle(ctrCoord, radius, xyz, &r2);
+    std::vector<std::vector<int>> histograms;
+    histograms.reserve(inds.size());
+    for (auto ind : inds) {
+        std::vector<int> hist(binEdges.size() - 1, 0);
+        int nstars = 0;
+        int* starinds = searchStarInds(ind, xyz, r2, &nstars);
+        if (nstars > 0) {
+            float* mag = NULL;
+            try {
+                mag = readMagColumn(ind, magCol, starinds, nstars);
+            } catch (...) {
+                free(starinds);
+                throw;
+            }
+            free(starinds);
+            for (int i = 0; i < nstars; ++i) {
+                // upper_bound puts the value in [edges[bin-1], edges[bin]); NaN is never in a bin
+                auto const bin = std::upper_bound(binEdges.begin(), binEdges.end(), mag[i]) -
+                                 binEdges.begin();
+                if (!std::isnan(mag[i]) && bin > 0 && bin < static_cast<long>(binEdges.size())) {
+                    ++hist[bin - 1];
+                }
+            }
+            free(mag);
+        } else {
+            free(starinds);
+        }
+        histograms.push_back(hist);
+    }
+    return histograms;
+}
+
+std::tuple<std::vector<double>, std::vector<double>, std::vector<double>> Solver::getStarArrays(
+    std::vector<index_t*> inds,
+    lsst::afw::geom::SpherePoint const &ctrCoord,
+    lsst::afw::geom::Angle const &radius,
+    std::string const& magCol) const
+{
+    double xyz[3], r2;
+    getSearchCircle(ctrCoord, radius, xyz, &r2);
+    std::vector<double> ra, dec, mag;
+    for (auto ind : inds) {
+        double* radecs = NULL;
+        int* starinds = NULL;
+        int nstars = 0;
+        startree_search_for(ind->starkd, xyz, r2, NULL, &radecs, magCol.empty() ? NULL : &starinds,
+                            &nstars);
+        if (nstars == 0) {
+            free(radecs);
+            free(starinds);
+            continue;
+        }
+        float* indMag = NULL;
+        if (!magCol.empty()) {
+            try {
+                indMag = readMagColumn(ind, magCol, starinds, nstars);
+            } catch (...) {
+                free(radecs);
+                free(starinds);
+                throw;
+            }
+        }
+        for (int i = 0; i < nstars; ++i) {
+            ra.push_back(radecs[2*i]);
+            dec.push_back(radecs[2*i + 1]);
+            mag.push_back(indMag ? indMag[i] : std::numeric_limits<double>::quiet_NaN());
+        }
+        free(indMag);
+        free(radecs);
+        free(starinds);
+    }
+    return std::make_tuple(ra, dec, mag);
+}
+
 std::shared_ptr<lsst::daf::base::PropertyList> Solver::getSolveStats() const {
     // Gather solve stats...
     auto qa = std::make_shared<daf::base::PropertyList>();
@@ -217,17 +429,31 @@ void Solver::setImageSize(int width, int height) {
 }
 
 void Solver::setStars(lsst::afw::table::SourceCatalog const & srcs, int x0, int y0) {
-    // convert to Astrometry.net "starxy_t"
-    starxy_free(_solver->fieldxy);
     const size_t N = srcs.size();
-    starxy_t *starxy = starxy_new(N, true, false);
+    std::vector<double> x(N), y(N), flux(N);
     for (size_t i=0; i<N; ++i) {
-        double const x    = srcs[i].getX();
-        double const y    = srcs[i].getY();
-        double const flux = srcs[i].getPsfInstFlux();
-        starxy_set(starxy, i, x - x0, y - y0);
-        starxy_set_flux(starxy, i, flux);
+        x[i]    = srcs[i].getX();
+        y[i]    = srcs[i].getY();
+        flux[i] = srcs[i].getPsfInstFlux();
+    }
+    setStars(x.data(), y.data(), flux.data(), N, x0, y0);
+}
+
+void Solver::setStars(double const* x, double const* y, double const* flux, std::size_t n, int x0, int y0) {
+    // Select the stars the solver will use before converting to Astrometry.net "starxy_t",
+    // so that only those are sorted and put in the field kd-tree
+    std::vector<std::size_t> const indices = selectBrightest(flux, n, _maxStars);
+    starxy_t *starxy = starxy_new(indices.size(), true, false);
+    for (size_t i=0; i<indices.size(); ++i) {
+        std::size_t const j = indices[i];
+        starxy_set(starxy, i, x[j] - x0, y[j] - y0);
+        starxy_set_flux(starxy, i, flux[j]);
     }
+    _setField(starxy);
+}
+
+void Solver::_setField(starxy_t* starxy) {
+    starxy_free(_solver->fieldxy);
     // Sort the array
     starxy_sort_by_flux(starxy);
 
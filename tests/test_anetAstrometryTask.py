@@ -22,16 +22,25 @@
 
 import os.path
 import math
+import shutil
+import tempfile
 import unittest
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 import lsst.utils.tests
 import lsst.geom
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
 import lsst.afw.image as afwImage
+from lsst.afw.cameraGeom import PIXELS, FIELD_ANGLE, Orientation
+from lsst.afw.cameraGeom.testUtils import DetectorWrapper
 import lsst.meas.base as measBase
 from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig, \
-    ANetAstrometryTask, LoadAstrometryNetObjectsTask
+    ANetAstrometryTask, ANetBasicAstrometryTask, LoadAstrometryNetObjectsTask
+from lsst.meas.extensions.astrometryNet.loadAstrometryNetObjects import LoadMultiIndexes
+from lsst.meas.extensions.astrometryNet.pointingModel import PointingModel
 from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
 
 
@@ -51,12 +60,14 @@ class TestAstrometricSolver(lsst.utils.tests.TestCase):
         andConfig = AstrometryNetDataConfig()
         andConfig.load(os.path.join(self.datapath, 'andConfig2.py'))
         andConfig.magErrorColumnMap = {}
+        self.andConfig = andConfig
         self.refObjLoader = LoadAstrometryNetObjectsTask(andConfig=andConfig)
 
     def tearDown(self):
         del self.tanWcs
         del self.exposure
         del self.refObjLoader
+        del self.andConfig
 
     def testTrivial(self):
         """Test fit with no distortion
@@ -70,12 +81,427 @@ class TestAstrometricSolver(lsst.utils.tests.TestCase):
         """
         self.doTest(afwGeom.makeRadialTransform([0, 1.01, 1e-7]))
 
+    def testRadialMad(self):
+        """Test fit with radial distortion, rejecting outliers using the median absolute deviation
+        """
+        config = ANetAstrometryTask.ConfigClass()
+        config.rejectScatter = "mad"
+        self.doTest(afwGeom.makeRadialTransform([0, 1.01, 1e-7]), config=config)
+
+    def testSolveArrays(self):
+        """Test a blind solve from arrays of positions and fluxes
+        """
+        sourceCat = self.makeSourceCat(self.tanWcs)
+        if not sourceCat.isContiguous():
+            sourceCat = sourceCat.copy(deep=True)
+        task = ANetBasicAstrometryTask(config=ANetBasicAstrometryTask.ConfigClass(),
+                                       andConfig=self.andConfig)
+        res = task.solveArrays(sourceCat.getX(), sourceCat.getY(), sourceCat.getPsfInstFlux(),
+                               bbox=self.bbox, pixelScale=self.tanWcs.getPixelScale(),
+                               radecCenter=self.tanWcs.pixelToSky(lsst.geom.Box2D(self.bbox).getCenter()))
+        self.assertIsNotNone(res.wcs)
+        self.assertWcsAlmostEqualOverBBox(self.tanWcs, res.wcs, self.bbox,
+                                          maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+
+    def testPointingModel(self):
+        """Test that determineWcs solves around the center corrected by a trained pointing model
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            config = ANetBasicAstrometryTask.ConfigClass()
+            config.pointingModelFile = os.path.join(directory, "pointing.json")
+            crpix = lsst.geom.Box2D(self.bbox).getCenter()
+            trueCenter = self.tanWcs.pixelToSky(crpix)
+            commanded = trueCenter.offset(45*lsst.geom.degrees, 20*lsst.geom.arcseconds)
+            model = PointingModel(config.pointingModelFile, config.pointingModelTelescope)
+            for i in range(config.pointingModelMinUpdates):
+                model.update(commanded, trueCenter)
+            model.write()
+
+            self.exposure.setWcs(afwGeom.makeSkyWcs(crpix=crpix, crval=commanded,
+                                                    cdMatrix=self.tanWcs.getCdMatrix()))
+            task = ANetBasicAstrometryTask(config=config, andConfig=self.andConfig)
+            solveArgs = self.recordSolves(task)
+            astrom = task.determineWcs(self.makeSourceCat(self.tanWcs), self.exposure)
+            self.assertEqual(len(solveArgs), 1)
+            self.assertLess(solveArgs[0]["radecCenter"].separation(trueCenter).asArcseconds(), 0.01)
+            bboxD = lsst.geom.Box2D(self.bbox)
+            fieldRadius = self.tanWcs.getPixelScale()*math.hypot(*bboxD.getDimensions())/2
+            self.assertGreaterEqual(solveArgs[0]["searchRadius"].asDegrees(), fieldRadius.asDegrees())
+            self.assertLess(solveArgs[0]["searchRadius"].asDegrees(), config.raDecSearchRadius)
+            self.assertWcsAlmostEqualOverBBox(self.tanWcs, astrom.getWcs(), self.bbox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+            updated = PointingModel(config.pointingModelFile, config.pointingModelTelescope)
+            self.assertEqual(updated.getNumUpdates(), config.pointingModelMinUpdates + 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def testPointingModelFallback(self):
+        """Test that a failed solve around a stale pointing model center is retried around the input WCS
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            config = ANetBasicAstrometryTask.ConfigClass()
+            config.pointingModelFile = os.path.join(directory, "pointing.json")
+            crpix = lsst.geom.Box2D(self.bbox).getCenter()
+            trueCenter = self.tanWcs.pixelToSky(crpix)
+            model = PointingModel(config.pointingModelFile, config.pointingModelTelescope)
+            for i in range(config.pointingModelMinUpdates):
+                model.update(trueCenter, trueCenter.offset(90*lsst.geom.degrees, 30*lsst.geom.arcminutes))
+            model.write()
+
+            task = ANetBasicAstrometryTask(config=config, andConfig=self.andConfig)
+            solveArgs = self.recordSolves(task)
+            astrom = task.determineWcs(self.makeSourceCat(self.tanWcs), self.exposure)
+            self.assertEqual(len(solveArgs), 2)
+            self.assertGreater(solveArgs[0]["radecCenter"].separation(trueCenter).asArcminutes(), 29)
+            bboxD = lsst.geom.Box2D(self.bbox)
+            fieldRadius = self.tanWcs.getPixelScale()*math.hypot(*bboxD.getDimensions())/2
+            minSigma = config.pointingModelMinSigma*lsst.geom.arcseconds
+            minRadius = fieldRadius + config.pointingModelNumSigma*minSigma
+            self.assertGreaterEqual(solveArgs[0]["searchRadius"].asArcseconds(),
+                                    minRadius.asArcseconds() - 1e-6)
+            self.assertLess(solveArgs[1]["radecCenter"].separation(trueCenter).asArcseconds(), 0.01)
+            self.assertAlmostEqual(solveArgs[1]["searchRadius"].asDegrees(), config.raDecSearchRadius)
+            self.assertWcsAlmostEqualOverBBox(self.tanWcs, astrom.getWcs(), self.bbox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+            updated = PointingModel(config.pointingModelFile, config.pointingModelTelescope)
+            self.assertEqual(updated.getNumUpdates(), config.pointingModelMinUpdates + 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def testVerifyPrior(self):
+        """Test that a correct input WCS is accepted without a blind solve
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            config = ANetBasicAstrometryTask.ConfigClass()
+            config.doVerifyPrior = True
+            config.pointingModelFile = os.path.join(directory, "pointing.json")
+            task = ANetBasicAstrometryTask(config=config, andConfig=self.andConfig)
+            solveArgs = self.recordSolves(task)
+            wcs, qa = task.getBlindWcsSolution(self.makeSourceCat(self.tanWcs), exposure=self.exposure)
+            self.assertEqual(solveArgs, [])
+            self.assertWcsAlmostEqualOverBBox(self.tanWcs, wcs, self.bbox,
+                                              maxDiffSky=1e-6*lsst.geom.arcseconds, maxDiffPix=1e-6)
+            self.assertGreaterEqual(qa.getAsDouble("meas_astrom*verify_prior*logodds"), config.matchThreshold)
+            self.assertGreater(qa.getAsInt("meas_astrom*verify_prior*nmatch"), 0)
+            self.assertEqual(task.metadata.getAsInt("verifyPriorAttempts"), 1)
+            self.assertEqual(task.metadata.getAsInt("verifyPriorHits"), 1)
+            # An accepted input WCS says nothing about the pointing error
+            self.assertEqual(task.pointingModel.getNumUpdates(), 0)
+            self.assertFalse(os.path.exists(config.pointingModelFile))
+        finally:
+            shutil.rmtree(directory)
+
+    def testVerifyPriorRejected(self):
+        """Test that a wrong input WCS is rejected, falling back to a blind solve
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            config = ANetBasicAstrometryTask.ConfigClass()
+            config.doVerifyPrior = True
+            config.pointingModelFile = os.path.join(directory, "pointing.json")
+            crpix = lsst.geom.Box2D(self.bbox).getCenter()
+            crval = self.tanWcs.pixelToSky(crpix).offset(45*lsst.geom.degrees, 30*lsst.geom.arcseconds)
+            self.exposure.setWcs(afwGeom.makeSkyWcs(crpix=crpix, crval=crval,
+                                                    cdMatrix=self.tanWcs.getCdMatrix()))
+            task = ANetBasicAstrometryTask(config=config, andConfig=self.andConfig)
+            solveArgs = self.recordSolves(task)
+            wcs, qa = task.getBlindWcsSolution(self.makeSourceCat(self.tanWcs), exposure=self.exposure)
+            self.assertEqual(len(solveArgs), 1)
+            self.assertWcsAlmostEqualOverBBox(self.tanWcs, wcs, self.bbox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+            self.assertFalse(qa.exists("meas_astrom*verify_prior*logodds"))
+            self.assertEqual(task.metadata.getAsInt("verifyPriorAttempts"), 1)
+            self.assertEqual(task.metadata.getAsInt("verifyPriorHits"), 0)
+            self.assertEqual(task.pointingModel.getNumUpdates(), 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def testSipNoImprovement(self):
+        """Test that a warm-started SIP fit that does not improve on its seed is not used
+        """
+        task = ANetBasicAstrometryTask(config=ANetBasicAstrometryTask.ConfigClass(), andConfig=self.andConfig)
+        sipA = np.zeros((3, 3))
+        sipA[2, 0] = 1e-12
+        seedWcs = afwGeom.makeTanSipWcs(self.tanWcs.getPixelOrigin(),
+                                        self.tanWcs.pixelToSky(self.tanWcs.getPixelOrigin()),
+                                        self.tanWcs.getCdMatrix(), sipA, np.zeros((3, 3)))
+        task._getSipSeedWcs = lambda detectorName, filterName, tanWcs: seedWcs
+        startWcsList = []
+
+        def calculateSipTerms(origWcs, refCat, sourceCat, matches, bbox, matcher=None):
+            startWcsList.append(origWcs)
+            return origWcs, matches, 1
+        task._calculateSipTerms = calculateSipTerms
+
+        astrom = task.useKnownWcs(self.makeSourceCat(self.tanWcs), wcs=self.tanWcs, exposure=self.exposure)
+        self.assertEqual(len(startWcsList), 1)
+        self.assertIs(startWcsList[0], seedWcs)
+        self.assertIsNone(astrom.sipWcs)
+        self.assertIs(astrom.getWcs(), self.tanWcs)
+        self.assertGreater(len(astrom.getMatches()), 50)
+
+    def testRunVisit(self):
+        """Test solving several CCDs together, with a common pointing error
+        """
+        config = ANetAstrometryTask.ConfigClass()
+        config.numWorkers = 2
+        solver = ANetAstrometryTask(config=config, refObjLoader=self.refObjLoader,
+                                    schema=self.makeSourceSchema())
+        crval = self.tanWcs.pixelToSky(self.tanWcs.getPixelOrigin())
+        offsetWcs = afwGeom.makeSkyWcs(crpix=self.tanWcs.getPixelOrigin(),
+                                       crval=crval.offset(45*lsst.geom.degrees, 20*lsst.geom.arcseconds),
+                                       cdMatrix=self.tanWcs.getCdMatrix())
+        exposureSourceList = []
+        for i in range(3):
+            exposure = afwImage.ExposureF(self.bbox)
+            exposure.setWcs(offsetWcs)
+            exposure.setFilter(afwImage.Filter("r", True))
+            exposureSourceList.append((exposure, self.makeSourceCat(self.tanWcs)))
+
+        # Count the loads of each multi-index: those pinned for the visit must be loaded only once
+        solver.makeSubtask("solver")
+        loads = {}
+        for mi in solver.solver.refObjLoader.multiInds:
+            def reload(mi=mi, original=mi.reload):
+                if not mi._loaded:
+                    loads[id(mi)] = loads.get(id(mi), 0) + 1
+                original()
+            mi.reload = reload
+
+        results = solver.runVisit(exposureSourceList)
+        self.assertGreater(len(loads), 0)
+        self.assertEqual(set(loads.values()), {1})
+        self.assertEqual(len(results), 3)
+        # Each refit replaces the per-iteration metadata of the previous one
+        numIter = len(solver.metadata.getArray("refitWcsFitTime"))
+        self.assertLessEqual(numIter, config.rejectIter)
+        self.assertEqual(len(solver.metadata.getArray("refitWcsNumMatches")), numIter)
+        for result, (exposure, sourceCat) in zip(results, exposureSourceList):
+            self.assertIsNotNone(result)
+            self.assertGreater(len(result.matches), 50)
+            self.assertWcsAlmostEqualOverBBox(self.tanWcs, exposure.getWcs(), self.bbox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+
+    def testConcurrentSolves(self):
+        """Test that solves in several threads, sharing pinned indexes, match serial solves
+        """
+        task = ANetBasicAstrometryTask(config=ANetBasicAstrometryTask.ConfigClass(), andConfig=self.andConfig)
+        sourceCat = self.makeSourceCat(self.tanWcs)
+        serial = task.getBlindWcsSolution(sourceCat, exposure=self.exposure)[0]
+        pool = ThreadPool(4)
+        try:
+            with LoadMultiIndexes(task.refObjLoader.multiInds):
+                results = pool.map(lambda i: task.getBlindWcsSolution(sourceCat, exposure=self.exposure)[0],
+                                   range(8))
+        finally:
+            pool.close()
+            pool.join()
+        for wcs in results:
+            self.assertWcsAlmostEqualOverBBox(serial, wcs, self.bbox,
+                                              maxDiffSky=1e-6*lsst.geom.arcseconds, maxDiffPix=1e-5)
+        self.assertWcsAlmostEqualOverBBox(self.tanWcs, serial, self.bbox,
+                                          maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+
+    def testSolveFocalPlane(self):
+        """Test solving the CCDs of a small camera together in a common focal-plane frame
+        """
+        pixelScale = 0.18*lsst.geom.arcseconds
+        fieldAngleToFp = afwGeom.makeTransform(lsst.geom.AffineTransform(
+            lsst.geom.LinearTransform.makeScaling(1.0/pixelScale.asRadians())))
+        center = lsst.geom.SpherePoint(215.5, 53.0, lsst.geom.degrees)
+        cdMatrix = afwGeom.makeCdMatrix(scale=pixelScale)
+        fpWcs = afwGeom.makeSkyWcs(crpix=lsst.geom.Point2D(0, 0), crval=center, cdMatrix=cdMatrix)
+        commandedFpWcs = afwGeom.makeSkyWcs(crpix=lsst.geom.Point2D(0, 0),
+                                            crval=center.offset(45*lsst.geom.degrees,
+                                                                20*lsst.geom.arcseconds),
+                                            cdMatrix=cdMatrix)
+
+        # A 2x2 mosaic of 1500x1500 pixel CCDs, 0.018 mm pixels, 10 arcsec/mm
+        ccdBBox = lsst.geom.Box2I(lsst.geom.Point2I(0, 0), lsst.geom.Extent2I(1500, 1500))
+        exposureSourceList = []
+        trueWcsList = []
+        commandedWcsList = []
+        for i, fpPosition in enumerate([(-13.7, -13.7), (13.7, -13.7), (-13.7, 13.7), (13.7, 13.7)]):
+            detector = DetectorWrapper(name="ccd%d" % (i,), id=i, bbox=ccdBBox,
+                                       pixelSize=lsst.geom.Extent2D(0.018, 0.018),
+                                       orientation=Orientation(lsst.geom.Point2D(*fpPosition),
+                                                               lsst.geom.Point2D(749.5, 749.5)),
+                                       plateScale=10.0, radialDistortion=0.0).detector
+            pixToFp = detector.getTransform(PIXELS, FIELD_ANGLE).then(fieldAngleToFp)
+            trueWcs = afwGeom.makeModifiedWcs(pixelTransform=pixToFp, wcs=fpWcs, modifyActualPixels=False)
+            commandedWcs = afwGeom.makeModifiedWcs(pixelTransform=pixToFp, wcs=commandedFpWcs,
+                                                   modifyActualPixels=False)
+            exposure = afwImage.ExposureF(ccdBBox)
+            exposure.setDetector(detector)
+            exposure.setFilter(afwImage.Filter("r", True))
+            exposureSourceList.append((exposure, self.makeSourceCat(trueWcs, bbox=ccdBBox)))
+            trueWcsList.append(trueWcs)
+            commandedWcsList.append(commandedWcs)
+
+        config = ANetAstrometryTask.ConfigClass()
+        config.useFocalPlaneSolve = True
+        solver = ANetAstrometryTask(config=config, refObjLoader=self.refObjLoader,
+                                    schema=self.makeSourceSchema())
+        for (exposure, sourceCat), commandedWcs in zip(exposureSourceList, commandedWcsList):
+            exposure.setWcs(commandedWcs)
+        res = solver.solveFocalPlane(exposureSourceList)
+        self.assertLess(res.focalPlaneWcs.pixelToSky(0, 0).separation(center).asArcseconds(), 0.01)
+        self.assertEqual(len(res.ccdResults), len(exposureSourceList))
+        for result, (exposure, sourceCat), trueWcs in zip(res.ccdResults, exposureSourceList, trueWcsList):
+            self.assertIsNotNone(result)
+            self.assertGreater(len(result.matches), 20)
+            self.assertWcsAlmostEqualOverBBox(trueWcs, exposure.getWcs(), ccdBBox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+
+        # runVisit must use the joint solution, without solving any CCD individually
+        solveCalls = []
+        solve = solver.solve
+
+        def recordSolve(**kwargs):
+            solveCalls.append(kwargs)
+            return solve(**kwargs)
+        solver.solve = recordSolve
+        for (exposure, sourceCat), commandedWcs in zip(exposureSourceList, commandedWcsList):
+            exposure.setWcs(commandedWcs)
+        results = solver.runVisit(exposureSourceList)
+        self.assertEqual(solveCalls, [])
+        for result, (exposure, sourceCat), trueWcs in zip(results, exposureSourceList, trueWcsList):
+            self.assertIsNotNone(result)
+            self.assertWcsAlmostEqualOverBBox(trueWcs, exposure.getWcs(), ccdBBox,
+                                              maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+
+    def testNeighborPointing(self):
+        """Test estimating the pointing and search radius of a failed CCD from a neighbor that solved
+        """
+        config = ANetAstrometryTask.ConfigClass()
+        solver = ANetAstrometryTask(config=config, refObjLoader=self.refObjLoader,
+                                    schema=self.makeSourceSchema())
+        bearing, offset = 30*lsst.geom.degrees, 15*lsst.geom.arcseconds
+        commanded = []
+        exposureSourceList = []
+        for dec in (53.0, 53.3):
+            center = lsst.geom.SpherePoint(215.5, dec, lsst.geom.degrees)
+            exposure = afwImage.ExposureF(self.bbox)
+            exposure.setWcs(afwGeom.makeSkyWcs(crpix=lsst.geom.Box2D(self.bbox).getCenter(),
+                                               crval=center.offset(bearing, offset),
+                                               cdMatrix=self.tanWcs.getCdMatrix()))
+            commanded.append((center, 0.2*lsst.geom.degrees))
+            exposureSourceList.append((exposure, None))
+        results = [object(), None]
+        center, radius = solver._getNeighborPointing(1, commanded, results, exposureSourceList)
+        expected = commanded[1][0].offset(bearing, offset)
+        self.assertLess(center.separation(expected).asArcseconds(), 0.01)
+        bboxD = lsst.geom.Box2D(self.bbox)
+        fieldRadius = self.tanWcs.getPixelScale()*math.hypot(*bboxD.getDimensions())/2
+        expectedRadius = fieldRadius + 2*offset + config.neighborSearchMargin*lsst.geom.arcseconds
+        self.assertAlmostEqual(radius.asArcseconds(), expectedRadius.asArcseconds(), places=3)
+        self.assertLess(radius, commanded[1][1])
+        self.assertIsNone(solver._getNeighborPointing(1, commanded, [None, None], exposureSourceList))
+
+        # The radius is never larger than that of the input pointing
+        commanded[1] = (commanded[1][0], 1*lsst.geom.arcminutes)
+        center, radius = solver._getNeighborPointing(1, commanded, results, exposureSourceList)
+        self.assertEqual(radius, commanded[1][1])
+
+    def testValidateMatches(self):
+        """Test the match-list checks of each validation level
+        """
+        refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+        sourceCat = afwTable.SourceCatalog(self.makeSourceSchema())
+        otherCat = afwTable.SourceCatalog(self.makeSourceSchema())
+        matches = []
+        for i in range(3):
+            src = sourceCat.addNew()
+            src.setId(i + 1)
+            matches.append(afwTable.ReferenceMatch(refCat.addNew(), src, 0.0))
+        for level in ("none", "fast", "full"):
+            ANetBasicAstrometryTask.validateMatches(matches, sourceCat, level)
+
+        # A record with the ID of a source in the catalog, but not in the catalog
+        copy = otherCat.addNew()
+        copy.setId(2)
+        badRecord = matches + [afwTable.ReferenceMatch(refCat.addNew(), copy, 0.0)]
+        ANetBasicAstrometryTask.validateMatches(badRecord, sourceCat, "fast")
+        with self.assertRaises(RuntimeError):
+            ANetBasicAstrometryTask.validateMatches(badRecord, sourceCat, "full")
+
+        stranger = otherCat.addNew()
+        stranger.setId(10)
+        badId = matches + [afwTable.ReferenceMatch(refCat.addNew(), stranger, 0.0)]
+        ANetBasicAstrometryTask.validateMatches(badId, sourceCat, "none")
+        for level in ("fast", "full"):
+            with self.assertRaises(RuntimeError):
+                ANetBasicAstrometryTask.validateMatches(badId, sourceCat, level)
+
+    def testCleaningUseY(self):
+        """Test that config.cleaningUseY clips matches on their Y residuals too
+        """
+        sourceCat = self.makeSourceCat(self.tanWcs)
+        centroidKey = afwTable.Point2DKey(sourceCat.schema["slot_Centroid"])
+        badY = set()
+        for src in sourceCat[::20]:
+            src.set(centroidKey, src.getCentroid() + lsst.geom.Extent2D(0, 2))
+            badY.add(src.getId())
+        refCat = self.refObjLoader.loadPixelBox(bbox=self.bbox, wcs=self.tanWcs, filterName="r").refCat
+        for useY in (False, True):
+            config = ANetBasicAstrometryTask.ConfigClass()
+            config.cleaningUseY = useY
+            task = ANetBasicAstrometryTask(config=config, andConfig=self.andConfig)
+            matchIds = set(m.second.getId() for m in task._getMatchList(sourceCat, refCat, self.tanWcs))
+            self.assertEqual(matchIds & badY, set() if useY else badY)
+            self.assertGreater(len(matchIds - badY), 200)
+
+    def testTrimBadPoints(self):
+        """Test trimming sources and reference objects to a bounding box
+        """
+        sourceCat = self.makeSourceCat(self.tanWcs)
+        # Sources on the edges of the box: min edges are inside, max edges outside
+        for x, y in ((0, 0), (3001, 10), (10, 3001), (3000.5, 3000.5)):
+            src = sourceCat.addNew()
+            src.set(afwTable.Point2DKey(sourceCat.schema["slot_Centroid"]), lsst.geom.Point2D(x, y))
+        bboxD = lsst.geom.Box2D(lsst.geom.Point2D(0, 0), lsst.geom.Point2D(3001, 3001))
+        trimmed = ANetBasicAstrometryTask._trimBadPoints(sourceCat, bboxD)
+        self.assertTrue(trimmed.isContiguous())
+        expected = [src.getId() for src in sourceCat if bboxD.contains(src.getCentroid())]
+        self.assertEqual(list(trimmed["id"]), expected)
+        self.assertIn(sourceCat[-4].getId(), expected)
+        self.assertNotIn(sourceCat[-3].getId(), expected)
+
+        # Non-contiguous input, and positions from the WCS
+        refCat = self.refObjLoader.loadPixelBox(bbox=self.bbox, wcs=self.tanWcs, filterName="r").refCat
+        refCat = refCat[::2]
+        smallBBox = lsst.geom.Box2D(lsst.geom.Point2D(500, 700), lsst.geom.Point2D(2000, 1500))
+        trimmed = ANetBasicAstrometryTask._trimBadPoints(refCat, smallBBox, wcs=self.tanWcs)
+        self.assertTrue(trimmed.isContiguous())
+        expected = [ref.getId() for ref in refCat
+                    if smallBBox.contains(self.tanWcs.skyToPixel(ref.getCoord()))]
+        self.assertGreater(len(expected), 0)
+        self.assertLess(len(expected), len(refCat))
+        self.assertEqual(list(trimmed["id"]), expected)
+
+    def recordSolves(self, task):
+        """Record the keyword arguments of every call to an ANetBasicAstrometryTask's _solve
+
+        @return the list to which the arguments of each call are appended
+        """
+        solveArgs = []
+        solve = task._solve
+
+        def recordSolve(**kwargs):
+            solveArgs.append(kwargs)
+            return solve(**kwargs)
+        task._solve = recordSolve
+        return solveArgs
+
     def makeSourceSchema(self):
         schema = afwTable.SourceTable.makeMinimalSchema()
         measBase.SingleFrameMeasurementTask(schema=schema)  # expand the schema
         return schema
 
-    def doTest(self, pixelsToTanPixels):
+    def doTest(self, pixelsToTanPixels, config=None):
         """Test using pixelsToTanPixels to distort the source positions
         """
         distortedWcs = afwGeom.makeModifiedWcs(pixelTransform=pixelsToTanPixels, wcs=self.tanWcs,
@@ -83,7 +509,8 @@ class TestAstrometricSolver(lsst.utils.tests.TestCase):
         self.exposure.setWcs(distortedWcs)
         sourceCat = self.makeSourceCat(distortedWcs)
         print("number of stars =", len(sourceCat))
-        config = ANetAstrometryTask.ConfigClass()
+        if config is None:
+            config = ANetAstrometryTask.ConfigClass()
         solver = ANetAstrometryTask(config=config, refObjLoader=self.refObjLoader,
                                     schema=self.makeSourceSchema())
         results = solver.run(
@@ -94,6 +521,10 @@ class TestAstrometricSolver(lsst.utils.tests.TestCase):
         self.assertRaises(Exception, self.assertWcsAlmostEqualOverBBox, fitWcs, distortedWcs)
         self.assertWcsAlmostEqualOverBBox(distortedWcs, fitWcs, self.bbox,
                                           maxDiffSky=0.01*lsst.geom.arcseconds, maxDiffPix=0.02)
+        numIter = len(solver.metadata.getArray("refitWcsFitTime"))
+        self.assertGreater(numIter, 0)
+        self.assertLessEqual(numIter, config.rejectIter)
+        self.assertEqual(len(solver.metadata.getArray("refitWcsNumMatches")), numIter)
 
         srcCoordKey = afwTable.CoordKey(sourceCat.schema["coord"])
         refCoordKey = afwTable.CoordKey(results.refCat.schema["coord"])
@@ -126,10 +557,12 @@ class TestAstrometricSolver(lsst.utils.tests.TestCase):
         )
         self.assertGreater(len(noFitResults.refCat), 300)
 
-    def makeSourceCat(self, distortedWcs):
+    def makeSourceCat(self, distortedWcs, bbox=None):
         """Make a source catalog by reading the position reference stars and distorting the positions
         """
-        loadRes = self.refObjLoader.loadPixelBox(bbox=self.bbox, wcs=distortedWcs, filterName="r")
+        if bbox is None:
+            bbox = self.bbox
+        loadRes = self.refObjLoader.loadPixelBox(bbox=bbox, wcs=distortedWcs, filterName="r")
         refCat = loadRes.refCat
         refCentroidKey = afwTable.Point2DKey(refCat.schema["centroid"])
         refFluxRKey = refCat.schema["r_flux"].asKey()
@@ -0,0 +1,106 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.astrom.sip import LeastSqFitter1dPoly
+from lsst.meas.extensions.astrometryNet import cleanBadPoints
+
+
+def legacyIndicesOfGoodPoints(x, y, order, nsigma=3):
+    """The original per-point implementation of cleanBadPoints.indicesOfGoodPoints"""
+    idx = x.argsort()
+    rSize = len(idx)/float(order+1)
+    rx = np.zeros((order+1))
+    ry = np.zeros((order+1))
+    for i in range(order+1):
+        rng = list(range(int(rSize*i), int(rSize*(i+1))))
+        rx[i] = np.mean(x[idx[rng]])
+        ry[i] = np.median(y[idx[rng]])
+    lsf = LeastSqFitter1dPoly(list(rx), list(ry), list(np.ones(len(rx))), order)
+    f = np.array([lsf.valueAt(value) for value in x])
+    sigma = (y - f).std()
+    if sigma == 0:
+        return idx
+    return np.flatnonzero(np.fabs((y - f)/sigma) < nsigma)
+
+
+class CleanBadPointsTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(12345)
+
+    def testIndicesMatchLegacy(self):
+        for num in (10, 101, 1000):
+            x = self.rng.uniform(0, 2048, num)
+            y = 1e-4*x + 2e-8*x**2 + self.rng.normal(0, 0.05, num)
+            y[self.rng.choice(num, num//10, replace=False)] += 5
+            for order in (1, 2, 3, 4):
+                np.testing.assert_array_equal(cleanBadPoints.indicesOfGoodPoints(x, y, None, order=order),
+                                              legacyIndicesOfGoodPoints(x, y, order=order))
+
+    def testClean(self):
+        wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(1000, 1000),
+                                 crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                 cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+        srcSchema = afwTable.SourceTable.makeMinimalSchema()
+        centroidKey = afwTable.Point2DKey.addFields(srcSchema, "centroid", "centroid", "pixel")
+        srcSchema.getAliasMap().set("slot_Centroid", "centroid")
+        srcCat = afwTable.SourceCatalog(srcSchema)
+        num = 500
+        badX = set(self.rng.choice(num, 20, replace=False))
+        badY = set(self.rng.choice(num, 20, replace=False)) - badX
+        matches = []
+        for i in range(num):
+            x, y = self.rng.uniform(0, 2000, 2)
+            ref = refCat.addNew()
+            ref.setCoord(wcs.pixelToSky(x, y))
+            src = srcCat.addNew()
+            src.set(centroidKey, afwGeom.Point2D(x + self.rng.normal(0, 0.02) + (3 if i in badX else 0),
+                                                 y + self.rng.normal(0, 0.02) + (3 if i in badY else 0)))
+            matches.append(afwTable.ReferenceMatch(ref, src, 0.0))
+
+        cleanX = cleanBadPoints.clean(matches, wcs, order=3)
+        self.assertEqual(set(m.second.getId() for m in matches) - set(m.second.getId() for m in cleanX),
+                         set(matches[i].second.getId() for i in badX))
+        cleanXY = cleanBadPoints.clean(matches, wcs, order=3, useY=True)
+        self.assertEqual(set(m.second.getId() for m in matches) - set(m.second.getId() for m in cleanXY),
+                         set(matches[i].second.getId() for i in badX | badY))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -22,13 +22,18 @@
 
 from __future__ import absolute_import, division, print_function
 import os
+import time
 import unittest
 
+import numpy as np
+
 from lsst.afw.table import SimpleCatalog, SourceCatalog
 import lsst.utils.tests
 import lsst.afw.geom as afwGeom
 from lsst.log import Log
 from lsst.meas.extensions.astrometryNet import ANetBasicAstrometryTask, cleanBadPoints
+from lsst.meas.extensions.astrometryNet.matchArrays import MatchArrays
+from lsst.meas.extensions.astrometryNet.sipFitter import fitTanSip
 import lsst.meas.astrom.sip as sip
 import lsst.meas.astrom.sip.genDistortedImage as distort
 from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
@@ -85,6 +90,70 @@ class CreateWcsWithSipCase(unittest.TestCase):
             self.assertLess(abs(xy[0] - src.getX()), 0.1)
             self.assertLess(abs(xy[1] - src.getY()), 0.1)
 
+    def testBigXy0Numpy(self):
+        """Test for ticket #2710 using the numpy SIP fitter"""
+        self.config.sipFitter = "numpy"
+        self.astrom = ANetBasicAstrometryTask(config=self.config)
+        self.testBigXy0()
+
+    def testCompareFitters(self):
+        """Compare the accuracy and speed of fitTanSip and makeCreateWcsWithSip"""
+        cat = self.loadCatalogue(self.filename)
+        img = distort.distortList(cat, distort.linearXDistort)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1000, 1000))
+        imgWcs = self.astrom.determineWcs2(img, bbox=bbox).getWcs()
+        cat = cat.cast(SimpleCatalog, False)
+        matchList = self.matchSrcAndCatalogue(cat, img, imgWcs)
+        self.assertGreater(len(matchList), 50)
+        order = 3
+
+        t0 = time.time()
+        sipObject = sip.makeCreateWcsWithSip(matchList, imgWcs, order, bbox)
+        measAstromTime = time.time() - t0
+        t0 = time.time()
+        fit = fitTanSip(MatchArrays.fromReferenceMatches(matchList), imgWcs, order, bbox=bbox)
+        numpyTime = time.time() - t0
+        measAstromScatter = sipObject.getScatterOnSky().asArcseconds()
+        numpyScatter = fit.scatterOnSky.asArcseconds()
+        print("makeCreateWcsWithSip: %.4f s, scatter %.4f arcsec" % (measAstromTime, measAstromScatter))
+        print("fitTanSip:            %.4f s, scatter %.4f arcsec" % (numpyTime, numpyScatter))
+
+        self.assertLess(numpyScatter, self.tolArcsec)
+        self.assertLess(numpyScatter, 1.1*measAstromScatter + 1e-3)
+        for x in (0, 250, 500, 750, 1000):
+            for y in (0, 250, 500, 750, 1000):
+                pixel = afwGeom.Point2D(x, y)
+                sky = fit.wcs.pixelToSky(pixel)
+                self.assertLess(sky.separation(sipObject.getNewWcs().pixelToSky(pixel)).asArcseconds(), 0.05)
+                roundTrip = fit.wcs.skyToPixel(sky)
+                self.assertLess(abs(roundTrip.getX() - x), self.tolPixel)
+                self.assertLess(abs(roundTrip.getY() - y), self.tolPixel)
+
+    def testSipWcsFromWcs(self):
+        """Test approximating a distorted WCS with a TAN-SIP WCS, with fixed and adaptive grids"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(2048, 4096))
+        tanWcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(0, 0),
+                                    crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                    cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        wcs = afwGeom.makeModifiedWcs(pixelTransform=afwGeom.makeRadialTransform([0, 1.0, 1e-8]),
+                                      wcs=tanWcs, modifyActualPixels=False)
+        for fitter in ("meas_astrom", "numpy"):
+            self.config.sipFitter = fitter
+            astrom = ANetBasicAstrometryTask(config=self.config)
+            sipWcs = astrom.getSipWcsFromWcs(wcs, bbox, ngrid=20)
+            # CRPIX is refit, so it agrees with that of the linearized WCS to the accuracy of the fit
+            self.assertLess(np.hypot(*(sipWcs.getPixelOrigin() - afwGeom.Box2D(bbox).getCenter())), 0.05)
+            for x in np.linspace(bbox.getMinX(), bbox.getMaxX(), 7):
+                for y in np.linspace(bbox.getMinY(), bbox.getMaxY(), 7):
+                    self.assertLess(sipWcs.pixelToSky(x, y).separation(wcs.pixelToSky(x, y)).asArcseconds(),
+                                    0.01)
+            adaptiveWcs = astrom.getSipWcsFromWcs(wcs, bbox, ngrid=5, maxResidual=0.01)
+            for x in np.linspace(bbox.getMinX(), bbox.getMaxX(), 7):
+                for y in np.linspace(bbox.getMinY(), bbox.getMaxY(), 7):
+                    pixel = adaptiveWcs.skyToPixel(wcs.pixelToSky(x, y))
+                    self.assertLess(abs(pixel.getX() - x), 0.02)
+                    self.assertLess(abs(pixel.getY() - y), 0.02)
+
     def testLinearXDistort(self):
         print("linearXDistort")
         self.singleTestInstance(self.filename, distort.linearXDistort)
@@ -0,0 +1,113 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.afw.cameraGeom import PIXELS, TAN_PIXELS
+from lsst.meas.extensions.astrometryNet.distortionCache import DistortionCache
+
+
+class FakeDetector(object):
+    """Just enough of a Detector for DistortionCache"""
+
+    def __init__(self, name, bbox, transform):
+        self.name = name
+        self.bbox = bbox
+        self.transform = transform
+        self.numGetTransform = 0
+
+    def getName(self):
+        return self.name
+
+    def getSerial(self):
+        return "serial-" + self.name
+
+    def getBBox(self):
+        return self.bbox
+
+    def getTransform(self, fromSys, toSys):
+        assert (fromSys, toSys) == (PIXELS, TAN_PIXELS)
+        self.numGetTransform += 1
+        return self.transform
+
+    def getCorners(self, cameraSys):
+        assert cameraSys == TAN_PIXELS
+        return [self.transform.applyForward(corner) for corner in afwGeom.Box2D(self.bbox).getCorners()]
+
+
+class DistortionCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+        # Radial distortion about a point off the detector, as for a CCD away from the boresight
+        toCenter = afwGeom.makeTransform(afwGeom.AffineTransform(afwGeom.Extent2D(3000, -1000)))
+        radial = afwGeom.makeRadialTransform([0, 1.0, 1e-11])
+        self.transform = toCenter.then(radial).then(toCenter.getInverse())
+        rng = np.random.RandomState(12345)
+        self.x = rng.uniform(-10, 2060, 5000)
+        self.y = rng.uniform(-10, 4110, 5000)
+
+    def exact(self, x, y):
+        points = [self.transform.applyForward(afwGeom.Point2D(xx, yy)) for xx, yy in zip(x, y)]
+        return np.array([p.getX() for p in points]), np.array([p.getY() for p in points])
+
+    def testGrid(self):
+        cache = DistortionCache(gridSpacing=64, tolerance=1e-3)
+        detector = FakeDetector("ccd", self.bbox, self.transform)
+        distortion = cache.get(detector)
+        self.assertTrue(distortion.useGrid)
+        self.assertLessEqual(distortion.maxError, 1e-3)
+        tanX, tanY = distortion.apply(self.x, self.y)
+        exactX, exactY = self.exact(self.x, self.y)
+        self.assertLess(np.max(np.hypot(tanX - exactX, tanY - exactY)), 1e-3)
+
+        # The same detector must come from the cache
+        self.assertIs(cache.get(detector), distortion)
+        self.assertEqual(detector.numGetTransform, 1)
+        self.assertIsNot(cache.get(FakeDetector("other", self.bbox, self.transform)), distortion)
+
+    def testExactFallback(self):
+        """A tolerance that the grid cannot meet must give exact results"""
+        cache = DistortionCache(gridSpacing=1024, tolerance=1e-9)
+        distortion = cache.get(FakeDetector("ccd", self.bbox, self.transform))
+        self.assertFalse(distortion.useGrid)
+        tanX, tanY = distortion.apply(self.x, self.y)
+        exactX, exactY = self.exact(self.x, self.y)
+        self.assertFloatsAlmostEqual(tanX, exactX, atol=1e-9)
+        self.assertFloatsAlmostEqual(tanY, exactY, atol=1e-9)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,147 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+from builtins import object
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig, ANetBasicAstrometryTask
+from lsst.meas.extensions.astrometryNet.astrometry_net import radecDegToHealpix
+from lsst.meas.extensions.astrometryNet.indexHitStats import IndexHitStats
+from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
+
+
+class FakeIndex(object):
+    """Just enough of an index_t for ANetBasicAstrometryTask._getIndexesToLoad"""
+
+    def __init__(self, indexid, healpix, hpnside=2, scaleLower=60.0, scaleUpper=120.0):
+        self.indexid = indexid
+        self.healpix = healpix
+        self.hpnside = hpnside
+        self.index_scale_lower = scaleLower
+        self.index_scale_upper = scaleUpper
+
+
+class FakeMultiIndex(object):
+    """Just enough of a MultiIndexCache for ANetBasicAstrometryTask._getIndexesToLoad"""
+
+    def __init__(self, *indexes):
+        self.indexes = indexes
+
+    def getScaleRanges(self):
+        return [(ind.index_scale_lower, ind.index_scale_upper) for ind in self.indexes]
+
+    def __getitem__(self, i):
+        return self.indexes[i]
+
+    def __len__(self):
+        return len(self.indexes)
+
+
+class IndexHitStatsTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "hits.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testHitRate(self):
+        stats = IndexHitStats(self.filename, "indexSet")
+        self.assertEqual(stats.getHitRate(1), 0.5)
+        stats.update([1, 2, 2], 2)
+        stats.update([1, 2], None)
+        self.assertAlmostEqual(stats.getHitRate(1), 1/4)
+        self.assertAlmostEqual(stats.getHitRate(2), 2/4)
+        self.assertEqual(stats.getHitRate(3), 0.5)
+
+    def testPersistence(self):
+        stats = IndexHitStats(self.filename, "indexSet")
+        stats.update([1, 2], 1)
+        stats.write()
+        self.assertTrue(os.path.exists(self.filename))
+        self.assertEqual(os.listdir(self.directory), ["hits.json"])
+
+        same = IndexHitStats(self.filename, "indexSet")
+        self.assertAlmostEqual(same.getHitRate(1), 2/3)
+        self.assertAlmostEqual(same.getHitRate(2), 1/3)
+        other = IndexHitStats(self.filename, "otherIndexSet")
+        self.assertEqual(other.getHitRate(1), 0.5)
+
+        # Writing one index set keeps the others
+        other.update([1], None)
+        other.write()
+        same = IndexHitStats(self.filename, "indexSet")
+        self.assertAlmostEqual(same.getHitRate(1), 2/3)
+        self.assertAlmostEqual(IndexHitStats(self.filename, "otherIndexSet").getHitRate(1), 1/3)
+
+    def testIndexOrder(self):
+        """Indexes are ordered by distance from the center, then by hit rate"""
+        datapath = setupAstrometryNetDataDir('photocal')
+        andConfig = AstrometryNetDataConfig()
+        andConfig.load(os.path.join(datapath, 'andConfig.py'))
+        config = ANetBasicAstrometryTask.ConfigClass()
+        config.indexHitStatsFile = self.filename
+        task = ANetBasicAstrometryTask(config=config, andConfig=andConfig)
+
+        center = afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees)
+        near = int(radecDegToHealpix(215.5, 53.0, 2))
+        far = int(radecDegToHealpix(35.5, -53.0, 2))
+        nearPoor = FakeIndex(1, near)
+        nearGood = FakeIndex(2, near)
+        farBest = FakeIndex(3, far)
+        multiInds = [FakeMultiIndex(nearPoor, farBest), FakeMultiIndex(nearGood)]
+        for i in range(5):
+            task.indexHitStats.update([1, 2, 3], 3)
+            task.indexHitStats.update([1, 2], 2)
+
+        # Unordered by default: the configured order
+        self.assertFalse(config.orderIndexes)
+        toLoadMultiInds, toLoadInds = task._getIndexesToLoad(multiInds, 50.0, 200.0, radecCenter=center)
+        self.assertEqual([ind.indexid for ind in toLoadInds], [1, 3, 2])
+        self.assertEqual(toLoadMultiInds, set(multiInds))
+
+        config.orderIndexes = True
+        toLoadMultiInds, toLoadInds = task._getIndexesToLoad(multiInds, 50.0, 200.0, radecCenter=center)
+        self.assertEqual([ind.indexid for ind in toLoadInds], [2, 1, 3])
+
+        # Indexes that do not cover the quad scale range are dropped
+        toLoadMultiInds, toLoadInds = task._getIndexesToLoad(multiInds, 150.0, 200.0, radecCenter=center)
+        self.assertEqual(toLoadInds, [])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
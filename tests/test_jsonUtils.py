@@ -0,0 +1,73 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+from lsst.meas.extensions.astrometryNet.jsonUtils import writeJsonAtomic
+
+
+class WriteJsonAtomicTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "data.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.filename) as fd:
+            return json.load(fd)
+
+    def testWrite(self):
+        data = dict(a=[1, 2, 3], b="text")
+        writeJsonAtomic(self.filename, data, indent=2, sort_keys=True)
+        self.assertEqual(self.read(), data)
+        writeJsonAtomic(self.filename, dict(a=4))
+        self.assertEqual(self.read(), dict(a=4))
+        self.assertEqual(os.listdir(self.directory), ["data.json"])
+
+    def testFailure(self):
+        """A failed write leaves the old file in place, and no temporary file"""
+        writeJsonAtomic(self.filename, dict(a=1))
+        with self.assertRaises(TypeError):
+            writeJsonAtomic(self.filename, dict(a=object()))
+        self.assertEqual(self.read(), dict(a=1))
+        self.assertEqual(os.listdir(self.directory), ["data.json"])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -1,4 +1,5 @@
 from __future__ import absolute_import, division, print_function
+from builtins import object
 from builtins import zip
 
 #
@@ -28,6 +29,7 @@ import unittest
 
 import lsst.utils.tests
 from lsst.daf.base import PropertySet
+import lsst.pex.exceptions as pexExcept
 import lsst.afw.geom as afwGeom
 from lsst.afw.table import CoordKey, Point2DKey
 from lsst.meas.extensions.astrometryNet import LoadAstrometryNetObjectsTask, \
@@ -37,6 +39,41 @@ from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
 DoPlot = False
 
 
+class FakeIndex(object):
+    """An astrometry.net index with just the attributes used to count stars"""
+
+    def __init__(self, indexid, healpix, hpnside):
+        self.indexid = indexid
+        self.healpix = healpix
+        self.hpnside = hpnside
+
+
+class FakeMultiIndex(object):
+    """A multi-index holding one FakeIndex, that need not be loaded"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def pin(self):
+        pass
+
+    def unpin(self):
+        pass
+
+    def __getitem__(self, i):
+        return [self.index][i]
+
+
+class FakeSolver(object):
+    """A solver that reports fixed star counts"""
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def countStars(self, inds, ctrCoord, radius):
+        return list(self.counts)
+
+
 class TestLoadAstrometryNetObjects(unittest.TestCase):
 
     def setUp(self):
@@ -101,6 +138,56 @@ class TestLoadAstrometryNetObjects(unittest.TestCase):
         loadRes = loadANetObj.loadSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r")
         self.assertEqual(len(loadRes.refCat), self.desNumStarsInSkyCircle)
 
+    def testCountSkyCircle(self):
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        radius = ctrCoord.separation(self.wcs.pixelToSky(afwGeom.Box2D(self.bbox).getMin()))
+
+        countRes = loadANetObj.countSkyCircle(ctrCoord=ctrCoord, radius=radius)
+        self.assertEqual(countRes.counts, [self.desNumStarsInSkyCircle])
+        self.assertEqual(countRes.numStars, self.desNumStarsInSkyCircle)
+        self.assertEqual(len(countRes.indexIds), 1)
+        self.assertIsNone(countRes.magHistograms)
+
+        magBinEdges = [-100, 15, 18, 21, 100]
+        countRes = loadANetObj.countSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="r",
+                                              magBinEdges=magBinEdges)
+        self.assertEqual(len(countRes.magHistograms), 1)
+        self.assertEqual(len(countRes.magHistograms[0]), len(magBinEdges) - 1)
+        self.assertEqual(sum(countRes.magHistograms[0]), self.desNumStarsInSkyCircle)
+
+        with self.assertRaises(pexExcept.InvalidParameterError):
+            loadANetObj.countSkyCircle(ctrCoord=ctrCoord, radius=radius, magBinEdges=[18, 15])
+        with self.assertRaises(RuntimeError):
+            loadANetObj.countSkyCircle(ctrCoord=ctrCoord, radius=radius, filterName="nonexistent",
+                                       magBinEdges=magBinEdges)
+
+    def testCountSkyCircleTiles(self):
+        """Count the stars in a circle crossing a healpix tile boundary, with two scales per tile
+        """
+        loadANetObj = LoadAstrometryNetObjectsTask(config=self.config)
+        ctrCoord = self.wcs.pixelToSky(afwGeom.Point2D(self.ctrPix))
+        inds = [FakeIndex(1, 11, 2), FakeIndex(2, 11, 2), FakeIndex(3, 12, 2), FakeIndex(4, 12, 2)]
+
+        def countTiles(inds, counts):
+            loadANetObj._getMIndexesWithinRange = lambda ctrCoord, radius: [FakeMultiIndex(ind)
+                                                                            for ind in inds]
+            loadANetObj._getSolver = lambda: FakeSolver(counts)
+            return loadANetObj.countSkyCircle(ctrCoord=ctrCoord, radius=0.1*afwGeom.degrees)
+
+        countRes = countTiles(inds, [300, 280, 150, 160])
+        self.assertEqual(countRes.indexIds, [1, 2, 3, 4])
+        self.assertEqual(countRes.counts, [300, 280, 150, 160])
+        # Duplicates within a tile count once; the two tiles add
+        self.assertEqual(countRes.numStars, 300 + 160)
+
+        # An all-sky index overlaps both tiles
+        allSky = FakeIndex(5, -1, 1)
+        self.assertEqual(countTiles(inds + [allSky], [300, 280, 150, 160, 400]).numStars, 460)
+        self.assertEqual(countTiles(inds + [allSky], [300, 280, 150, 160, 500]).numStars, 500)
+        self.assertEqual(countTiles([], []).numStars, 0)
+
     def testNoMagErrs(self):
         """Exclude magnitude errors from the found catalog
         """
@@ -0,0 +1,110 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.extensions.astrometryNet import cleanBadPoints
+from lsst.meas.extensions.astrometryNet.matchArrays import MatchArrays
+
+
+class MatchArraysTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        self.wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(1000, 1000),
+                                      crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                      cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        refCat = afwTable.SimpleCatalog(afwTable.SimpleTable.makeMinimalSchema())
+        srcSchema = afwTable.SourceTable.makeMinimalSchema()
+        centroidKey = afwTable.Point2DKey.addFields(srcSchema, "centroid", "centroid", "pixel")
+        srcSchema.getAliasMap().set("slot_Centroid", "centroid")
+        srcCat = afwTable.SourceCatalog(srcSchema)
+        self.matches = []
+        for i in range(200):
+            x, y = rng.uniform(0, 2000, 2)
+            ref = refCat.addNew()
+            ref.setCoord(self.wcs.pixelToSky(x, y))
+            src = srcCat.addNew()
+            src.set(centroidKey, afwGeom.Point2D(x + rng.normal(0, 0.5) + (5 if i % 20 == 0 else 0),
+                                                 y + rng.normal(0, 0.5)))
+            self.matches.append(afwTable.ReferenceMatch(ref, src, 1e-6*i))
+
+    def assertSameMatches(self, matches1, matches2):
+        self.assertEqual(len(matches1), len(matches2))
+        for m1, m2 in zip(matches1, matches2):
+            self.assertEqual(m1.first.getId(), m2.first.getId())
+            self.assertEqual(m1.second.getId(), m2.second.getId())
+            self.assertAlmostEqual(m1.distance, m2.distance)
+
+    def testRoundTrip(self):
+        matchArrays = MatchArrays.fromReferenceMatches(self.matches)
+        self.assertEqual(len(matchArrays), len(self.matches))
+        self.assertSameMatches(matchArrays.toReferenceMatches(), self.matches)
+        self.assertFloatsAlmostEqual(matchArrays.srcX, np.array([m.second.getX() for m in self.matches]))
+        self.assertFloatsAlmostEqual(matchArrays.refDec,
+                                     np.array([m.first.getDec().asRadians() for m in self.matches]))
+
+    def testSubset(self):
+        matchArrays = MatchArrays.fromReferenceMatches(self.matches)
+        mask = np.arange(len(self.matches)) % 3 == 0
+        self.assertSameMatches(matchArrays.subset(mask).toReferenceMatches(),
+                               [m for m, keep in zip(self.matches, mask) if keep])
+        indices = np.array([5, 2, 7])
+        self.assertSameMatches(matchArrays.subset(indices).toReferenceMatches(),
+                               [self.matches[i] for i in indices])
+
+    def testPositions(self):
+        matchArrays = MatchArrays.fromReferenceMatches(self.matches)
+        refX, refY = matchArrays.getRefPixels(self.wcs)
+        separations = matchArrays.getSeparations(self.wcs)
+        for i, m in enumerate(self.matches):
+            refPixel = self.wcs.skyToPixel(m.first.getCoord())
+            self.assertAlmostEqual(refX[i], refPixel.getX(), places=6)
+            self.assertAlmostEqual(refY[i], refPixel.getY(), places=6)
+            separation = self.wcs.pixelToSky(m.second.getCentroid()).separation(m.first.getCoord())
+            self.assertAlmostEqual(separations[i], separation.asRadians(), delta=1e-12)
+
+    def testClean(self):
+        """cleanBadPoints.clean gives the same matches for a list and a MatchArrays"""
+        cleanList = cleanBadPoints.clean(self.matches, self.wcs)
+        cleanArrays = cleanBadPoints.clean(MatchArrays.fromReferenceMatches(self.matches), self.wcs)
+        self.assertIsInstance(cleanArrays, MatchArrays)
+        self.assertLess(len(cleanList), len(self.matches))
+        self.assertSameMatches(cleanArrays.toReferenceMatches(), cleanList)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -24,6 +24,8 @@ from __future__ import absolute_import, division, print_function
 import os
 import unittest
 
+import numpy as np
+
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
 import lsst.afw.image as afwImg
@@ -32,7 +34,9 @@ from astrometry.util import ttime
 from lsst.log import Log
 from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig, \
     ANetBasicAstrometryConfig, ANetBasicAstrometryTask
-from lsst.meas.extensions.astrometryNet.multiindex import generateCache
+from lsst.meas.extensions.astrometryNet.astrometry_net import radecDegToHealpix
+from lsst.meas.extensions.astrometryNet.densityMap import DensityMap
+from lsst.meas.extensions.astrometryNet.multiindex import AstrometryNetCatalog, generateCache
 from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
 
 
@@ -105,6 +109,92 @@ class MultiIndexTest(unittest.TestCase):
         andConfig.load(fn)
         self._testGetSolution(andConfig=andConfig)
 
+    def testHierarchicalSolve(self):
+        """Test a blind solve that first uses only the coarsest indexes, then refines"""
+        andConfig = AstrometryNetDataConfig()
+        fn = os.path.join(self.an_data_dir, 'andConfig6.py')
+        andConfig.load(fn)
+        self.conf.useHierarchicalSolve = True
+        astrom = ANetBasicAstrometryTask(self.conf, andConfig=andConfig)
+
+        # Record the indexes given to the solver by each solve
+        selections = []
+        getIndexesToLoad = astrom._getIndexesToLoad
+
+        def recordIndexes(multiInds, qlo, qhi, coarseOnly=False, radecCenter=None):
+            result = getIndexesToLoad(multiInds, qlo, qhi, coarseOnly=coarseOnly, radecCenter=radecCenter)
+            selections.append((coarseOnly, radecCenter, result[1]))
+            return result
+        astrom._getIndexesToLoad = recordIndexes
+
+        res = astrom.determineWcs(self.srcCat, self.exposure, bbox=self.bbox, useRaDecCenter=False)
+        self.assertGreater(len(res.getMatches()), 50)
+
+        self.assertEqual(len(selections), 2)
+        maxScale = max(ind.index_scale_upper for mi in astrom.refObjLoader.multiInds for ind in mi)
+        coarseOnly, radecCenter, coarseInds = selections[0]
+        self.assertTrue(coarseOnly)
+        self.assertIsNone(radecCenter)
+        self.assertGreater(len(coarseInds), 0)
+        for ind in coarseInds:
+            self.assertEqual(ind.index_scale_upper, maxScale)
+        coarseOnly, radecCenter, fineInds = selections[1]
+        self.assertFalse(coarseOnly)
+        self.assertIsNotNone(radecCenter)
+        self.assertGreaterEqual(len(fineInds), len(coarseInds))
+        solvedCenter = res.getWcs().pixelToSky(afwGeom.Box2D(self.bbox).getCenter())
+        self.assertLess(radecCenter.separation(solvedCenter).asArcseconds(), 1.0)
+
+    def testHierarchicalSolveLoading(self):
+        """Test that the coarse solve of a hierarchical solve does not load the fine indexes"""
+        andConfig = AstrometryNetDataConfig()
+        fn = os.path.join(self.an_data_dir, 'andConfig2.py')
+        andConfig.load(fn)
+        andConfig.allowCache = True
+        cacheName = os.path.join(self.an_data_dir, 'andCache.fits')
+        if os.path.exists(cacheName):
+            os.unlink(cacheName)
+        try:
+            generateCache(andConfig, densityNside=0)
+            self.conf.useHierarchicalSolve = True
+            astrom = ANetBasicAstrometryTask(self.conf, andConfig=andConfig)
+            multiInds = list(astrom.refObjLoader.multiInds)
+            self.assertEqual(len(multiInds), 2)
+            maxScale = max(upper for mi in multiInds for lower, upper in mi.getScaleRanges())
+            coarse = [mi for mi in multiInds if mi.getScaleRanges()[0][1] == maxScale]
+            fine = [mi for mi in multiInds if mi not in coarse]
+            self.assertEqual(len(coarse), 1)
+            self.assertEqual(len(fine), 1)
+
+            # Record each load of a multi-index, and the loads made before each index selection
+            loads = []
+            for mi in multiInds:
+                def reload(mi=mi, original=mi.reload):
+                    if not mi._loaded:
+                        loads.append(mi)
+                    original()
+                mi.reload = reload
+            selections = []
+            getIndexesToLoad = astrom._getIndexesToLoad
+
+            def recordIndexes(multiInds, qlo, qhi, coarseOnly=False, radecCenter=None):
+                result = getIndexesToLoad(multiInds, qlo, qhi, coarseOnly=coarseOnly,
+                                          radecCenter=radecCenter)
+                selections.append((coarseOnly, list(loads)))
+                return result
+            astrom._getIndexesToLoad = recordIndexes
+
+            res = astrom.determineWcs(self.srcCat, self.exposure, bbox=self.bbox, useRaDecCenter=False)
+            self.assertGreater(len(res.getMatches()), 50)
+            self.assertEqual([coarseOnly for coarseOnly, loaded in selections], [True, False])
+            coarseLoads = selections[0][1]
+            self.assertEqual(coarseLoads, coarse)
+            self.assertNotIn(fine[0], coarseLoads)
+            self.assertIn(fine[0], loads)
+        finally:
+            if os.path.exists(cacheName):
+                os.unlink(cacheName)
+
     # This one uses the cache
     def testCache(self):
         andConfig = AstrometryNetDataConfig()
@@ -122,6 +212,80 @@ class MultiIndexTest(unittest.TestCase):
             if os.path.exists(cacheName):
                 os.unlink(cacheName)
 
+    def testDensityMap(self):
+        """Test density maps written to and read from the cache"""
+        andConfig = AstrometryNetDataConfig()
+        fn = os.path.join(self.an_data_dir, 'andConfig6.py')
+        andConfig.load(fn)
+        andConfig.allowCache = True
+        cacheName = os.path.join(self.an_data_dir, 'andCache.fits')
+        if os.path.exists(cacheName):
+            os.unlink(cacheName)
+        try:
+            generateCache(andConfig, densityNside=8, quantiles=(0.1, 0.5, 0.9))
+            catalog = AstrometryNetCatalog(andConfig)
+            self.assertTrue(catalog.hasDensityMaps())
+            for ind in catalog:
+                self.assertEqual(ind.densityMap.nside, 8)
+                self.assertGreater(ind.densityMap.counts.sum(), 0)
+                self.assertEqual(ind.densityMap.counts.sum(), ind[0].nstars)
+                ind.unload()
+
+            # The whole sky holds every star; a circle about the test field holds some
+            allSky = catalog.planSkyCircle(afwGeom.SpherePoint(0, 0, afwGeom.degrees), 180*afwGeom.degrees)
+            self.assertAlmostEqual(allSky.numStars, sum(ind.densityMap.counts.sum() for ind in catalog))
+            center = afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees)
+            plan = catalog.planSkyCircle(center, 0.1*afwGeom.degrees)
+            self.assertGreater(plan.numStars, 0)
+            self.assertLess(plan.numStars, allSky.numStars)
+            self.assertEqual(len(plan.magQuantiles), len(plan.multiInds))
+            for mags in plan.magQuantiles:
+                self.assertTrue(np.all(np.diff(mags) >= 0))
+        finally:
+            if os.path.exists(cacheName):
+                os.unlink(cacheName)
+
+    def testDensityMapNoMagnitudes(self):
+        """Test that a missing magnitude column gives density maps without magnitude quantiles"""
+        andConfig = AstrometryNetDataConfig()
+        fn = os.path.join(self.an_data_dir, 'andConfig6.py')
+        andConfig.load(fn)
+        andConfig.allowCache = True
+        cacheName = os.path.join(self.an_data_dir, 'andCache.fits')
+        if os.path.exists(cacheName):
+            os.unlink(cacheName)
+        try:
+            generateCache(andConfig, densityNside=8, magColumn='noSuchColumn')
+            catalog = AstrometryNetCatalog(andConfig)
+            self.assertTrue(catalog.hasDensityMaps())
+            for ind in catalog:
+                self.assertEqual(ind.densityMap.counts.sum(), ind[0].nstars)
+                self.assertTrue(np.all(np.isnan(ind.densityMap.magQuantiles)))
+                ind.unload()
+        finally:
+            if os.path.exists(cacheName):
+                os.unlink(cacheName)
+
+    def testDensityMapFromArrays(self):
+        """Test the counts and magnitude quantiles of a density map against numpy"""
+        rng = np.random.RandomState(12345)
+        num = 5000
+        ra = rng.uniform(0, 360, num)
+        dec = np.degrees(np.arcsin(rng.uniform(-1, 1, num)))
+        mag = rng.uniform(10, 20, num)
+        mag[::50] = np.nan
+        quantiles = (0.0, 0.25, 0.5, 1.0)
+        densityMap = DensityMap.fromArrays(ra, dec, mag, 2, quantiles)
+        pixels = np.asarray(radecDegToHealpix(ra, dec, 2))
+        self.assertEqual(len(densityMap.counts), 48)
+        self.assertEqual(densityMap.counts.sum(), num)
+        for pix in range(48):
+            inPix = pixels == pix
+            self.assertEqual(densityMap.counts[pix], inPix.sum())
+            finiteMags = mag[inPix & np.isfinite(mag)]
+            expected = np.percentile(finiteMags, [100*q for q in quantiles])
+            np.testing.assert_allclose(densityMap.magQuantiles[pix], expected)
+
     # Test that creating an Astrometry object with many index files
     # does not use up a lot of memory or file descriptors.
     # FIXME -- there are no tests on memory usage -- not clear exactly
@@ -0,0 +1,79 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet.pointingModel import PointingModel
+
+
+class PointingModelTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "pointing.json")
+        self.commanded = afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees)
+        # The telescope consistently points 20 arcsec east and 10 arcsec south of where it is told
+        self.solved = self.commanded.offset(math.atan2(-10, 20)*afwGeom.radians,
+                                            math.hypot(20, 10)*afwGeom.arcseconds)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testUpdateAndCorrect(self):
+        model = PointingModel(self.filename, "telescope")
+        self.assertEqual(model.getNumUpdates(), 0)
+        self.assertEqual(model.correct(self.commanded), self.commanded)
+        for i in range(5):
+            model.update(self.commanded, self.solved)
+        self.assertEqual(model.getNumUpdates(), 5)
+        corrected = model.correct(self.commanded)
+        self.assertLess(corrected.separation(self.solved).asArcseconds(), 0.01)
+        self.assertLess(model.getUncertainty().asArcseconds(), 0.01)
+
+    def testPersistence(self):
+        model = PointingModel(self.filename, "telescope")
+        model.update(self.commanded, self.solved)
+        model.write()
+        other = PointingModel(self.filename, "otherTelescope")
+        self.assertEqual(other.getNumUpdates(), 0)
+        same = PointingModel(self.filename, "telescope")
+        self.assertEqual(same.getNumUpdates(), 1)
+        self.assertLess(same.correct(self.commanded).separation(self.solved).asArcseconds(), 0.01)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
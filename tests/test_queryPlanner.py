@@ -0,0 +1,135 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet import AstrometryNetDataConfig
+from lsst.meas.extensions.astrometryNet.multiindex import AstrometryNetCatalog, generateCache
+from lsst.meas.extensions.astrometryNet.queryPlanner import QueryPlanner, makePointing, readPointings
+from test_findAstrometryNetDataDir import setupAstrometryNetDataDir
+
+
+class QueryPlannerTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.an_data_dir = setupAstrometryNetDataDir('photocal')
+        self.andConfig = AstrometryNetDataConfig()
+        self.andConfig.load(os.path.join(self.an_data_dir, 'andConfig6.py'))
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4612))
+        self.wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(1024, 2306),
+                                      crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                      cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        self.directory = tempfile.mkdtemp()
+        self.cacheName = os.path.join(self.an_data_dir, 'andCache.fits')
+        if os.path.exists(self.cacheName):
+            os.unlink(self.cacheName)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        if os.path.exists(self.cacheName):
+            os.unlink(self.cacheName)
+
+    def makeCatalog(self):
+        """Make a catalog from a cache that records the index scale ranges"""
+        self.andConfig.allowCache = True
+        generateCache(self.andConfig, densityNside=0)
+        return AstrometryNetCatalog(self.andConfig)
+
+    def testScaleRangesFromCache(self):
+        """The cache records the same scale ranges as the index files"""
+        catalog = self.makeCatalog()
+        for mi in catalog:
+            cached = mi.getScaleRanges()
+            self.assertEqual(len(cached), len(mi))
+            mi.reload()
+            for (lower, upper), ind in zip(cached, mi):
+                self.assertAlmostEqual(lower, ind.index_scale_lower)
+                self.assertAlmostEqual(upper, ind.index_scale_upper)
+            mi.unload()
+
+    def testSelectFiles(self):
+        planner = QueryPlanner(self.makeCatalog())
+        files = planner.selectFiles(self.bbox, wcs=self.wcs)
+        self.assertGreater(len(files), 0)
+        # The star file comes before the index files
+        self.assertIn(files[0], set(mi.getFilenameList()[0] for mi in planner.catalog))
+        # A blind solve may use any index
+        blindFiles = planner.selectFiles(self.bbox)
+        self.assertTrue(set(files).issubset(set(blindFiles)))
+        # No index has quads this large
+        self.assertEqual(planner.selectFiles(self.bbox, pixelScale=1000*afwGeom.arcseconds), [])
+
+    def testPlan(self):
+        planner = QueryPlanner(self.makeCatalog())
+        near = makePointing("near", self.bbox, wcs=self.wcs, visit=1)
+        empty = makePointing("empty", self.bbox, pixelScale=1000*afwGeom.arcseconds, visit=2)
+        pointings = [near, empty, near, empty]
+        plan = planner.plan(pointings)
+        numBytes = plan.pointingBytes[0]
+        self.assertGreater(numBytes, 0)
+        self.assertEqual(plan.pointingBytes, [numBytes, 0, numBytes, 0])
+        self.assertEqual(plan.totalBytes, numBytes)
+        self.assertEqual(plan.peakBytes, numBytes)
+        self.assertEqual(plan.peakVisitBytes, numBytes)
+        self.assertEqual(plan.missingFiles, [])
+        for fn in plan.files[0]:
+            self.assertEqual(plan.accessCounts[fn], 2)
+        # The suggested order puts the two near pointings together, so their files load once
+        self.assertEqual(sorted(plan.order), [0, 1, 2, 3])
+        self.assertEqual(plan.order[:2], [0, 2])
+        self.assertEqual(plan.loadBytes, 2*numBytes)
+        self.assertEqual(plan.orderedLoadBytes, numBytes)
+
+    def testReadPointings(self):
+        filename = os.path.join(self.directory, "pointings.json")
+        with open(filename, "w") as fd:
+            json.dump([dict(name="a", bbox=[0, 0, 2048, 4612], ra=215.5, dec=53.0, pixelScale=0.2, visit=5),
+                       dict(name="b", bbox=[0, 0, 1000, 1000])], fd)
+        pointings = readPointings(filename)
+        self.assertEqual([p.name for p in pointings], ["a", "b"])
+        self.assertEqual(pointings[0].bbox, self.bbox)
+        self.assertEqual(pointings[0].visit, 5)
+        self.assertAlmostEqual(pointings[0].pixelScale.asArcseconds(), 0.2)
+        center = pointings[0].wcs.pixelToSky(afwGeom.Box2D(self.bbox).getCenter())
+        self.assertAlmostEqual(center.getLongitude().asDegrees(), 215.5)
+        self.assertAlmostEqual(center.getLatitude().asDegrees(), 53.0)
+        self.assertIsNone(pointings[1].wcs)
+        self.assertIsNone(pointings[1].visit)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
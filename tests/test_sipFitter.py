@@ -0,0 +1,118 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.pex.exceptions as pexExceptions
+from lsst.meas.astrom.sip import makeCreateWcsWithSip
+from lsst.meas.extensions.astrometryNet import ANetBasicAstrometryTask
+from lsst.meas.extensions.astrometryNet.sipFitter import TanSipFitter, fitTanSip
+from lsst.meas.extensions.astrometryNet.wcsUtils import pixelToSkyArrays, skyToPixelArrays
+
+
+class TanSipFitterTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.crpix = afwGeom.Point2D(1023.5, 2047.5)
+        self.crval = afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees)
+        self.cdMatrix = afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds, orientation=30*afwGeom.degrees)
+        self.sipA = np.zeros((4, 4))
+        self.sipB = np.zeros((4, 4))
+        self.sipA[2, 0] = 2e-6
+        self.sipA[1, 2] = -3e-10
+        self.sipB[0, 2] = 1e-6
+        self.sipB[3, 0] = 5e-10
+        self.wcs = afwGeom.makeTanSipWcs(self.crpix, self.crval, self.cdMatrix, self.sipA, self.sipB)
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+        rng = np.random.RandomState(12345)
+        self.x = rng.uniform(0, 2048, 500)
+        self.y = rng.uniform(0, 4096, 500)
+        self.ra, self.dec = pixelToSkyArrays(self.wcs, self.x, self.y)
+
+    def testRecovery(self):
+        """Recover the coefficients of a TAN-SIP WCS from exact positions"""
+        fitter = TanSipFitter(self.x, self.y, self.crpix, order=3)
+        fit = fitter.fit(self.ra, self.dec, self.crval, bbox=self.bbox)
+        self.assertEqual(fit.numPoints, len(self.x))
+        self.assertLess(fit.scatterOnSky.asArcseconds(), 1e-6)
+        self.assertLess(fit.scatterInPixels, 1e-5)
+        self.assertWcsAlmostEqualOverBBox(self.wcs, fit.wcs, self.bbox,
+                                          maxDiffSky=1e-5*afwGeom.arcseconds, maxDiffPix=1e-3)
+
+    def testRows(self):
+        """Fitting a subset of rows matches fitting a fitter built on that subset"""
+        rows = np.arange(0, len(self.x), 3)
+        fitter = TanSipFitter(self.x, self.y, self.crpix, order=3)
+        fitRows = fitter.fit(self.ra[rows], self.dec[rows], self.crval, rows=rows, bbox=self.bbox)
+        fitSubset = TanSipFitter(self.x[rows], self.y[rows], self.crpix, order=3).fit(
+            self.ra[rows], self.dec[rows], self.crval, bbox=self.bbox)
+        self.assertEqual(fitRows.numPoints, len(rows))
+        self.assertWcsAlmostEqualOverBBox(fitRows.wcs, fitSubset.wcs, self.bbox,
+                                          maxDiffSky=1e-6*afwGeom.arcseconds, maxDiffPix=1e-4)
+
+    def testOffsetCrpix(self):
+        """A zero-point offset of the initial WCS is absorbed into CRPIX, as by makeCreateWcsWithSip"""
+        initialWcs = afwGeom.makeSkyWcs(crpix=self.crpix + afwGeom.Extent2D(2.5, -4.0), crval=self.crval,
+                                        cdMatrix=self.cdMatrix)
+        matches = ANetBasicAstrometryTask._makeGridMatches(self.x, self.y, self.ra, self.dec)
+        fit = fitTanSip(matches, initialWcs, order=3, bbox=self.bbox)
+        self.assertLess(fit.scatterOnSky.asArcseconds(), 1e-6)
+        self.assertPairsAlmostEqual(fit.wcs.getPixelOrigin(), self.crpix, maxDiff=1e-4)
+        self.assertWcsAlmostEqualOverBBox(self.wcs, fit.wcs, self.bbox,
+                                          maxDiffSky=1e-5*afwGeom.arcseconds, maxDiffPix=1e-3)
+
+        sipObject = makeCreateWcsWithSip(matches.toReferenceMatches(), initialWcs, 3, self.bbox)
+        residuals = []
+        for wcs in (fit.wcs, sipObject.getNewWcs()):
+            x, y = skyToPixelArrays(wcs, self.ra, self.dec)
+            residuals.append(np.hypot(x - self.x, y - self.y))
+        self.assertFloatsAlmostEqual(residuals[0], residuals[1], atol=0.01)
+
+    def testTooFew(self):
+        fitter = TanSipFitter(self.x[:5], self.y[:5], self.crpix, order=3)
+        with self.assertRaises(pexExceptions.LengthError):
+            fitter.fit(self.ra[:5], self.dec[:5], self.crval)
+
+    def testSingular(self):
+        """Sources along a line give a singular CD matrix, reported as a pex exception"""
+        y = np.full(len(self.x), self.crpix.getY())
+        ra, dec = pixelToSkyArrays(self.wcs, self.x, y)
+        fitter = TanSipFitter(self.x, y, self.crpix, order=3)
+        with self.assertRaises(pexExceptions.RuntimeError):
+            fitter.fit(ra, dec, self.crval, bbox=self.bbox)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,111 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet.sipWarmStart import SipWarmStartCache
+
+
+class SipWarmStartCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "sip.json")
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+        self.crpix = afwGeom.Point2D(1023.5, 2047.5)
+        self.cdMatrix = afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds)
+        sipA = np.zeros((3, 3))
+        sipB = np.zeros((3, 3))
+        sipA[2, 0] = 2e-6
+        sipB[0, 2] = 1e-6
+        sipAp = -sipA
+        sipBp = -sipB
+        self.sipMatrices = (sipA, sipB, sipAp, sipBp)
+        self.sipWcs = self.makeSipWcs(afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def makeSipWcs(self, crval):
+        return afwGeom.makeTanSipWcs(self.crpix, crval, self.cdMatrix, *self.sipMatrices)
+
+    def testSeed(self):
+        """The seed combines the cached distortion with the linear part of a new TAN WCS"""
+        cache = SipWarmStartCache(self.filename)
+        newCrval = afwGeom.SpherePoint(150.0, 2.0, afwGeom.degrees)
+        tanWcs = afwGeom.makeSkyWcs(crpix=self.crpix, crval=newCrval, cdMatrix=self.cdMatrix)
+        self.assertIsNone(cache.makeSeedWcs("ccd1", "r", tanWcs))
+        self.assertTrue(cache.update("ccd1", "r", self.sipWcs, numIterations=4, warm=False))
+        self.assertIsNone(cache.makeSeedWcs("ccd1", "i", tanWcs))
+        self.assertIsNone(cache.makeSeedWcs("ccd2", "r", tanWcs))
+        seed = cache.makeSeedWcs("ccd1", "r", tanWcs)
+        self.assertWcsAlmostEqualOverBBox(seed, self.makeSipWcs(newCrval), self.bbox,
+                                          maxDiffSky=1e-6*afwGeom.arcseconds, maxDiffPix=1e-5)
+
+    def testIterations(self):
+        """The iterations of the last cold fit are kept when updating from a warm fit"""
+        cache = SipWarmStartCache(self.filename)
+        cache.update("ccd1", "r", self.sipWcs, numIterations=4, warm=False)
+        self.assertEqual(cache.getColdIterations("ccd1", "r"), 4)
+        cache.update("ccd1", "r", self.sipWcs, numIterations=1, warm=True)
+        self.assertEqual(cache.getColdIterations("ccd1", "r"), 4)
+        cache.update("ccd1", "r", self.sipWcs, numIterations=3, warm=False)
+        self.assertEqual(cache.getColdIterations("ccd1", "r"), 3)
+        self.assertIsNone(cache.getColdIterations("ccd2", "r"))
+
+    def testNoReverse(self):
+        """A WCS without reverse SIP terms is not recorded"""
+        cache = SipWarmStartCache(self.filename)
+        sipWcs = afwGeom.makeTanSipWcs(self.crpix, self.sipWcs.getSkyOrigin(), self.cdMatrix,
+                                       *self.sipMatrices[:2])
+        self.assertFalse(cache.update("ccd1", "r", sipWcs, numIterations=4, warm=False))
+        self.assertIsNone(cache.get("ccd1", "r"))
+
+    def testPersistence(self):
+        cache = SipWarmStartCache(self.filename)
+        cache.update("ccd1", "r", self.sipWcs, numIterations=4, warm=False)
+        cache.write()
+        same = SipWarmStartCache(self.filename)
+        self.assertEqual(same.getColdIterations("ccd1", "r"), 4)
+        seed = same.makeSeedWcs("ccd1", "r", self.sipWcs)
+        self.assertWcsAlmostEqualOverBBox(seed, self.sipWcs, self.bbox,
+                                          maxDiffSky=1e-6*afwGeom.arcseconds, maxDiffPix=1e-5)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,111 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet.skyMatcher import SkyMatcher
+
+
+class SkyMatcherTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.center = afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees)
+        self.radius = 1.0*afwGeom.arcseconds
+        rng = np.random.RandomState(12345)
+        num = 500
+        ra0, dec0 = np.radians(215.5), np.radians(53.0)
+        self.refRa = ra0 + rng.uniform(-0.01, 0.01, num)/np.cos(dec0)
+        self.refDec = dec0 + rng.uniform(-0.01, 0.01, num)
+        self.rng = rng
+
+    def bruteForce(self, ra, dec):
+        """Nearest reference for each source, then nearest source for each reference, by brute force"""
+        radius = self.radius.asRadians()
+        best = {}
+        for i in range(len(ra)):
+            source = afwGeom.SpherePoint(ra[i], dec[i], afwGeom.radians)
+            dist = np.array([source.separation(afwGeom.SpherePoint(r, d, afwGeom.radians)).asRadians()
+                             for r, d in zip(self.refRa, self.refDec)])
+            j = np.argmin(dist)
+            if dist[j] < radius and (j not in best or dist[j] < best[j][1]):
+                best[j] = (i, dist[j])
+        return best
+
+    def testMatch(self):
+        """Compare with a brute-force match"""
+        num = 200
+        pick = self.rng.choice(len(self.refRa), num, replace=False)
+        offset = np.radians(self.rng.normal(0, 0.5, (2, num))/3600.0)
+        ra = self.refRa[pick] + offset[0]/np.cos(self.refDec[pick])
+        dec = self.refDec[pick] + offset[1]
+
+        matcher = SkyMatcher(self.refRa, self.refDec, self.center, self.radius)
+        result = matcher.match(ra, dec)
+        expected = self.bruteForce(ra, dec)
+        self.assertEqual(len(result.refIndex), len(expected))
+        self.assertGreater(len(expected), num//2)
+        for refIndex, srcIndex, distance in zip(result.refIndex, result.srcIndex, result.distance):
+            self.assertEqual(expected[refIndex][0], srcIndex)
+            self.assertAlmostEqual(expected[refIndex][1], distance, delta=1e-12)
+
+    def testOneToOne(self):
+        """Two sources near one reference object: only the nearer is matched"""
+        matcher = SkyMatcher(self.refRa[:1], self.refDec[:1], self.center, self.radius)
+        step = np.radians(0.2/3600.0)
+        result = matcher.match(self.refRa[0] + np.array([2*step, step, 10*step]),
+                               np.repeat(self.refDec[0], 3))
+        np.testing.assert_array_equal(result.refIndex, [0])
+        np.testing.assert_array_equal(result.srcIndex, [1])
+
+    def testReuse(self):
+        """A matcher may be queried repeatedly with moved positions"""
+        refRa = np.radians(215.5) + np.radians(np.arange(50)*5.0/3600.0)
+        refDec = np.repeat(np.radians(53.0), 50)
+        matcher = SkyMatcher(refRa, refDec, self.center, self.radius)
+        for shift in (0.0, 0.3, 0.6):
+            result = matcher.match(refRa, refDec + np.radians(shift/3600.0))
+            self.assertEqual(len(result.srcIndex), 50)
+            np.testing.assert_array_equal(result.refIndex, result.srcIndex)
+
+    def testEmpty(self):
+        matcher = SkyMatcher(self.refRa, self.refDec, self.center, self.radius)
+        result = matcher.match(np.zeros(0), np.zeros(0))
+        self.assertEqual(len(result.refIndex), 0)
+        self.assertEqual(len(result.distance), 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,96 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.daf.base as dafBase
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet.solveCache import SolveCache
+
+
+class SolveCacheTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(2048, 4096))
+        self.wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(1000, 2000),
+                                      crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                      cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        self.solveStats = dafBase.PropertyList()
+        self.solveStats.set("meas_astrom*an*n_tried", 123)
+        self.solveStats.set("meas_astrom*an*best_logodds", 45.6)
+        np.random.seed(1)
+        self.x = np.random.uniform(0, 2048, 100)
+        self.y = np.random.uniform(0, 4096, 100)
+        self.flux = np.random.uniform(100, 1000, 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def makeKey(self, **kwargs):
+        args = dict(x=self.x, y=self.y, flux=self.flux, bbox=self.bbox, pixelScale=None,
+                    radecCenter=None, searchRadius=None, parity=None, indexIdentity="abc")
+        args.update(kwargs)
+        return SolveCache.makeKey(**args)
+
+    def testKey(self):
+        key = self.makeKey()
+        self.assertEqual(key, self.makeKey())
+        self.assertNotEqual(key, self.makeKey(parity=True))
+        self.assertNotEqual(key, self.makeKey(indexIdentity="def"))
+        self.assertNotEqual(key, self.makeKey(x=self.x + 0.01))
+
+    def testRoundTrip(self):
+        cache = SolveCache(self.directory)
+        key = self.makeKey()
+        self.assertIsNone(cache.get(key, "fingerprint"))
+        cache.put(key, "fingerprint", self.wcs, self.solveStats)
+        wcs, solveStats = cache.get(key, "fingerprint")
+        self.assertWcsAlmostEqualOverBBox(wcs, self.wcs, self.bbox)
+        self.assertEqual(solveStats.get("meas_astrom*an*n_tried"), 123)
+        self.assertAlmostEqual(solveStats.get("meas_astrom*an*best_logodds"), 45.6)
+
+    def testInvalidation(self):
+        cache = SolveCache(self.directory)
+        key = self.makeKey()
+        cache.put(key, "fingerprint", self.wcs, self.solveStats)
+        self.assertIsNone(cache.get(key, "newFingerprint"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,81 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.extensions.astrometryNet.sourceThinning import selectBrightestPerCell
+
+
+class SourceThinningTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(400, 300))
+        rng = np.random.RandomState(12345)
+        num = 2000
+        self.x = rng.uniform(100, 500, num)
+        self.y = rng.uniform(200, 500, num)
+        self.flux = rng.uniform(1, 1000, num)
+
+    def testMatchesLoop(self):
+        """Compare with a per-cell loop"""
+        numCells, numPerCell = 4, 3
+        keep = selectBrightestPerCell(self.x, self.y, self.flux, self.bbox, numCells, numPerCell)
+
+        cellX = ((self.x - 100)*numCells/400).astype(int)
+        cellY = ((self.y - 200)*numCells/300).astype(int)
+        expected = []
+        for cx in range(numCells):
+            for cy in range(numCells):
+                inCell = np.where((cellX == cx) & (cellY == cy))[0]
+                expected.extend(inCell[np.argsort(-self.flux[inCell])][:numPerCell])
+        self.assertEqual(len(keep), numCells*numCells*numPerCell)
+        np.testing.assert_array_equal(keep, np.sort(expected))
+
+    def testClustered(self):
+        """Sources bunched in one corner should not crowd out the rest of the image"""
+        flux = self.flux.copy()
+        corner = (self.x < 150) & (self.y < 250)
+        flux[corner] *= 1000
+        keep = selectBrightestPerCell(self.x, self.y, flux, self.bbox, 2, 5)
+        self.assertEqual(len(keep), 20)
+        self.assertEqual(corner[keep].sum(), 5)
+
+    def testEmpty(self):
+        keep = selectBrightestPerCell(np.zeros(0), np.zeros(0), np.zeros(0), self.bbox, 4, 3)
+        self.assertEqual(len(keep), 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
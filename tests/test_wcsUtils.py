@@ -0,0 +1,80 @@
+#
+# LSST Data Management System
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+
+from __future__ import absolute_import, division, print_function
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.meas.extensions.astrometryNet.wcsUtils import setSourceCoords
+
+
+class SetSourceCoordsTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        tanWcs = afwGeom.makeSkyWcs(crpix=afwGeom.Point2D(1000, 1000),
+                                    crval=afwGeom.SpherePoint(215.5, 53.0, afwGeom.degrees),
+                                    cdMatrix=afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        self.wcs = afwGeom.makeModifiedWcs(pixelTransform=afwGeom.makeRadialTransform([0, 1.0, 1e-6]),
+                                           wcs=tanWcs, modifyActualPixels=False)
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        self.centroidKey = afwTable.Point2DKey.addFields(schema, "centroid", "centroid", "pixel")
+        schema.getAliasMap().set("slot_Centroid", "centroid")
+        self.sourceCat = afwTable.SourceCatalog(schema)
+        rng = np.random.RandomState(12345)
+        for i in range(100):
+            src = self.sourceCat.addNew()
+            src.set(self.centroidKey, afwGeom.Point2D(*rng.uniform(0, 2000, 2)))
+
+    def assertCoordsSet(self, sourceCat):
+        for src in sourceCat:
+            expected = self.wcs.pixelToSky(src.getCentroid())
+            self.assertLess(src.getCoord().separation(expected).asArcseconds(), 1e-8)
+
+    def testContiguous(self):
+        self.assertTrue(self.sourceCat.isContiguous())
+        setSourceCoords(self.wcs, self.sourceCat)
+        self.assertCoordsSet(self.sourceCat)
+
+    def testNonContiguous(self):
+        subset = self.sourceCat[::2]
+        self.assertFalse(subset.isContiguous())
+        setSourceCoords(self.wcs, subset)
+        self.assertCoordsSet(subset)
+
+    def testEmpty(self):
+        setSourceCoords(self.wcs, self.sourceCat[:0])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()